@@ -0,0 +1,101 @@
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+from collections import namedtuple
+import heapq
+import itertools
+
+import logbook
+
+from .constants import BATCH_DOWNLOADS_IN_FLIGHT
+
+logger = logbook.Logger(__name__)
+
+LESSONS_PREFIX = 'lessons:'
+
+
+class Job(namedtuple('Job', field_names=['department', 'lessons', 'priority'])):
+    """
+    A department number, or a list of lesson ids (department is None), downloaded at some priority - higher first
+    """
+
+    def __str__(self):
+        if self.department is not None:
+            return 'department {}'.format(self.department)
+        return 'lessons {}'.format(', '.join(self.lessons))
+
+
+def parse_job(spec):
+    """
+    '12' is department 12, 'lessons:101,102' a set of lessons, either followed by '@<priority>' (0 by default)
+    """
+    spec, _, priority = spec.strip().partition('@')
+    try:
+        priority = int(priority) if priority else 0
+        if spec.startswith(LESSONS_PREFIX):
+            lessons = [lesson_id.strip() for lesson_id in spec[len(LESSONS_PREFIX):].split(',') if lesson_id.strip()]
+            if not lessons:
+                raise ValueError('no lessons')
+            return Job(None, lessons, priority)
+        return Job(int(spec), None, priority)
+    except ValueError:
+        raise ValueError('invalid batch job {!r}, expected <department>[@priority] or '
+                         'lessons:<id>,<id>...[@priority]'.format(spec))
+
+
+def read_jobs(path):
+    """
+    Jobs of a batch file, one per line. Empty lines and lines starting with # are skipped
+    """
+    with open(path) as f:
+        return [parse_job(line) for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+def by_priority(jobs):
+    # stable, jobs of the same priority keep their order
+    return sorted(jobs, key=lambda job: -job.priority)
+
+
+class PriorityDownloads(object):
+    """
+    Feeds the downloads of every job of a batch to a single downloader, highest priority first. At most in_flight
+    of them are started at once, so work queued (or retried) later by an important job doesn't wait behind
+    everything else, and the downloader's scheduler bounds the connections of the whole batch.
+    """
+
+    def __init__(self, downloader, in_flight=BATCH_DOWNLOADS_IN_FLIGHT):
+        self.downloader = downloader
+        self.in_flight = in_flight
+        self._heap = []
+        self._order = itertools.count()
+
+    def put(self, priority, link, output_folder_path):
+        heapq.heappush(self._heap, (-priority, next(self._order), link, output_folder_path))
+
+    def __len__(self):
+        return len(self._heap)
+
+    @asyncio.coroutine
+    def _run(self):
+        running = set()
+        failed = 0
+        while self._heap or running:
+            while self._heap and len(running) < self.in_flight:
+                _, _, link, output_folder_path = heapq.heappop(self._heap)
+                task = self.downloader.download_link(link, output_folder_path)
+                if task is not None:
+                    running.add(task)
+
+            if running:
+                done, running = yield from asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                # already logged by the downloader
+                failed += sum(1 for task in done if task.cancelled() or task.exception() is not None)
+
+        if failed:
+            logger.error('{} downloads of the batch failed'.format(failed))
+
+    def run(self):
+        try:
+            self.downloader.loop.run_until_complete(self._run())
+        finally:
+            self.downloader.close()
@@ -8,9 +8,124 @@ ARTISTWORKS_MASTERCLASS_BASE = 'http://artistworks.com/masterclass/'
 
 DEFAULT_OUTPUT_DIRECTORY = str(Path(os.path.expanduser('~')).joinpath('ArtistWorks'))
 
+# download concurrency starts at MAX_CONCURRENT_DOWNLOADS and adapts within its bounds
 MAX_CONCURRENT_DOWNLOADS = 5
+MIN_CONCURRENT_DOWNLOADS = 1
+MAX_CONCURRENT_DOWNLOADS_LIMIT = 32
+CONCURRENCY_ADJUST_INTERVAL = 5
+CONCURRENCY_ERROR_THRESHOLD = 0.1
+CONCURRENCY_DECREASE_FACTOR = 0.5
+CONCURRENCY_THROUGHPUT_TOLERANCE = 0.05
+
+# requests per second (and burst) per host, None for no limit
+HOST_REQUEST_RATE = 20
+HOST_REQUEST_BURST = 40
+
+# retries wait a random time of up to RETRY_BACKOFF_BASE * 2 ** attempt seconds, at most RETRY_BACKOFF_MAX
 MAX_RETRIES = 5
-RETRY_DURATION = 60
+RETRY_BACKOFF_BASE = 2
+RETRY_BACKOFF_MAX = 120
+
+# large files served with Accept-Ranges are split into this many concurrent byte ranges
+DOWNLOAD_SEGMENTS = 4
+SEGMENTED_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+# the progress of a download (of each of its ranges) is saved to the sidecar every this many bytes, a killed
+# download resumes from there
+PROGRESS_SAVE_INTERVAL = 16 * 1024 * 1024
+
+# stream reads grow between these sizes, writes go through a fixed pool of buffers to a few writer threads
+MIN_READ_CHUNK_SIZE = 64 * 1024
+MAX_READ_CHUNK_SIZE = 4 * 1024 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+WRITE_BUFFERS = 32
+DISK_WRITER_THREADS = 4
+
+# downloads are hashed as they stream, in blocks of this size (byte ranges start on block boundaries)
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+# query parameters of signed cdn urls, ignored when telling whether two urls are the same asset
+VOLATILE_URL_PARAMETERS = frozenset(['token', 'expires', 'signature', 'policy', 'key-pair-id', 'hdnts', 'hdntl',
+                                     '__gda__'])
+
+# HLS output formats and rendition policies
+TS = 'ts'
+MP4 = 'mp4'
+HLS_FORMATS = (TS, MP4)
+MAX_RESOLUTION = 'max_resolution'
+MAX_BANDWIDTH = 'max_bandwidth'
+RENDITION_POLICIES = (MAX_RESOLUTION, MAX_BANDWIDTH)
+
+# streamed HLS: segments fetched ahead of the one being written, and retries of a single segment
+HLS_WINDOW = 8
+HLS_SEGMENT_RETRIES = 3
+
+# resolved playlists, kept in memory and in the manifest
+PLAYLIST_CACHE_SIZE = 1024
+PLAYLIST_CACHE_TTL = 6 * 60 * 60
+
+# pipelined runs: lessons waiting between stages, and lessons downloading at the same time
+PIPELINE_QUEUE_SIZE = 8
+PIPELINE_LESSONS_IN_FLIGHT = 16
+# how often a scraper blocked on a full queue checks whether the pipeline stopped, in seconds
+PIPELINE_STOP_POLL_INTERVAL = 0.5
+
+# batch runs: downloads of all jobs started at the same time, further ones wait in priority order
+BATCH_DOWNLOADS_IN_FLIGHT = 64
+
+# planned downloads: sizes probed with at most PLAN_PROBE_CONCURRENCY HEAD requests at a time, and the space kept
+# free on the output disk by default
+PLAN_PROBE_CONCURRENCY = 32
+PLAN_FREE_SPACE_RESERVE_MB = 1024
+
+# shared http session settings
+HTTP_CONNECTION_LIMIT = 100
+HTTP_CONNECTION_LIMIT_PER_HOST = 20
+HTTP_KEEPALIVE_TIMEOUT = 30
+HTTP_DNS_CACHE_TTL = 300
+HTTP_CONNECT_TIMEOUT = 30
+HTTP_READ_TIMEOUT = 300
+
+# run metrics, written to output_dir/METRICS_DIRECTORY at the end of every run
+METRICS_DIRECTORY = 'metrics'
+METRICS_PREFIX = 'artistworks_'
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+THROUGHPUT_BUCKETS = tuple(2 ** power * 1024 for power in range(4, 18, 2))
+MAX_FILE_PROGRESS_BARS = 8
+# histograms keep a uniform sample of at most this many observations for their quantiles
+HISTOGRAM_SAMPLE_SIZE = 1024
+
+# sqlite manifest: queued writes committed together, and how long to wait for another process' transaction
+MANIFEST_NAME = 'manifest.sqlite'
+MANIFEST_BATCH_SIZE = 200
+MANIFEST_COMMIT_INTERVAL = 2
+MANIFEST_BUSY_TIMEOUT = 30
+
+MAX_SCRAPE_RETRIES = 3
+
+# distributed runs: work items are leased for WORK_LEASE_SECONDS, kept by heartbeats every third of it
+WORK_QUEUE_NAME = 'work.sqlite'
+WORK_LEASE_SECONDS = 60
+WORK_MAX_ATTEMPTS = 5
+WORK_CLAIM_BATCH = 8
+WORK_POLL_INTERVAL = 2
+WORK_UNREACHABLE_RETRIES = 5
+WORK_KINDS = ('lesson', 'masterclass', 'download', 'unite')
+
+# logged in sessions saved between runs, in output_dir/SESSION_DIRECTORY unless told otherwise
+SESSION_DIRECTORY = '.session'
+SESSION_FILE_NAME = 'session.json'
+SESSION_PROFILE_DIRECTORY = 'profile'
+SESSION_CHECK_TIMEOUT = 10
+# id of the user block artistworks only shows to logged in users
+LOGGED_IN_MARKER = 'blk-artistworks_user'
+HTTP_SCRAPE_CONCURRENCY = 8
+
+# waiting for jwplayer to switch to a clicked playlist item
+LINK_EVENT_TIMEOUT = 3
+LINK_POLL_TIMEOUT = 20
+LINK_POLL_INITIAL_DELAY = 0.25
+LINK_POLL_MAX_DELAY = 4
 
 if os.name == 'nt':
     LOG_PATH = os.path.join(os.path.expandvars('%LOCALAPPDATA%'), 'temp', 'artistworks_downloader.log')
@@ -0,0 +1,605 @@
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+from collections import namedtuple
+import contextlib
+import functools
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+import logbook
+
+from .constants import WORK_LEASE_SECONDS, WORK_MAX_ATTEMPTS, WORK_CLAIM_BATCH, WORK_POLL_INTERVAL, \
+    WORK_KINDS, WORK_UNREACHABLE_RETRIES, MANIFEST_BUSY_TIMEOUT
+from .metrics import metrics
+from .models import Lesson, Masterclass, LessonLink
+
+logger = logbook.Logger(__name__)
+
+# kinds of work
+LESSON, MASTERCLASS, DOWNLOAD, UNITE = KINDS = WORK_KINDS
+
+# states of a work item, done items wait for the coordinator to apply their result
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+APPLIED = 'applied'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS work (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    grp TEXT,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    UNIQUE (kind, key)
+);
+CREATE INDEX IF NOT EXISTS work_state ON work (state, kind);
+CREATE INDEX IF NOT EXISTS work_group ON work (grp);
+CREATE TABLE IF NOT EXISTS work_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# what workers may call on a served queue
+REMOTE_METHODS = ('claim', 'heartbeat', 'complete', 'fail', 'finished')
+
+
+class WorkItem(namedtuple('WorkItem', field_names=['id', 'kind', 'key', 'group', 'payload', 'attempts'])):
+    pass
+
+
+class WorkQueue(object):
+    """
+    The work items of a distributed run in a sqlite file, shared by the coordinator and its workers (directly, or
+    through a QueueServer). A claimed item is leased to its worker, which keeps the lease with heartbeats. Items whose
+    lease ran out, those of a dead worker, are claimed again by the others, up to max_attempts times.
+    """
+
+    def __init__(self, path, max_attempts=WORK_MAX_ATTEMPTS, busy_timeout=MANIFEST_BUSY_TIMEOUT):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.RLock()
+        # transactions are managed by hand, claims take the write lock up front
+        self._db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _read(self, query, params=()):
+        with self._lock:
+            return self._db.execute(query, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def publish(self, kind, key, payload, group=None):
+        """
+        Adds an item, unless one of the same kind and key was published before. Returns whether it was added
+        """
+        with self._transaction() as db:
+            cursor = db.execute('INSERT OR IGNORE INTO work (kind, key, grp, payload, state, updated_at) '
+                                'VALUES (?, ?, ?, ?, ?, ?)',
+                                (kind, key, group, json.dumps(payload), PENDING, time.time()))
+            return cursor.rowcount > 0
+
+    def claim(self, worker, kinds=KINDS, limit=1, lease=WORK_LEASE_SECONDS):
+        now = time.time()
+        kinds = list(kinds)
+        with self._transaction() as db:
+            expired = db.execute('UPDATE work SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, '
+                                 "error = 'lease expired', updated_at = ? WHERE state = ? AND lease_expires < ?",
+                                 (self.max_attempts, FAILED, PENDING, now, LEASED, now)).rowcount
+            rows = db.execute('SELECT id, kind, key, grp, payload, attempts FROM work WHERE state = ? '
+                              'AND kind IN ({}) ORDER BY id LIMIT ?'.format(', '.join('?' * len(kinds))),
+                              [PENDING] + kinds + [limit]).fetchall()
+            db.executemany('UPDATE work SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, '
+                           'updated_at = ? WHERE id = ?', [(LEASED, worker, now + lease, now, row[0]) for row in rows])
+
+        if expired:
+            logger.warning('{} leases ran out, their items are queued again'.format(expired))
+            metrics.increment('work_leases_expired_total', expired)
+        return [WorkItem(item_id, kind, key, group, json.loads(payload), attempts + 1)
+                for item_id, kind, key, group, payload, attempts in rows]
+
+    def heartbeat(self, worker, item_ids, lease=WORK_LEASE_SECONDS):
+        """
+        Extends the leases worker holds on item_ids, returns the ids it still holds
+        """
+        if not item_ids:
+            return []
+        placeholders = ', '.join('?' * len(item_ids))
+        with self._transaction() as db:
+            db.execute('UPDATE work SET lease_expires = ? WHERE worker = ? AND state = ? AND id IN ({})'.format(
+                placeholders), [time.time() + lease, worker, LEASED] + list(item_ids))
+            return [row[0] for row in db.execute('SELECT id FROM work WHERE worker = ? AND state = ? AND id IN ({})'
+                                                 .format(placeholders), [worker, LEASED] + list(item_ids))]
+
+    def complete(self, worker, item_id, result):
+        """
+        Stores the result of an item. Results of items leased to another worker in the meantime are still taken,
+        returns False when the item was already done
+        """
+        with self._transaction() as db:
+            return db.execute('UPDATE work SET state = ?, result = ?, worker = ?, lease_expires = NULL, '
+                              'updated_at = ? WHERE id = ? AND state IN (?, ?)',
+                              (DONE, json.dumps(result), worker, time.time(), item_id, PENDING, LEASED)).rowcount > 0
+
+    def fail(self, worker, item_id, error):
+        with self._transaction() as db:
+            db.execute('UPDATE work SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, '
+                       'lease_expires = NULL, error = ?, updated_at = ? WHERE id = ? AND worker = ? AND state = ?',
+                       (self.max_attempts, FAILED, PENDING, error, time.time(), item_id, worker, LEASED))
+
+    def results(self, limit=100):
+        """
+        Done items waiting to be applied, with their results
+        """
+        rows = self._read('SELECT id, kind, key, grp, payload, attempts, result FROM work WHERE state = ? '
+                          'ORDER BY updated_at LIMIT ?', (DONE, limit))
+        return [(WorkItem(*row[:4], payload=json.loads(row[4]), attempts=row[5]), json.loads(row[6]))
+                for row in rows]
+
+    def _set_state(self, item_id, state, error=None):
+        with self._transaction() as db:
+            db.execute('UPDATE work SET state = ?, error = ?, updated_at = ? WHERE id = ?',
+                       (state, error, time.time(), item_id))
+
+    def applied(self, item_id):
+        self._set_state(item_id, APPLIED)
+
+    def rejected(self, item_id, error):
+        self._set_state(item_id, FAILED, error)
+
+    def group_counts(self, group, kinds):
+        """
+        (items, items not applied or failed yet) of some kinds in group
+        """
+        kinds = list(kinds)
+        rows = self._read('SELECT COUNT(*), SUM(state NOT IN (?, ?)) FROM work WHERE grp = ? AND kind IN ({})'.format(
+            ', '.join('?' * len(kinds))), [APPLIED, FAILED, group] + kinds)
+        return rows[0][0], rows[0][1] or 0
+
+    def counts(self):
+        """
+        (kind, state) --> number of items
+        """
+        return {(kind, state): count for kind, state, count in
+                self._read('SELECT kind, state, COUNT(*) FROM work GROUP BY kind, state')}
+
+    def idle(self):
+        return not self._read('SELECT 1 FROM work WHERE state IN (?, ?, ?) LIMIT 1', (PENDING, LEASED, DONE))
+
+    def failures(self):
+        return self._read('SELECT kind, key, error FROM work WHERE state = ? ORDER BY id', (FAILED,))
+
+    def start(self):
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO work_meta (key, value) VALUES ('finished', '0')")
+
+    def finish(self):
+        """
+        Tells workers there is no more work coming
+        """
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO work_meta (key, value) VALUES ('finished', '1')")
+
+    def finished(self):
+        rows = self._read("SELECT value FROM work_meta WHERE key = 'finished'")
+        return bool(rows) and rows[0][0] == '1'
+
+
+class QueueServer(object):
+    """
+    Serves the worker side of a WorkQueue over http, for workers on nodes that can't open its file.
+    Requests are not authenticated, only serve it on a trusted network.
+    """
+
+    def __init__(self, queue, host='127.0.0.1', port=0):
+        self.queue = queue
+        self.host = host
+        self.port = port
+        self.url = None
+        self._loop = None
+        self._thread = None
+
+    @asyncio.coroutine
+    def handle(self, request):
+        from aiohttp import web
+
+        method = request.match_info['method']
+        if method not in REMOTE_METHODS:
+            raise web.HTTPNotFound()
+        kwargs = yield from request.json()
+        # sqlite blocks, the loop keeps answering other workers meanwhile
+        result = yield from self._loop.run_in_executor(None, functools.partial(getattr(self.queue, method), **kwargs))
+        return web.json_response({'result': result})
+
+    def _serve(self, ready):
+        from aiohttp import web
+
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_post('/{method}', self.handle)
+        handler = app.make_handler(loop=self._loop)
+        server = self._loop.run_until_complete(self._loop.create_server(handler, self.host, self.port))
+        self.url = 'http://{}:{}'.format(self.host, server.sockets[0].getsockname()[1])
+        ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            server.close()
+            self._loop.run_until_complete(server.wait_closed())
+            self._loop.run_until_complete(handler.shutdown(1))
+            self._loop.close()
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(ready,), daemon=True)
+        self._thread.start()
+        ready.wait()
+        logger.info('serving work items on {}'.format(self.url))
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+class RemoteQueue(object):
+    """
+    The worker side of a WorkQueue served by a QueueServer
+    """
+
+    def __init__(self, url, timeout=WORK_LEASE_SECONDS / 2):
+        import requests
+
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self._session = requests.Session()
+        # the session is shared with the heartbeat thread
+        self._lock = threading.Lock()
+
+    def _call(self, method, **kwargs):
+        with self._lock:
+            response = self._session.post('{}/{}'.format(self.url, method), json=kwargs, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['result']
+
+    def claim(self, worker, kinds=KINDS, limit=1, lease=WORK_LEASE_SECONDS):
+        return [WorkItem(*item) for item in self._call('claim', worker=worker, kinds=list(kinds), limit=limit,
+                                                       lease=lease)]
+
+    def heartbeat(self, worker, item_ids, lease=WORK_LEASE_SECONDS):
+        return self._call('heartbeat', worker=worker, item_ids=list(item_ids), lease=lease)
+
+    def complete(self, worker, item_id, result):
+        return self._call('complete', worker=worker, item_id=item_id, result=result)
+
+    def fail(self, worker, item_id, error):
+        return self._call('fail', worker=worker, item_id=item_id, error=error)
+
+    def finished(self):
+        return self._call('finished')
+
+
+def connect(spec):
+    """
+    The queue a worker takes its work from: a coordinator's url, or the path of its queue file
+    """
+    if spec.startswith(('http://', 'https://')):
+        return RemoteQueue(spec)
+    return WorkQueue(spec)
+
+
+def _relative(path, root):
+    return os.path.relpath(os.path.abspath(str(path)), os.path.abspath(root))
+
+
+class Coordinator(object):
+    """
+    Publishes the lessons of a run as work items, and applies the results workers send back: scraped lessons and
+    masterclasses, finished downloads and united videos all end up in the manifest, which only the coordinator
+    writes. Paths travel relative to output_dir, every node mounts the same output tree (possibly somewhere else).
+    downloads_for(lesson, department_path, masterclasses_db) returns a lesson's folder and (link, folder) pairs.
+    """
+
+    def __init__(self, queue, manifest, output_dir, downloads_for, fetch_masterclasses=False, unite=True,
+                 poll_interval=WORK_POLL_INTERVAL):
+        self.queue = queue
+        self.manifest = manifest
+        self.output_dir = output_dir
+        self.downloads_for = downloads_for
+        self.fetch_masterclasses = fetch_masterclasses
+        self.unite = unite
+        self.poll_interval = poll_interval
+
+    def _department(self, payload):
+        name = payload['department']
+        return (Path(self.output_dir).joinpath(payload['folder']), self.manifest.lessons(name),
+                self.manifest.masterclasses(name))
+
+    def add_lessons(self, department_name, department_path, lesson_ids):
+        """
+        Publishes the work of lessons of a department: scraping the ones not scraped yet, downloading the others
+        """
+        department = {'department': department_name, 'folder': _relative(department_path, self.output_dir)}
+        lessons_db = self.manifest.lessons(department_name)
+        for lesson_id in lesson_ids:
+            if lesson_id in lessons_db:
+                self._publish_lesson_work(department, lessons_db[lesson_id])
+            else:
+                self.queue.publish(LESSON, '{}/{}'.format(department_name, lesson_id),
+                                   dict(department, lesson_id=lesson_id))
+
+    def _publish_lesson_work(self, department, lesson):
+        department_path, _, masterclasses_db = self._department(department)
+        lesson_folder, downloads = self.downloads_for(lesson, department_path, masterclasses_db)
+        group = _relative(lesson_folder, self.output_dir)
+
+        if self.fetch_masterclasses:
+            for masterclass_id in lesson.masterclass_ids:
+                if masterclass_id not in masterclasses_db:
+                    self.queue.publish(MASTERCLASS, '{}/{}'.format(department['department'], masterclass_id),
+                                       dict(department, masterclass_id=masterclass_id, lesson_id=lesson.id,
+                                            lesson_name=lesson.name), group=group)
+
+        for link, folder in downloads:
+            folder = _relative(folder, self.output_dir)
+            self.queue.publish(DOWNLOAD, '{}|{}'.format(folder, link.link),
+                               {'folder': folder, 'name': link.name, 'url': link.link}, group=group)
+        self._unite_when_downloaded(group)
+
+    def _unite_when_downloaded(self, group):
+        if not self.unite:
+            return
+        total, remaining = self.queue.group_counts(group, (MASTERCLASS, DOWNLOAD))
+        if total and not remaining:
+            # keyed by the number of downloads, a lesson getting more of them (masterclasses scraped later)
+            # is united again
+            self.queue.publish(UNITE, '{}#{}'.format(group, total), {'folder': group}, group=group)
+
+    def _apply(self, item, result):
+        if item.kind == LESSON:
+            lesson = Lesson(result[0], result[1], [LessonLink(*link) for link in result[2]], result[3])
+            self._department(item.payload)[1][lesson.id] = lesson
+            self._publish_lesson_work(item.payload, lesson)
+        elif item.kind == MASTERCLASS:
+            masterclass = Masterclass(result[0], result[1], [LessonLink(*link) for link in result[2]])
+            _, lessons_db, masterclasses_db = self._department(item.payload)
+            masterclasses_db[masterclass.id] = masterclass
+            self._publish_lesson_work(item.payload, lessons_db[item.payload['lesson_id']])
+        elif item.kind == DOWNLOAD:
+            for download in result:
+                self.manifest.download_finished(os.path.join(self.output_dir, download['path']),
+                                                size=download['size'], url=download['url'],
+                                                sha256=download['sha256'], mtime=download['mtime'])
+        elif item.kind == UNITE:
+            for united in result:
+                self.manifest.parts_united([os.path.join(self.output_dir, path) for path in united['parts']],
+                                           os.path.join(self.output_dir, united['output']),
+                                           size=united['size'], mtime=united['mtime'])
+
+    def run(self):
+        """
+        Applies results until every item was applied (or failed), then tells the workers to stop
+        """
+        self.queue.start()
+        while True:
+            results = self.queue.results()
+            for item, result in results:
+                try:
+                    self._apply(item, result)
+                except Exception as e:
+                    logger.exception('could not apply {} {}'.format(item.kind, item.key))
+                    self.queue.rejected(item.id, str(e))
+                    continue
+                self.queue.applied(item.id)
+                metrics.increment('work_items_applied_total')
+                if item.group and item.kind in (MASTERCLASS, DOWNLOAD):
+                    self._unite_when_downloaded(item.group)
+
+            if not results:
+                if self.queue.idle():
+                    break
+                time.sleep(self.poll_interval)
+
+        self.manifest.flush()
+        self.queue.finish()
+        failures = self.queue.failures()
+        for kind, key, error in failures:
+            logger.error('{} {} failed: {}'.format(kind, key, error))
+        return failures
+
+
+class Heartbeat(object):
+    """
+    Keeps the leases of the items a worker holds, from a thread of its own so long downloads don't lose them
+    """
+
+    def __init__(self, queue, worker, lease=WORK_LEASE_SECONDS):
+        self.queue = queue
+        self.worker = worker
+        self.lease = lease
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def hold(self, items):
+        with self._lock:
+            self._held.update(item.id for item in items)
+
+    def release(self, items):
+        with self._lock:
+            self._held.difference_update(item.id for item in items)
+
+    def _run(self):
+        while not self._stop.wait(self.lease / 3):
+            with self._lock:
+                held = list(self._held)
+            if not held:
+                continue
+            try:
+                kept = self.queue.heartbeat(self.worker, held, self.lease)
+            except Exception as e:
+                logger.warning('heartbeat failed: {}'.format(e))
+                continue
+            lost = set(held) - set(kept)
+            if lost:
+                logger.warning('lost the leases of {} items, another worker may do them too'.format(len(lost)))
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class _UniteResults(object):
+    # stands in for the manifest of unite_ts_videos, united videos are reported to the coordinator instead
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.united = []
+
+    def parts_united(self, part_paths, output_path, size=None, mtime=None):
+        self.united.append({'parts': [_relative(path, self.output_dir) for path in part_paths],
+                            'output': _relative(output_path, self.output_dir), 'size': size, 'mtime': mtime})
+
+
+class Worker(object):
+    """
+    Claims work items of kinds and does them: lessons and masterclasses with scraper, the downloads of every claimed
+    batch with a fresh downloader from create_downloader() (which keeps the node's own manifest), and unites.
+    Stops once the coordinator is finished.
+    """
+
+    def __init__(self, queue, worker_id, output_dir, create_downloader=None, scraper=None, kinds=KINDS,
+                 batch=WORK_CLAIM_BATCH, lease=WORK_LEASE_SECONDS, poll_interval=WORK_POLL_INTERVAL,
+                 unite_workers=None, fast_concat=True):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.output_dir = output_dir
+        self.create_downloader = create_downloader
+        self.scraper = scraper
+        self.kinds = kinds
+        self.batch = batch
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.unite_workers = unite_workers
+        self.fast_concat = fast_concat
+
+    def run(self):
+        heartbeat = Heartbeat(self.queue, self.worker_id, self.lease).start()
+        unreachable = 0
+        try:
+            while True:
+                try:
+                    items = self.queue.claim(self.worker_id, self.kinds, limit=self.batch, lease=self.lease)
+                    if not items and self.queue.finished():
+                        break
+                    if items:
+                        heartbeat.hold(items)
+                        try:
+                            self._work(items)
+                        finally:
+                            heartbeat.release(items)
+                except OSError as e:
+                    # a served queue's connection errors, items whose results were lost are leased again
+                    unreachable += 1
+                    if unreachable > WORK_UNREACHABLE_RETRIES:
+                        logger.error('the coordinator is gone, {} stops'.format(self.worker_id))
+                        raise
+                    logger.warning('could not reach the coordinator ({}), trying again'.format(e))
+                    items = None
+                else:
+                    unreachable = 0
+                if not items:
+                    time.sleep(self.poll_interval)
+        finally:
+            heartbeat.stop()
+
+    def _complete(self, item, result):
+        if not self.queue.complete(self.worker_id, item.id, result):
+            logger.info('{} {} was already done by another worker'.format(item.kind, item.key))
+        metrics.increment('work_items_done_total')
+
+    def _fail(self, item, error):
+        logger.error('{} {} failed: {}'.format(item.kind, item.key, error))
+        self.queue.fail(self.worker_id, item.id, str(error))
+        metrics.increment('work_items_failed_total')
+
+    def _work(self, items):
+        downloads = [item for item in items if item.kind == DOWNLOAD]
+        if downloads:
+            self._download(downloads)
+
+        for item in items:
+            if item.kind == DOWNLOAD:
+                continue
+            try:
+                if item.kind == LESSON:
+                    result = self.scraper.get_lesson_by_id(item.payload['lesson_id'])
+                elif item.kind == MASTERCLASS:
+                    result = self.scraper.get_masterclass_by_id(item.payload['masterclass_id'],
+                                                                lesson_name=item.payload['lesson_name'])
+                else:
+                    result = self._unite(item.payload['folder'])
+            except Exception as e:
+                logger.exception(e)
+                self._fail(item, e)
+                continue
+            self._complete(item, result)
+
+    def _download(self, items):
+        downloader = self.create_downloader()
+        links = [(LessonLink(item.payload['name'], item.payload['url']),
+                  os.path.join(self.output_dir, item.payload['folder'])) for item in items]
+        tasks = [downloader.download_link(link, folder) for link, folder in links]
+        downloader.run()
+
+        for item, (link, folder), task in zip(items, links, tasks):
+            if task is not None and (task.cancelled() or task.exception() is not None):
+                self._fail(item, 'cancelled' if task.cancelled() else task.exception())
+                continue
+
+            # the file itself or the parts of a playlist, as the download reports them. nothing to download when
+            # the file was already there
+            paths = task.result() if task is not None else [downloader.link_path(link, folder)[0]]
+            self._complete(item, [dict(download, path=_relative(download['path'], self.output_dir))
+                                  for download in downloader.manifest.finished_downloads(paths)])
+
+    def _unite(self, folder):
+        from .unite import unite_ts_videos
+
+        results = _UniteResults(self.output_dir)
+        unite_ts_videos(os.path.join(self.output_dir, folder), workers=self.unite_workers,
+                        fast_concat=self.fast_concat, manifest=results)
+        return results.united
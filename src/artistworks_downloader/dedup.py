@@ -0,0 +1,103 @@
+from __future__ import unicode_literals, absolute_import
+
+from collections import Counter
+import contextlib
+import os
+import shutil
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+
+from .constants import VOLATILE_URL_PARAMETERS
+
+# linux FICLONE ioctl, shares the extents of a file on btrfs, xfs and other copy on write filesystems
+FICLONE = 0x40049409
+
+# ways a file is materialized from another one
+REFLINK = 'reflink'
+HARDLINK = 'hardlink'
+COPY = 'copy'
+
+# why a file was found to be a duplicate
+BY_URL = 'url'
+BY_HASH = 'hash'
+
+
+def normalize_url(url):
+    """
+    The same asset under another url spelling (host case, default port, fragment, query order or
+    expiring signature parameters) normalizes to the same string
+    """
+    parts = urlsplit(url)
+    netloc = parts.hostname or ''
+    default_port = {'http': 80, 'https': 443}.get(parts.scheme.lower())
+    if parts.port and parts.port != default_port:
+        netloc += ':{}'.format(parts.port)
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if key.lower() not in VOLATILE_URL_PARAMETERS)
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path or '/', urlencode(query), ''))
+
+
+def _reflink(source, target):
+    if fcntl is None:
+        raise OSError('reflinks are not supported here')
+    with open(source, 'rb') as s, open(target, 'wb') as t:
+        fcntl.ioctl(t.fileno(), FICLONE, s.fileno())
+
+
+def link_file(source, target):
+    """
+    Makes target a copy of source, sharing its data when the filesystem allows it: a reflink, else a hardlink,
+    else a plain copy. target is replaced atomically, returns the method used
+    """
+    tmp_path = target + '.link'
+    with contextlib.suppress(OSError):
+        os.remove(tmp_path)
+
+    try:
+        _reflink(source, tmp_path)
+        method = REFLINK
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        try:
+            os.link(source, tmp_path)
+            method = HARDLINK
+        except OSError:
+            # another filesystem, or one without links
+            shutil.copyfile(source, tmp_path)
+            method = COPY
+
+    os.replace(tmp_path, target)
+    return method
+
+
+class DedupStats(object):
+    def __init__(self):
+        self.files = Counter()
+        self.methods = Counter()
+        # bytes not downloaded (duplicate urls), and bytes not stored twice (anything but a copy)
+        self.bytes_not_downloaded = 0
+        self.bytes_not_stored = 0
+
+    def record(self, reason, method, size):
+        self.files[reason] += 1
+        self.methods[method] += 1
+        if reason == BY_URL:
+            self.bytes_not_downloaded += size
+        if method != COPY:
+            self.bytes_not_stored += size
+
+    def __bool__(self):
+        return bool(self.files)
+
+    def __str__(self):
+        return ('Deduplicated {} files ({} by url, {} by content): {} reflinks, {} hardlinks, {} copies, '
+                '{:.1f} MB not downloaded, {:.1f} MB not stored twice').format(
+            sum(self.files.values()), self.files[BY_URL], self.files[BY_HASH], self.methods[REFLINK],
+            self.methods[HARDLINK], self.methods[COPY], self.bytes_not_downloaded / 2 ** 20,
+            self.bytes_not_stored / 2 ** 20)
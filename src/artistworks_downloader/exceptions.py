@@ -1,2 +1,10 @@
 class NoElementsException(Exception):
     pass
+
+
+class PageParseException(Exception):
+    pass
+
+
+class DiskBudgetException(Exception):
+    pass
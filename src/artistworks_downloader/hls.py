@@ -0,0 +1,201 @@
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+from collections import OrderedDict
+import os
+import subprocess
+import time
+
+import logbook
+import m3u8
+
+from .constants import PLAYLIST_CACHE_SIZE, PLAYLIST_CACHE_TTL, MAX_RESOLUTION, MAX_BANDWIDTH
+from .metrics import metrics
+from .writer import open_for_positioned_writes
+
+logger = logbook.Logger(__name__)
+
+
+def _resolution(playlist):
+    return playlist.stream_info.resolution or (0, 0)
+
+
+def select_rendition(master, policy=MAX_RESOLUTION, max_height=None):
+    """
+    Picks the rendition with the most pixels (or the highest bandwidth) out of those no taller than max_height
+    """
+    renditions = master.playlists
+    if max_height:
+        # when nothing is small enough, settle for the smallest one
+        renditions = ([p for p in renditions if _resolution(p)[1] <= max_height] or
+                      [min(renditions, key=lambda p: _resolution(p)[1])])
+
+    def pixels(playlist):
+        width, height = _resolution(playlist)
+        return width * height
+
+    if policy == MAX_BANDWIDTH:
+        return max(renditions, key=lambda p: (p.stream_info.bandwidth or 0, pixels(p)))
+    return max(renditions, key=lambda p: (pixels(p), p.stream_info.bandwidth or 0))
+
+
+def parse_playlist(content, url):
+    return m3u8.M3U8(content, base_uri=url.rsplit('/', 1)[0] + '/')
+
+
+class TTLCache(object):
+    """
+    Least recently used cache of at most size items, each expiring ttl seconds after it was put
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+
+class PlaylistResolver(object):
+    """
+    Resolves HLS playlists into the urls of their segments, through the rendition chosen by the policy when given
+    a master playlist. fetch is a coroutine returning the text of a playlist url.
+    Results are cached for ttl seconds, in memory and in the manifest (to be reused by the next runs), and
+    concurrent lookups of the same playlist share a single resolution.
+    """
+
+    def __init__(self, fetch, loop, policy=MAX_RESOLUTION, max_height=None, size=PLAYLIST_CACHE_SIZE,
+                 ttl=PLAYLIST_CACHE_TTL, manifest=None):
+        self.fetch = fetch
+        self.loop = loop
+        self.policy = policy
+        self.max_height = max_height
+        self.ttl = ttl
+        self.manifest = manifest
+        self.cache = TTLCache(size, ttl)
+        self._resolving = {}
+
+    def _key(self, url):
+        # the same master playlist resolves differently under another policy
+        return '{} {} {}'.format(url, self.policy, self.max_height or '')
+
+    @asyncio.coroutine
+    def _load(self, url):
+        return parse_playlist((yield from self.fetch(url)), url)
+
+    @asyncio.coroutine
+    def _resolve(self, url, key):
+        with metrics.timed('playlist_resolve_seconds'):
+            playlist = yield from self._load(url)
+            if playlist.is_variant:
+                playlist = yield from self._load(select_rendition(playlist, self.policy, self.max_height).absolute_uri)
+        segments = [segment.absolute_uri for segment in playlist.segments]
+        logger.info('resolved playlist {} into {} segments'.format(url, len(segments)))
+
+        self.cache.put(key, segments)
+        if self.manifest:
+            self.manifest.cache_playlist(key, segments)
+        return segments
+
+    @asyncio.coroutine
+    def resolve(self, url):
+        key = self._key(url)
+        segments = self.cache.get(key)
+        if segments is None and self.manifest:
+            segments = self.manifest.cached_playlist(key, self.ttl)
+            if segments is not None:
+                self.cache.put(key, segments)
+        if segments is not None:
+            metrics.increment('playlist_cache_hits_total')
+            return list(segments)
+
+        metrics.increment('playlist_cache_misses_total')
+        if key not in self._resolving:
+            task = asyncio.Task(self._resolve(url, key), loop=self.loop)
+            task.add_done_callback(lambda _: self._resolving.pop(key, None))
+            self._resolving[key] = task
+        # a cancelled caller shouldn't cancel the resolution the others are waiting for
+        return list((yield from asyncio.shield(self._resolving[key])))
+
+
+class TsSink(object):
+    """
+    Appends segments, in order, to a single transport stream file
+    """
+
+    def __init__(self, path, writer_factory):
+        self.path = path
+        self.fd = open_for_positioned_writes(path, truncate=True)
+        self.writer = writer_factory(self.fd)
+        self.offset = 0
+
+    @asyncio.coroutine
+    def write(self, data):
+        yield from self.writer.write(data, self.offset)
+        self.offset += len(data)
+
+    @asyncio.coroutine
+    def close(self):
+        try:
+            yield from self.writer.close()
+        finally:
+            os.close(self.fd)
+
+    @asyncio.coroutine
+    def abort(self):
+        yield from self.close()
+
+
+class FfmpegSink(object):
+    """
+    Pipes segments, in order, into ffmpeg which remuxes them into an mp4 without re-encoding
+    """
+
+    def __init__(self, path, loop):
+        self.path = path
+        self.loop = loop
+        self.process = None
+
+    @asyncio.coroutine
+    def _start(self):
+        self.process = yield from asyncio.create_subprocess_exec(
+            'ffmpeg', '-y', '-loglevel', 'error', '-f', 'mpegts', '-i', 'pipe:0', '-bsf:a', 'aac_adtstoasc',
+            '-c', 'copy', '-f', 'mp4', self.path,
+            stdin=subprocess.PIPE, loop=self.loop)
+
+    @asyncio.coroutine
+    def write(self, data):
+        if self.process is None:
+            yield from self._start()
+        self.process.stdin.write(data)
+        yield from self.process.stdin.drain()
+
+    @asyncio.coroutine
+    def close(self):
+        if self.process is None:
+            yield from self._start()
+        self.process.stdin.close()
+        returncode = yield from self.process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, 'ffmpeg')
+
+    @asyncio.coroutine
+    def abort(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            yield from self.process.wait()
@@ -0,0 +1,291 @@
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import re
+
+import aiohttp
+import logbook
+from bs4 import BeautifulSoup
+
+from .constants import ARTISTWORKS_LESSON_BASE, ARTISTWORKS_DEPARTMENT_BASE, ARTISTWORKS_MASTERCLASS_BASE, \
+    HTTP_SCRAPE_CONCURRENCY
+from .exceptions import PageParseException
+from .http_session import create_session
+from .metrics import metrics
+from .webdriver import ArtistWorkScraper, Lesson, Masterclass, parse_page_title, parse_masterclass_ids, \
+    parse_pdf_links, parse_department_lessons
+
+logger = logbook.Logger(__name__)
+
+JWPLAYER_SETUP_RE = re.compile(r'jwplayer\([^)]*\)\s*\.setup\(\s*(\{.*?\})\s*\)\s*;', re.S)
+JWPLAYER_FILE_RE = re.compile(r'[\'"]?file[\'"]?\s*:\s*[\'"]([^\'"]+)[\'"]')
+JWPLAYER_TITLE_RE = re.compile(r'[\'"]?title[\'"]?\s*:\s*[\'"]([^\'"]*)[\'"]')
+JWPLAYER_KIND_RE = re.compile(r'[\'"]?kind[\'"]?\s*:')
+NESTED_OBJECT_RE = re.compile(r'\{[^{}]*\}')
+
+
+def _enclosing_object(text, position):
+    """
+    Returns (start, end) of the object literal directly containing position, or None at the top level
+    """
+    depth = 0
+    for start in range(position, -1, -1):
+        if text[start] == '}':
+            depth += 1
+        elif text[start] == '{':
+            if depth == 0:
+                break
+            depth -= 1
+    else:
+        return None
+
+    depth = 0
+    for end in range(start, len(text)):
+        if text[end] == '{':
+            depth += 1
+        elif text[end] == '}':
+            depth -= 1
+            if depth == 0:
+                return start, end + 1
+    return None
+
+
+def _top_level(text):
+    inner = text[1:-1]
+    while NESTED_OBJECT_RE.search(inner):
+        inner = NESTED_OBJECT_RE.sub('', inner)
+    return inner
+
+
+def parse_jwplayer_setup(content):
+    """
+    Returns (title, file) for every playlist item found in the jwplayer setup calls of a page,
+    captions/thumbnail tracks are ignored.
+    """
+    videos = []
+    for setup in JWPLAYER_SETUP_RE.findall(content):
+        for match in JWPLAYER_FILE_RE.finditer(setup):
+            bounds = _enclosing_object(setup, match.start())
+            if bounds is None:
+                continue
+            item = _top_level(setup[bounds[0]:bounds[1]])
+            if JWPLAYER_KIND_RE.search(item):
+                continue
+
+            title = JWPLAYER_TITLE_RE.search(item)
+            parent = _enclosing_object(setup, bounds[0] - 1) if bounds[0] else None
+            if not title and parent is not None and parent != (0, len(setup)):
+                # files listed under an item's sources, the title belongs to the item itself
+                title = JWPLAYER_TITLE_RE.search(_top_level(setup[parent[0]:parent[1]]))
+
+            video = (title.group(1) if title else '', match.group(1))
+            if video not in videos:
+                videos.append(video)
+    return videos
+
+
+class HttpScraper(object):
+    """
+    Scrapes lesson, masterclass and department pages without a browser, using the cookies of a logged in
+    ArtistWorkScraper. Pages that can't be parsed are handed back to that scraper, one at a time.
+    """
+
+    def __init__(self, fallback, concurrency=HTTP_SCRAPE_CONCURRENCY, fetch_extras=False,
+                 loop=asyncio.get_event_loop()):
+        self.loop = loop
+        self.fallback = fallback
+        self.fetch_extras = fetch_extras
+        self.sem = asyncio.Semaphore(concurrency)
+        self.session = create_session(self.loop, cookies=fallback.get_session_cookies(), limit_per_host=concurrency)
+
+        # selenium drivers are not thread safe, fallbacks are serialized on a single thread
+        self._browser = ThreadPoolExecutor(max_workers=1)
+        self._department_pages = {}
+
+    @asyncio.coroutine
+    def _request(self, url, headers=None):
+        with (yield from self.sem), metrics.timed('scrape_page_seconds'):
+            response = yield from self.session.get(url, headers=headers)
+            try:
+                if response.status not in (200, 304):
+                    raise PageParseException('got status {} for {}'.format(response.status, url))
+                if 'awentry' in str(response.url):
+                    raise PageParseException('redirected to login page from {}'.format(url))
+                content = None
+                if response.status == 200:
+                    content = yield from response.text()
+                return response.status, response.headers, content
+            finally:
+                response.release()
+
+    @asyncio.coroutine
+    def _get_page(self, url):
+        _, _, content = yield from self._request(url)
+        return BeautifulSoup(content), content
+
+    @asyncio.coroutine
+    def get_page_if_modified(self, url, etag=None, last_modified=None):
+        """
+        Conditional GET, returns None when the page didn't change since it was served with these validators,
+        (soup, content, etag, last_modified) otherwise
+        """
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        status, response_headers, content = yield from self._request(url, headers=headers)
+        if status == 304:
+            return None
+        return BeautifulSoup(content), content, response_headers.get('ETag'), response_headers.get('Last-Modified')
+
+    @asyncio.coroutine
+    def _with_fallback(self, description, page_coroutine, fallback, *args):
+        try:
+            return (yield from page_coroutine)
+        except (PageParseException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning('could not scrape {} over http ({}), falling back to the browser'.format(description, e))
+            return (yield from self.loop.run_in_executor(self._browser, fallback, *args))
+
+    @staticmethod
+    def _links_for_videos(name, videos):
+        links = []
+        for title, link in videos:
+            links.extend(ArtistWorkScraper.links_for_video(title or name, link))
+        return links
+
+    @asyncio.coroutine
+    def _get_lesson_by_id(self, lesson_id):
+        logger.info('grabbing info for lesson {} over http'.format(lesson_id))
+        soup, content = yield from self._get_page(ARTISTWORKS_LESSON_BASE + str(lesson_id))
+        return (yield from self.lesson_from_page(lesson_id, soup, content))
+
+    @asyncio.coroutine
+    def lesson_from_page(self, lesson_id, soup, content):
+        lesson_name = parse_page_title(soup)
+        videos = parse_jwplayer_setup(content)
+        if not lesson_name or not videos:
+            raise PageParseException('no title or player setup found for lesson {}'.format(lesson_id))
+
+        lesson_links = self._links_for_videos(lesson_name, videos)
+
+        if self.fetch_extras:
+            lesson_links.extend(parse_pdf_links(soup))
+
+        return Lesson(lesson_id, lesson_name, lesson_links, parse_masterclass_ids(soup))
+
+    @asyncio.coroutine
+    def _get_masterclass_by_id(self, masterclass_id, lesson_name=None):
+        logger.info('grabbing info for masterclass {} over http'.format(masterclass_id))
+        soup, content = yield from self._get_page(ARTISTWORKS_MASTERCLASS_BASE + str(masterclass_id))
+        masterclass_name = parse_page_title(soup)
+        videos = parse_jwplayer_setup(content)
+        if not masterclass_name or not videos:
+            raise PageParseException('no title or player setup found for masterclass {}'.format(masterclass_id))
+
+        if masterclass_name == lesson_name and videos[0][0]:
+            masterclass_name = videos[0][0]  # students question name is the masterclass name
+
+        if len(videos) < 2:
+            logger.debug('Found masterclass without artists response, not downloading!')
+            return Masterclass(masterclass_id, masterclass_name, [])
+
+        lesson_links = self._links_for_videos(masterclass_name, videos)
+        return Masterclass(masterclass_id, masterclass_name, lesson_links)
+
+    @asyncio.coroutine
+    def get_lesson_by_id(self, lesson_id):
+        with metrics.timed('scrape_lesson_seconds'):
+            return (yield from self._with_fallback('lesson {}'.format(lesson_id),
+                                                   self._get_lesson_by_id(lesson_id),
+                                                   self.fallback.get_lesson_by_id, lesson_id))
+
+    @asyncio.coroutine
+    def get_masterclass_by_id(self, masterclass_id, lesson_name=None):
+        with metrics.timed('scrape_masterclass_seconds'):
+            return (yield from self._with_fallback('masterclass {}'.format(masterclass_id),
+                                                   self._get_masterclass_by_id(masterclass_id, lesson_name),
+                                                   self.fallback.get_masterclass_by_id, masterclass_id, lesson_name))
+
+    @asyncio.coroutine
+    def _get_department_page(self, department_id):
+        if department_id not in self._department_pages:
+            soup, _ = yield from self._get_page(ARTISTWORKS_DEPARTMENT_BASE + str(department_id))
+            self._department_pages[department_id] = soup
+        return self._department_pages[department_id]
+
+    @asyncio.coroutine
+    def _get_department_name(self, department_id):
+        department_name = parse_page_title((yield from self._get_department_page(department_id)))
+        if not department_name:
+            raise PageParseException('no title found for department {}'.format(department_id))
+        return department_name
+
+    @asyncio.coroutine
+    def _get_all_lesson_ids_for_department(self, department_id):
+        soup = yield from self._get_department_page(department_id)
+        if soup.find('div', id='media-group-table') is None:
+            raise PageParseException('no lessons table found for department {}'.format(department_id))
+        lessons = parse_department_lessons(soup)
+        if not lessons:
+            # the table is sometimes only filled in by javascript
+            raise PageParseException('empty lessons table for department {}'.format(department_id))
+        return lessons
+
+    def get_department_name(self, department_id):
+        return self.loop.run_until_complete(
+            self._with_fallback('department {}'.format(department_id),
+                                self._get_department_name(department_id),
+                                self.fallback.get_department_name, department_id))
+
+    def get_all_lesson_ids_for_department(self, department_id):
+        logger.info('grabbing all links for department {} over http'.format(department_id))
+        return self.loop.run_until_complete(
+            self._with_fallback('department {}'.format(department_id),
+                                self._get_all_lesson_ids_for_department(department_id),
+                                self.fallback.get_all_lesson_ids_for_department, department_id))
+
+    @asyncio.coroutine
+    def _scrape(self, lesson_ids, lessons_db, masterclasses_db, fetch_masterclasses):
+        seen_masterclasses = set()
+
+        @asyncio.coroutine
+        def scrape_masterclass(masterclass_id, lesson_name):
+            try:
+                masterclasses_db[masterclass_id] = yield from self.get_masterclass_by_id(masterclass_id, lesson_name)
+            except Exception as e:
+                logger.exception(e)
+                logger.error('failed to scrape masterclass {}'.format(masterclass_id))
+
+        @asyncio.coroutine
+        def scrape_lesson(lesson_id):
+            if lesson_id not in lessons_db:
+                try:
+                    lessons_db[lesson_id] = yield from self.get_lesson_by_id(lesson_id)
+                except Exception as e:
+                    logger.exception(e)
+                    logger.error('failed to scrape lesson {}'.format(lesson_id))
+                    return
+
+            if fetch_masterclasses:
+                lesson = lessons_db[lesson_id]
+                masterclass_ids = [masterclass_id for masterclass_id in lesson.masterclass_ids
+                                   if masterclass_id not in masterclasses_db
+                                   and masterclass_id not in seen_masterclasses]
+                seen_masterclasses.update(masterclass_ids)
+                if masterclass_ids:
+                    yield from asyncio.wait([scrape_masterclass(masterclass_id, lesson.name)
+                                             for masterclass_id in masterclass_ids])
+
+        lesson_ids = list(lesson_ids)
+        if lesson_ids:
+            yield from asyncio.wait([scrape_lesson(lesson_id) for lesson_id in lesson_ids])
+
+    def scrape(self, lesson_ids, lessons_db, masterclasses_db, fetch_masterclasses=False):
+        self.loop.run_until_complete(self._scrape(lesson_ids, lessons_db, masterclasses_db, fetch_masterclasses))
+
+    def close(self):
+        self.loop.run_until_complete(self.session.close())
+        self._browser.shutdown()
@@ -0,0 +1,46 @@
+from __future__ import unicode_literals, absolute_import
+
+from http.cookies import SimpleCookie
+
+import aiohttp
+
+from .constants import HTTP_CONNECTION_LIMIT, HTTP_CONNECTION_LIMIT_PER_HOST, HTTP_KEEPALIVE_TIMEOUT, \
+    HTTP_DNS_CACHE_TTL, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+
+
+def selenium_cookies_to_jar(cookies):
+    """
+    Converts cookies as returned by selenium's driver.get_cookies() into a SimpleCookie aiohttp can load,
+    keeping their domain and path so they are only sent where the browser would send them.
+    """
+    jar = SimpleCookie()
+    for cookie in cookies:
+        jar[cookie['name']] = cookie['value']
+        morsel = jar[cookie['name']]
+        morsel['domain'] = cookie.get('domain', '')
+        morsel['path'] = cookie.get('path', '/')
+        if cookie.get('secure'):
+            morsel['secure'] = True
+    return jar
+
+
+def create_session(loop, cookies=None, limit=HTTP_CONNECTION_LIMIT, limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+                   keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                   read_timeout=HTTP_READ_TIMEOUT):
+    """
+    A long lived session, meant to be shared by every request of a run so connections (and their TLS handshakes)
+    are reused between files and HLS segments.
+    """
+    connector = aiohttp.TCPConnector(loop=loop,
+                                     limit=limit,
+                                     limit_per_host=limit_per_host,
+                                     keepalive_timeout=keepalive_timeout,
+                                     use_dns_cache=True,
+                                     ttl_dns_cache=HTTP_DNS_CACHE_TTL)
+    session = aiohttp.ClientSession(loop=loop,
+                                    connector=connector,
+                                    conn_timeout=connect_timeout,
+                                    read_timeout=read_timeout)
+    if cookies:
+        session.cookie_jar.update_cookies(selenium_cookies_to_jar(cookies))
+    return session
@@ -0,0 +1,151 @@
+from __future__ import unicode_literals, absolute_import
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+
+import logbook
+
+from .constants import HASH_BLOCK_SIZE
+
+logger = logbook.Logger(__name__)
+
+# verification results
+UNCHANGED = 'unchanged'
+VERIFIED = 'verified'
+CORRUPT = 'corrupt'
+MISSING = 'missing'
+
+
+class ContentHash(object):
+    """
+    sha256 of the sha256 digests of every block_size block of a file. Blocks are hashed independently, so byte
+    ranges streaming concurrently (each starting on a block boundary) are hashed as they arrive, and a resumed
+    download only reads back the blocks it didn't see whole. blocks maps block index --> hex digest.
+    """
+
+    def __init__(self, block_size=HASH_BLOCK_SIZE, blocks=None):
+        self.block_size = block_size
+        self.blocks = blocks if blocks is not None else {}
+        # block index --> (hash object, bytes hashed), blocks fed from their start and not complete yet
+        self._open = {}
+
+    def update(self, offset, data):
+        """
+        Hashes data written at offset. Data of a block has to arrive in order, a block joined halfway is
+        left to finish(), which reads it from the file
+        """
+        view = memoryview(data)
+        while view:
+            index, within = divmod(offset, self.block_size)
+            size = min(len(view), self.block_size - within)
+            block = self._open.pop(index, None)
+            if block is None and within == 0 and index not in self.blocks:
+                block = (hashlib.sha256(), 0)
+
+            if block is not None and block[1] == within:
+                block[0].update(view[:size])
+                if within + size == self.block_size:
+                    self.blocks[index] = block[0].hexdigest()
+                else:
+                    self._open[index] = (block[0], within + size)
+
+            offset += size
+            view = view[size:]
+
+    def retain(self, ranges):
+        """
+        Forgets the blocks not entirely within the (start, end) byte ranges known to be on disk
+        """
+        for index in list(self.blocks):
+            start, end = index * self.block_size, (index + 1) * self.block_size
+            if not any(range_start <= start and end <= range_end for range_start, range_end in ranges):
+                del self.blocks[index]
+
+    def finish(self, path, length):
+        """
+        The digest of the complete file at path, of length bytes
+        """
+        count = -(-length // self.block_size)
+        for index, (block, hashed) in list(self._open.items()):
+            # the last block is shorter than the others
+            if index == count - 1 and hashed == length - index * self.block_size:
+                self.blocks[index] = block.hexdigest()
+        self._open = {}
+
+        missing = [index for index in range(count) if index not in self.blocks]
+        if missing:
+            logger.debug('reading {} blocks of {} back for its hash'.format(len(missing), path))
+            with open(path, 'rb') as f:
+                for index in missing:
+                    f.seek(index * self.block_size)
+                    self.blocks[index] = hashlib.sha256(f.read(self.block_size)).hexdigest()
+
+        digest = hashlib.sha256()
+        for index in range(count):
+            digest.update(bytes.fromhex(self.blocks[index]))
+        return digest.hexdigest()
+
+
+def hash_file(path, block_size=HASH_BLOCK_SIZE):
+    return ContentHash(block_size).finish(path, os.path.getsize(path))
+
+
+class VerifySummary(object):
+    def __init__(self):
+        self.results = {UNCHANGED: [], VERIFIED: [], CORRUPT: [], MISSING: []}
+
+    @property
+    def damaged(self):
+        return self.results[CORRUPT] + self.results[MISSING]
+
+    def __str__(self):
+        lines = ['Verified {} files: {} unchanged, {} verified, {} corrupt, {} missing'.format(
+            sum(map(len, self.results.values())), len(self.results[UNCHANGED]), len(self.results[VERIFIED]),
+            len(self.results[CORRUPT]), len(self.results[MISSING]))]
+        for state in (CORRUPT, MISSING):
+            for download in self.results[state]:
+                lines.append('  {} {}'.format(state, download['path']))
+        return '\r\n'.join(lines)
+
+
+def check_download(download, full=False):
+    """
+    Checks a finished download (a row of Manifest.finished_downloads) against its file.
+    Returns (result, sha256, mtime), files whose size and mtime didn't change since they were recorded are only
+    hashed again when full is set
+    """
+    try:
+        stat = os.stat(download['path'])
+    except OSError:
+        return MISSING, None, None
+
+    if download['size'] is not None and stat.st_size != download['size']:
+        return CORRUPT, None, stat.st_mtime
+    if not full and download['sha256'] and download['mtime'] == stat.st_mtime:
+        return UNCHANGED, download['sha256'], stat.st_mtime
+
+    sha256 = hash_file(download['path'])
+    if download['sha256'] and sha256 != download['sha256']:
+        return CORRUPT, sha256, stat.st_mtime
+    return VERIFIED, sha256, stat.st_mtime
+
+
+def verify_downloads(manifest, workers=None, full=False):
+    """
+    Checks every finished download of the manifest on workers threads (hashing releases the GIL).
+    Verified files get their hash and mtime recorded, damaged ones are marked corrupt so they are downloaded again.
+    """
+    downloads = manifest.finished_downloads()
+    summary = VerifySummary()
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        results = pool.map(lambda download: check_download(download, full), downloads)
+        for download, (result, sha256, mtime) in zip(downloads, results):
+            summary.results[result].append(download)
+            if result == VERIFIED:
+                manifest.download_verified(download['path'], sha256, mtime)
+            elif result in (CORRUPT, MISSING):
+                logger.warning('{} is {}'.format(download['path'], result))
+                manifest.download_corrupt(download['path'], result)
+    manifest.flush()
+    return summary
@@ -0,0 +1,21 @@
+from __future__ import unicode_literals, absolute_import
+
+import logbook
+
+from .constants import LOG_PATH
+
+_handlers = None
+
+
+def setup_logging(log_path=LOG_PATH):
+    """
+    Sends the records of every module to the log file and to stderr. Only the first call sets them up, modules only
+    create their loggers, so importing them stays cheap and the log file is opened by its first record.
+    """
+    global _handlers
+    if _handlers is None:
+        # the file handler is pushed last, it sees records first and bubbles them up to stderr
+        _handlers = logbook.NestedSetup([logbook.StderrHandler(),
+                                         logbook.FileHandler(log_path, bubble=True, level=logbook.DEBUG, delay=True)])
+        _handlers.push_application()
+    return _handlers
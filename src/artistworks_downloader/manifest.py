@@ -0,0 +1,507 @@
+from __future__ import unicode_literals, absolute_import
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import contextlib
+import dbm
+import functools
+import json
+import os
+import re
+import shelve
+import sqlite3
+import threading
+import time
+
+import logbook
+
+from .constants import MANIFEST_BATCH_SIZE, MANIFEST_COMMIT_INTERVAL, MANIFEST_BUSY_TIMEOUT
+from .dedup import normalize_url
+from .models import Lesson, Masterclass, LessonLink
+
+logger = logbook.Logger(__name__)
+
+LESSON = 'lesson'
+MASTERCLASS = 'masterclass'
+
+# download states
+DOWNLOADING = 'downloading'
+DONE = 'done'
+FAILED = 'failed'
+UNITED = 'united'
+CORRUPT = 'corrupt'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS departments (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    number INTEGER,
+    root_folder TEXT
+);
+CREATE TABLE IF NOT EXISTS department_lessons (
+    department_id INTEGER NOT NULL REFERENCES departments(id),
+    lesson_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (department_id, lesson_id)
+);
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    key TEXT PRIMARY KEY,
+    segments TEXT NOT NULL,
+    resolved_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lessons (
+    department_id INTEGER NOT NULL REFERENCES departments(id),
+    id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    masterclass_ids TEXT NOT NULL,
+    scraped_at REAL NOT NULL,
+    PRIMARY KEY (department_id, id)
+);
+CREATE TABLE IF NOT EXISTS masterclasses (
+    department_id INTEGER NOT NULL REFERENCES departments(id),
+    id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    scraped_at REAL NOT NULL,
+    PRIMARY KEY (department_id, id)
+);
+CREATE TABLE IF NOT EXISTS links (
+    department_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    owner_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    PRIMARY KEY (department_id, kind, owner_id, position)
+);
+CREATE TABLE IF NOT EXISTS downloads (
+    path TEXT PRIMARY KEY,
+    url TEXT,
+    source TEXT,
+    size INTEGER,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    sha256 TEXT,
+    mtime REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS downloads_status ON downloads (status);
+"""
+
+# run once the columns they use exist
+INDEXES = """
+CREATE INDEX IF NOT EXISTS downloads_source ON downloads (source);
+CREATE INDEX IF NOT EXISTS downloads_sha256 ON downloads (sha256);
+"""
+
+TABLE_RE = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE)\s+(\w+)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=None)
+def _tables(query):
+    """
+    The tables a query reads or writes
+    """
+    return frozenset(TABLE_RE.findall(query))
+
+
+class Manifest(object):
+    """
+    A single sqlite database holding everything scraped and downloaded so far.
+    Runs in WAL mode so several processes can share it. Writes are queued and committed together, once
+    batch_size of them are waiting, once the oldest one waited commit_interval seconds, before a read of a table they
+    change and on close. Lessons and masterclasses waiting to be written are looked up without committing them.
+    A connection is shared between the threads of a process, guarded by a lock.
+    """
+
+    def __init__(self, path, batch_size=MANIFEST_BATCH_SIZE, commit_interval=MANIFEST_COMMIT_INTERVAL,
+                 busy_timeout=MANIFEST_BUSY_TIMEOUT):
+        self.path = path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self._lock = threading.RLock()
+        self._pending = []
+        self._pending_since = None
+        self._pending_tables = set()
+        # (table, department id, item id) --> lesson or masterclass of a pending write, None when it was deleted
+        self._pending_items = {}
+
+        # transactions are managed by hand, see flush
+        self._db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._add_columns('departments', (('root_folder', 'TEXT'),))
+        self._add_columns('downloads', (('sha256', 'TEXT'), ('mtime', 'REAL'), ('source', 'TEXT')))
+        self._db.executescript(INDEXES)
+
+    def _add_columns(self, table, columns):
+        # manifests created by older versions
+        existing = {row[1] for row in self._db.execute('PRAGMA table_info({})'.format(table))}
+        for name, column_type in columns:
+            if name not in existing:
+                self._db.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, column_type))
+
+    def _write(self, query, params=(), many=False):
+        with self._lock:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.append((query, params, many))
+            self._pending_tables.update(_tables(query))
+            if (len(self._pending) >= self.batch_size or
+                    time.monotonic() - self._pending_since >= self.commit_interval):
+                self.flush()
+
+    def _read(self, query, params=(), flush=True):
+        with self._lock:
+            # reads always see this process' own writes, flush=False when the rows read have none pending
+            if flush and not self._pending_tables.isdisjoint(_tables(query)):
+                self.flush()
+            return self._db.execute(query, params).fetchall()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            self._pending_tables.clear()
+            self._pending_items.clear()
+            # taking the write lock up front, a deferred transaction could fail to upgrade under contention
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                for query, params, many in pending:
+                    if many:
+                        self._db.executemany(query, params)
+                    else:
+                        self._db.execute(query, params)
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._db.close()
+
+    def department_id(self, name, number=None, root_folder=None):
+        if number is not None:
+            self._write('UPDATE departments SET number = ? WHERE name = ?', (number, name))
+        if root_folder is not None:
+            self._write('UPDATE departments SET root_folder = ? WHERE name = ?', (root_folder, name))
+        self._write('INSERT OR IGNORE INTO departments (name, number, root_folder) VALUES (?, ?, ?)',
+                    (name, number, root_folder))
+        return self._read('SELECT id FROM departments WHERE name = ?', (name,))[0][0]
+
+    def departments(self):
+        """
+        Every department scraped so far, with its number and the root folder it was downloaded into
+        """
+        columns = ('name', 'number', 'root_folder')
+        return [dict(zip(columns, row)) for row in
+                self._read('SELECT {} FROM departments ORDER BY id'.format(', '.join(columns)))]
+
+    def department_name(self, number):
+        rows = self._read('SELECT name FROM departments WHERE number = ?', (number,))
+        return rows[0][0] if rows else None
+
+    def department_lessons(self, department_name):
+        """
+        The lessons table of a department as it was last scraped, lesson id --> name
+        """
+        return OrderedDict(self._read('SELECT dl.lesson_id, dl.name FROM department_lessons dl '
+                                      'JOIN departments d ON d.id = dl.department_id '
+                                      'WHERE d.name = ? ORDER BY dl.position', (department_name,)))
+
+    def set_department_lessons(self, department_name, lessons):
+        department_id = self.department_id(department_name)
+        self._write('DELETE FROM department_lessons WHERE department_id = ?', (department_id,))
+        self._write('INSERT INTO department_lessons (department_id, lesson_id, name, position) VALUES (?, ?, ?, ?)',
+                    [(department_id, str(lesson_id), name, position)
+                     for position, (lesson_id, name) in enumerate(lessons.items())], many=True)
+
+    def page_validators(self, url):
+        """
+        (ETag, Last-Modified) of the last time url was fetched
+        """
+        rows = self._read('SELECT etag, last_modified FROM pages WHERE url = ?', (url,))
+        return rows[0] if rows else (None, None)
+
+    def set_page_validators(self, url, etag, last_modified):
+        self._write('INSERT OR REPLACE INTO pages (url, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?)',
+                    (url, etag, last_modified, time.time()))
+
+    def cached_playlist(self, key, ttl):
+        rows = self._read('SELECT segments FROM playlists WHERE key = ? AND resolved_at > ?',
+                          (key, time.time() - ttl))
+        return json.loads(rows[0][0]) if rows else None
+
+    def cache_playlist(self, key, segments):
+        self._write('INSERT OR REPLACE INTO playlists (key, segments, resolved_at) VALUES (?, ?, ?)',
+                    (key, json.dumps(segments), time.time()))
+
+    def lessons(self, department_name):
+        return ManifestView(self, self.department_id(department_name), LESSON)
+
+    def masterclasses(self, department_name):
+        return ManifestView(self, self.department_id(department_name), MASTERCLASS)
+
+    def migrate_shelves(self, output_dir, department_name):
+        """
+        Imports the <department>_lessons.db and <department>_masterclasses.db shelves of older versions, once.
+        The shelves themselves are left untouched.
+        """
+        views = ((department_name + '_lessons.db', self.lessons(department_name)),
+                 (department_name + '_masterclasses.db', self.masterclasses(department_name)))
+        for shelf_name, view in views:
+            shelf_path = os.path.join(output_dir, shelf_name)
+            migrated_key = 'migrated:' + os.path.abspath(shelf_path)
+            if not dbm.whichdb(shelf_path) or self._read('SELECT 1 FROM meta WHERE key = ?', (migrated_key,)):
+                continue
+
+            with contextlib.closing(shelve.open(shelf_path, flag='r')) as shelf:
+                for key, item in shelf.items():
+                    if key not in view:
+                        view[key] = item
+                logger.info('migrated {} items from {}'.format(len(shelf), shelf_path))
+
+            self._write('INSERT INTO meta (key, value) VALUES (?, ?)', (migrated_key, str(time.time())))
+        self.flush()
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(str(path))
+
+    def completed_downloads(self):
+        """
+        Paths of every finished download, in a single query
+        """
+        return {row[0] for row in self._read('SELECT path FROM downloads WHERE status IN (?, ?)', (DONE, UNITED))}
+
+    def download_statuses(self):
+        """
+        Status of every download path, in a single query
+        """
+        return dict(self._read('SELECT path, status FROM downloads'))
+
+    def download_summary(self):
+        """
+        status --> (number of downloads, their total known size)
+        """
+        return {status: (count, size or 0) for status, count, size in
+                self._read('SELECT status, COUNT(*), SUM(size) FROM downloads GROUP BY status')}
+
+    def finished_downloads(self, paths=None):
+        """
+        Every finished download, or only those of paths
+        """
+        columns = ('path', 'url', 'size', 'sha256', 'mtime')
+        query = 'SELECT {} FROM downloads WHERE status = ?'.format(', '.join(columns))
+        if paths is None:
+            rows = self._read(query, (DONE,))
+        else:
+            rows = [row for path in paths for row in self._read(query + ' AND path = ?', (DONE, self._key(path)))]
+        return [dict(zip(columns, row)) for row in rows]
+
+    def download_status(self, path):
+        rows = self._read('SELECT status FROM downloads WHERE path = ?', (self._key(path),))
+        return rows[0][0] if rows else None
+
+    def _set_download(self, path, status, url=None, size=None, error=None, attempt=False):
+        key, now = self._key(path), time.time()
+        self._write('INSERT OR IGNORE INTO downloads (path, status, created_at, updated_at) VALUES (?, ?, ?, ?)',
+                    (key, status, now, now))
+        self._write('UPDATE downloads SET url = coalesce(?, url), source = coalesce(?, source), '
+                    'size = coalesce(?, size), status = ?, attempts = attempts + ?, error = ?, updated_at = ? '
+                    'WHERE path = ?',
+                    (url, url and normalize_url(url), size, status, int(attempt), error, now, key))
+
+    def download_started(self, path, url):
+        self._set_download(path, DOWNLOADING, url=url, attempt=True)
+
+    def download_finished(self, path, size=None, url=None, sha256=None, mtime=None):
+        self._set_download(path, DONE, url=url, size=size)
+        # a hash recorded for an earlier download of the path doesn't describe this file
+        self._write('UPDATE downloads SET sha256 = ?, mtime = ? WHERE path = ?', (sha256, mtime, self._key(path)))
+
+    def _existing_copy(self, rows, path):
+        for other_path, size, sha256 in rows:
+            # the file may have been moved or changed since
+            if other_path != self._key(path) and size is not None and \
+                    os.path.splitext(other_path)[1] == os.path.splitext(str(path))[1]:
+                with contextlib.suppress(OSError):
+                    if os.path.getsize(other_path) == size:
+                        return other_path, sha256
+        return None
+
+    def find_by_source(self, url, path):
+        """
+        (path, sha256) of a finished download of the same asset as url (and of the same type as path), or None
+        """
+        return self._existing_copy(self._read('SELECT path, size, sha256 FROM downloads '
+                                              'WHERE source = ? AND status = ?', (normalize_url(url), DONE)), path)
+
+    def find_by_hash(self, sha256, path):
+        """
+        (path, sha256) of another finished download with the same content as path, or None
+        """
+        return self._existing_copy(self._read('SELECT path, size, sha256 FROM downloads '
+                                              'WHERE sha256 = ? AND status = ?', (sha256, DONE)), path)
+
+    def download_verified(self, path, sha256, mtime):
+        self._write('UPDATE downloads SET sha256 = ?, mtime = ?, updated_at = ? WHERE path = ?',
+                    (sha256, mtime, time.time(), self._key(path)))
+
+    def download_corrupt(self, path, error):
+        self._set_download(path, CORRUPT, error=str(error))
+
+    def download_failed(self, path, error):
+        self._set_download(path, FAILED, error=str(error))
+
+    def parts_united(self, part_paths, output_path, size=None, mtime=None):
+        for path in part_paths:
+            self._set_download(path, UNITED)
+        self.download_finished(output_path, size=size, mtime=mtime)
+
+
+class ManifestView(MutableMapping):
+    """
+    The lessons or masterclasses of a single department, used like the shelves it replaces
+    """
+
+    def __init__(self, manifest, department_id, kind):
+        self.manifest = manifest
+        self.department_id = department_id
+        self.kind = kind
+        self.table = 'lessons' if kind == LESSON else 'masterclasses'
+
+    def _links(self, owner_id=None):
+        query = 'SELECT owner_id, name, url FROM links WHERE department_id = ? AND kind = ?'
+        params = (self.department_id, self.kind)
+        if owner_id is not None:
+            query += ' AND owner_id = ?'
+            params += (owner_id,)
+        links = {}
+        for row_owner, name, url in self.manifest._read(query + ' ORDER BY owner_id, position', params,
+                                                        flush=owner_id is None):
+            links.setdefault(row_owner, []).append(LessonLink(name=name, link=url))
+        return links
+
+    def _build(self, row, links):
+        if self.kind == LESSON:
+            item_id, name, masterclass_ids = row
+            return Lesson(id=item_id, name=name, links=links.get(item_id, []),
+                          masterclass_ids=json.loads(masterclass_ids))
+        item_id, name = row
+        return Masterclass(id=item_id, name=name, links=links.get(item_id, []))
+
+    def _select(self, where='', params=(), flush=True):
+        # in the order the items were first scraped, rowids are kept when they are scraped again
+        columns = 'id, name, masterclass_ids' if self.kind == LESSON else 'id, name'
+        return self.manifest._read('SELECT {} FROM {} WHERE department_id = ?{} ORDER BY rowid'.format(
+            columns, self.table, where), (self.department_id,) + params, flush=flush)
+
+    def _pending(self, item_id):
+        """
+        (True, item or None once deleted) when a write of item_id is pending, (False, None) otherwise
+        """
+        key = (self.table, self.department_id, item_id)
+        if key not in self.manifest._pending_items:
+            return False, None
+        item = self.manifest._pending_items[key]
+        if item is not None and self.kind == LESSON:
+            item = Lesson(id=item_id, name=item.name, links=list(item.links),
+                          masterclass_ids=list(item.masterclass_ids))
+        elif item is not None:
+            item = Masterclass(id=item_id, name=item.name, links=list(item.links))
+        return True, item
+
+    def __getitem__(self, item_id):
+        item_id = str(item_id)
+        with self.manifest._lock:
+            pending, item = self._pending(item_id)
+            if pending:
+                if item is None:
+                    raise KeyError(item_id)
+                return item
+            # only writes of other items are pending, no need to commit them
+            rows = self._select(' AND id = ?', (item_id,), flush=False)
+            if not rows:
+                raise KeyError(item_id)
+            return self._build(rows[0], self._links(item_id))
+
+    def __setitem__(self, item_id, item):
+        item_id = str(item_id)
+        with self.manifest._lock:
+            self._write_item(item_id, item)
+            # after the writes, one of them may have flushed the others
+            self.manifest._pending_items[(self.table, self.department_id, item_id)] = item
+
+    def _write_item(self, item_id, item):
+        if self.kind == LESSON:
+            self.manifest._write('INSERT INTO lessons (department_id, id, name, masterclass_ids, scraped_at) '
+                                 'VALUES (?, ?, ?, ?, ?) ON CONFLICT (department_id, id) DO UPDATE SET '
+                                 'name = excluded.name, masterclass_ids = excluded.masterclass_ids, '
+                                 'scraped_at = excluded.scraped_at',
+                                 (self.department_id, item_id, item.name, json.dumps(list(item.masterclass_ids)),
+                                  time.time()))
+        else:
+            self.manifest._write('INSERT INTO masterclasses (department_id, id, name, scraped_at) VALUES (?, ?, ?, ?) '
+                                 'ON CONFLICT (department_id, id) DO UPDATE SET name = excluded.name, '
+                                 'scraped_at = excluded.scraped_at',
+                                 (self.department_id, item_id, item.name, time.time()))
+        self._delete_links(item_id)
+        self.manifest._write('INSERT INTO links (department_id, kind, owner_id, position, name, url) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             [(self.department_id, self.kind, item_id, position, link.name, link.link)
+                              for position, link in enumerate(item.links)], many=True)
+
+    def _delete_links(self, item_id):
+        self.manifest._write('DELETE FROM links WHERE department_id = ? AND kind = ? AND owner_id = ?',
+                             (self.department_id, self.kind, item_id))
+
+    def __delitem__(self, item_id):
+        item_id = str(item_id)
+        with self.manifest._lock:
+            if item_id not in self:
+                raise KeyError(item_id)
+            self.manifest._write('DELETE FROM {} WHERE department_id = ? AND id = ?'.format(self.table),
+                                 (self.department_id, item_id))
+            self._delete_links(item_id)
+            self.manifest._pending_items[(self.table, self.department_id, item_id)] = None
+
+    def __contains__(self, item_id):
+        item_id = str(item_id)
+        with self.manifest._lock:
+            pending, item = self._pending(item_id)
+            if pending:
+                return item is not None
+            return bool(self._select(' AND id = ?', (item_id,), flush=False))
+
+    def __iter__(self):
+        return iter([row[0] for row in self._select()])
+
+    def __len__(self):
+        return self.manifest._read('SELECT count(*) FROM {} WHERE department_id = ?'.format(self.table),
+                                   (self.department_id,))[0][0]
+
+    def values(self):
+        # two queries for the whole department instead of one per item
+        links = self._links()
+        return [self._build(row, links) for row in self._select()]
+
+    def items(self):
+        links = self._links()
+        return [(row[0], self._build(row, links)) for row in self._select()]
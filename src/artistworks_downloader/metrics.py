@@ -0,0 +1,246 @@
+from __future__ import unicode_literals, absolute_import
+
+import bisect
+from collections import OrderedDict, defaultdict
+import contextlib
+import json
+import os
+import random
+import re
+import threading
+import time
+
+import tqdm
+
+from .constants import METRICS_PREFIX, HISTOGRAM_BUCKETS, MAX_FILE_PROGRESS_BARS, HISTOGRAM_SAMPLE_SIZE
+
+
+class Histogram(object):
+    """
+    Bucket counts, count, sum, min and max of every observation, in constant memory. Quantiles come from a uniform
+    sample of sample_size observations (reservoir sampling), exact until there are more of them
+    """
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS, sample_size=HISTOGRAM_SAMPLE_SIZE):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.sample_size = sample_size
+        self.sample = []
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+
+        if len(self.sample) < self.sample_size:
+            self.sample.append(value)
+        else:
+            replaced = random.randrange(self.count)
+            if replaced < self.sample_size:
+                self.sample[replaced] = value
+
+    def quantile(self, q):
+        values = sorted(self.sample)
+        return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count, 'p50': self.quantile(0.5), 'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99)}
+
+
+class Metrics(object):
+    """
+    Counters, gauges, histograms and phase timings of a run, with live progress bars for downloads.
+    Thread safe, the scraper threads and the loop report to the same instance.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything recorded so far, for measuring another run in the same process
+        """
+        self.started = time.time()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.phases = OrderedDict()
+
+        self.show_progress = False
+        self._total_bar = None
+        self._file_bars = {}
+        self._counted = set()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value, buckets=HISTOGRAM_BUCKETS):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(buckets)
+            self.histograms[name].observe(value)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """
+        Observes the seconds spent in the block into the name histogram
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0) + time.monotonic() - start
+
+    def enable_progress(self):
+        self.show_progress = True
+
+    def _bar(self):
+        if self._total_bar is None:
+            self._total_bar = tqdm.tqdm(desc='total', total=0, unit='B', unit_scale=True, unit_divisor=1024,
+                                        position=0)
+        return self._total_bar
+
+    def file_started(self, key, name, total=None, initial=0):
+        """
+        Tracks the progress of a single file, total may be unknown (None)
+        """
+        if not self.show_progress:
+            return
+        with self._lock:
+            bar = self._bar()
+            if total and key not in self._counted:
+                # a retried file is only counted once
+                self._counted.add(key)
+                bar.total += total - initial
+                bar.refresh()
+            if key not in self._file_bars and len(self._file_bars) < MAX_FILE_PROGRESS_BARS:
+                self._file_bars[key] = tqdm.tqdm(desc=name[-40:], total=total, initial=initial, unit='B',
+                                                 unit_scale=True, unit_divisor=1024, leave=False)
+
+    def expect_file(self, key, size):
+        """
+        Counts the size of a file planned for download in the total progress before it starts, so the total's ETA
+        covers the whole run rather than the files started so far
+        """
+        if not self.show_progress or not size:
+            return
+        with self._lock:
+            if key not in self._counted:
+                self._counted.add(key)
+                bar = self._bar()
+                bar.total += size
+                bar.refresh()
+
+    def file_progress(self, key, count):
+        self.increment('download_bytes_total', count)
+        if not self.show_progress:
+            return
+        with self._lock:
+            self._bar().update(count)
+            if key in self._file_bars:
+                self._file_bars[key].update(count)
+
+    def file_finished(self, key):
+        if not self.show_progress:
+            return
+        with self._lock:
+            bar = self._file_bars.pop(key, None)
+            if bar is not None:
+                bar.close()
+
+    def close_progress(self):
+        with self._lock:
+            for bar in self._file_bars.values():
+                bar.close()
+            self._file_bars = {}
+            if self._total_bar is not None:
+                self._total_bar.close()
+                self._total_bar = None
+
+    def summary(self):
+        with self._lock:
+            return OrderedDict([
+                ('started', self.started),
+                ('duration', time.time() - self.started),
+                ('phases', OrderedDict(self.phases)),
+                ('counters', dict(self.counters)),
+                ('gauges', dict(self.gauges)),
+                ('histograms', {name: histogram.summary() for name, histogram in self.histograms.items()}),
+            ])
+
+    def write_json(self, directory):
+        """
+        Writes the summary of this run to run-<start time>.json in directory, returns its path
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'run-{}.json'.format(time.strftime('%Y%m%d-%H%M%S',
+                                                                          time.localtime(self.started))))
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        return path
+
+    def prometheus(self):
+        def metric_name(name):
+            return METRICS_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines += ['# TYPE {} counter'.format(metric_name(name)), '{} {}'.format(metric_name(name), value)]
+            for name, value in sorted(self.gauges.items()):
+                lines += ['# TYPE {} gauge'.format(metric_name(name)), '{} {}'.format(metric_name(name), value)]
+
+            phase_name = metric_name('phase_seconds')
+            lines.append('# TYPE {} gauge'.format(phase_name))
+            for phase, seconds in self.phases.items():
+                lines.append('{}{{phase="{}"}} {}'.format(phase_name, phase, seconds))
+
+            for name, histogram in sorted(self.histograms.items()):
+                name = metric_name(name)
+                lines.append('# TYPE {} histogram'.format(name))
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, cumulative))
+                lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, histogram.count))
+                lines.append('{}_sum {}'.format(name, histogram.sum))
+                lines.append('{}_count {}'.format(name, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # written aside and renamed, a textfile collector never reads half a file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+# shared by every module of a run, like their loggers
+metrics = Metrics()
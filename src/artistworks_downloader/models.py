@@ -0,0 +1,15 @@
+from __future__ import unicode_literals, absolute_import
+
+from collections import namedtuple
+
+
+class Lesson(namedtuple('Lesson', field_names=['id', 'name', 'links', 'masterclass_ids'])):
+    pass
+
+
+class Masterclass(namedtuple('Masterclass', field_names=['id', 'name', 'links'])):
+    pass
+
+
+class LessonLink(namedtuple('LessonLink', field_names=['name', 'link'])):
+    pass
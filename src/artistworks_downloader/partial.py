@@ -0,0 +1,159 @@
+from __future__ import unicode_literals, absolute_import
+
+import contextlib
+import json
+import os
+import re
+
+PART_SUFFIX = '.part'
+SIDECAR_SUFFIX = '.part.json'
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+def parse_content_range(header):
+    """
+    'bytes 100-199/1000' --> (100, 199, 1000), total is None when the server doesn't know it
+    """
+    match = CONTENT_RANGE_RE.match(header or '')
+    if not match:
+        return None
+    start, end, total = match.groups()
+    return int(start), int(end), None if total == '*' else int(total)
+
+
+class PartialDownload(object):
+    """
+    A download in progress. Data goes to <file>.part, a small json sidecar keeps the expected length and
+    the validator (ETag/Last-Modified) of the response, so an interrupted download can be resumed with a Range
+    request - as long as the remote file didn't change in the meantime.
+    The final file only appears (atomically renamed) once the download is complete.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.part_path = self.path + PART_SUFFIX
+        self.sidecar_path = self.path + SIDECAR_SUFFIX
+
+        self.url = None
+        self.length = None
+        self.etag = None
+        self.last_modified = None
+        # [start, end, bytes written] for downloads split into byte ranges, empty for single stream downloads
+        self.segments = []
+        # bytes of a single stream download known to be on disk, the part file may be longer: writes finish out of
+        # order, a killed download can leave holes below its size
+        self.written = 0
+        # block index --> digest of the blocks hashed so far, see ContentHash
+        self.hashes = {}
+
+    def load(self):
+        if not (os.path.exists(self.part_path) and os.path.exists(self.sidecar_path)):
+            return False
+
+        try:
+            with open(self.sidecar_path) as f:
+                state = json.load(f)
+        except ValueError:
+            return False
+
+        self.url = state.get('url')
+        self.length = state.get('length')
+        self.etag = state.get('etag')
+        self.last_modified = state.get('last_modified')
+        self.segments = state.get('segments', [])
+        self.written = state.get('written', 0)
+        self.hashes = {int(index): digest for index, digest in state.get('hashes', {}).items()}
+        return True
+
+    def save(self):
+        state = {'url': self.url, 'length': self.length, 'etag': self.etag, 'last_modified': self.last_modified,
+                 'segments': self.segments, 'written': self.written, 'hashes': self.hashes}
+        tmp_path = self.sidecar_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.sidecar_path)
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.part_path)
+        except OSError:
+            return 0
+
+    @property
+    def resume_offset(self):
+        """
+        Where a single stream download continues from
+        """
+        return min(self.written, self.offset)
+
+    @property
+    def validator(self):
+        # If-Range only works with strong etags
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+    def resume_headers(self, url):
+        """
+        Range headers for continuing this download, empty when it has to start over
+        """
+        offset = self.resume_offset
+        if not offset or url != self.url or not self.validator:
+            return {}
+        if self.length is not None and offset >= self.length:
+            return {}
+        return {'Range': 'bytes={}-'.format(offset), 'If-Range': self.validator}
+
+    def update_from_response(self, url, response):
+        """
+        Records the validators of a response, returns the offset the response body starts at
+        """
+        self.url = url
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+
+        if response.status == 206:
+            content_range = parse_content_range(response.headers.get('Content-Range'))
+            if content_range is None:
+                raise ValueError('partial response without a valid Content-Range from {}'.format(url))
+            start, _, total = content_range
+            self.length = total
+            return start
+
+        content_length = response.headers.get('Content-Length')
+        self.length = int(content_length) if content_length else None
+        return 0
+
+    def plan_segments(self, count, align=1):
+        """
+        Splits the whole file into count byte ranges of about the same size, starting on multiples of align
+        """
+        size = -(-self.length // count)
+        size = -(-size // align) * align
+        self.segments = [[start, min(start + size, self.length) - 1, 0] for start in range(0, self.length, size)]
+        return self.segments
+
+    @property
+    def written_ranges(self):
+        """
+        (start, end) of the bytes already in the part file
+        """
+        if self.segments:
+            return [(start, start + written) for start, _, written in self.segments]
+        return [(0, self.resume_offset)]
+
+    @property
+    def pending_segments(self):
+        return [segment for segment in self.segments if segment[2] < segment[1] - segment[0] + 1]
+
+    def complete(self):
+        os.replace(self.part_path, self.path)
+        with contextlib.suppress(OSError):
+            os.remove(self.sidecar_path)
+
+    def discard(self):
+        for path in (self.part_path, self.sidecar_path):
+            with contextlib.suppress(OSError):
+                os.remove(path)
@@ -0,0 +1,148 @@
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import logbook
+
+from .constants import PIPELINE_QUEUE_SIZE, PIPELINE_LESSONS_IN_FLIGHT, PIPELINE_STOP_POLL_INTERVAL
+from .metrics import metrics
+from .unite import unite_ts_videos
+
+logger = logbook.Logger(__name__)
+
+
+class Pipeline(object):
+    """
+    Runs scraping, downloading and uniting as concurrent stages connected by bounded queues.
+    A lesson's downloads are queued as soon as it is scraped, and its parts are united as soon as its
+    downloads are done, so a run takes about as long as its slowest stage instead of the sum of all three.
+    """
+
+    def __init__(self, downloader, unite=True, queue_size=PIPELINE_QUEUE_SIZE,
+                 lessons_in_flight=PIPELINE_LESSONS_IN_FLIGHT, unite_workers=None, fast_concat=True):
+        self.downloader = downloader
+        self.loop = downloader.loop
+        self.unite = unite
+        self.unite_workers = unite_workers
+        self.fast_concat = fast_concat
+        self.queue_size = queue_size
+        self.lessons_in_flight = lessons_in_flight
+
+        # selenium is blocking and not thread safe, the whole scrape stage runs on this one thread
+        self._scraper_thread = ThreadPoolExecutor(max_workers=1)
+        self._uniter_thread = ThreadPoolExecutor(max_workers=1)
+        # set when a stage failed and the others are cancelled, downstream of it nothing would take more work
+        self._stop = threading.Event()
+        self._lessons = set()
+
+    @asyncio.coroutine
+    def _scrape_stage(self, lessons, lesson_queue):
+        def produce():
+            for item in lessons:
+                # blocks the scraper when downloads fall behind, until the pipeline is stopped
+                put = asyncio.run_coroutine_threadsafe(lesson_queue.put(item), self.loop)
+                while True:
+                    try:
+                        put.result(timeout=PIPELINE_STOP_POLL_INTERVAL)
+                        break
+                    except concurrent.futures.TimeoutError:
+                        if self._stop.is_set():
+                            put.cancel()
+                            return
+                if self._stop.is_set():
+                    return
+
+        try:
+            yield from self.loop.run_in_executor(self._scraper_thread, produce)
+        finally:
+            if not self._stop.is_set():
+                yield from lesson_queue.put(None)
+
+    @asyncio.coroutine
+    def _finish_lesson(self, folder, tasks, unite_queue, in_flight):
+        try:
+            if tasks:
+                yield from asyncio.wait(tasks)
+            failed = [task for task in tasks if task.cancelled() or task.exception() is not None]
+            if failed:
+                logger.error('{} downloads of {} failed, not uniting it'.format(len(failed), folder))
+            elif self.unite:
+                yield from unite_queue.put(folder)
+        finally:
+            in_flight.release()
+
+    @asyncio.coroutine
+    def _download_stage(self, lesson_queue, unite_queue):
+        in_flight = asyncio.Semaphore(self.lessons_in_flight)
+        lessons = self._lessons
+        try:
+            while True:
+                item = yield from lesson_queue.get()
+                if item is None:
+                    break
+
+                folder, downloads = item
+                yield from in_flight.acquire()
+                tasks = [self.downloader.download_link(link, output_folder) for link, output_folder in downloads]
+                lesson = asyncio.Task(self._finish_lesson(folder, [task for task in tasks if task is not None],
+                                                          unite_queue, in_flight))
+                lesson.add_done_callback(lessons.discard)
+                lessons.add(lesson)
+
+            if lessons:
+                yield from asyncio.wait(lessons)
+        finally:
+            if not self._stop.is_set():
+                yield from unite_queue.put(None)
+
+    def _unite(self, folder):
+        with metrics.phase('unite'):
+            unite_ts_videos(str(folder), workers=self.unite_workers, fast_concat=self.fast_concat,
+                            manifest=self.downloader.manifest)
+
+    @asyncio.coroutine
+    def _unite_stage(self, unite_queue):
+        while True:
+            folder = yield from unite_queue.get()
+            if folder is None:
+                break
+            try:
+                yield from self.loop.run_in_executor(self._uniter_thread, self._unite, folder)
+            except Exception as e:
+                logger.exception(e)
+
+    @asyncio.coroutine
+    def _run(self, lessons):
+        lesson_queue = asyncio.Queue(maxsize=self.queue_size)
+        unite_queue = asyncio.Queue(maxsize=self.queue_size)
+        scrape = asyncio.Task(self._scrape_stage(lessons, lesson_queue))
+        stages = [scrape, asyncio.Task(self._download_stage(lesson_queue, unite_queue)),
+                  asyncio.Task(self._unite_stage(unite_queue))]
+
+        done, _ = yield from asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        if any(stage.exception() is not None for stage in done if stage is not scrape):
+            # downloading or uniting broke, lessons can't get through anymore
+            self._stop.set()
+            for task in stages + list(self._lessons) + list(self.downloader.tasks):
+                task.cancel()
+        # a failed scrape only stops new lessons, those scraped already are still downloaded and united
+        yield from asyncio.wait(stages + list(self._lessons) + list(self.downloader.tasks))
+
+        for stage in stages:
+            if not stage.cancelled() and stage.exception() is not None:
+                raise stage.exception()
+
+    def run(self, lessons):
+        """
+        lessons is an iterable of (lesson folder, [(link, output folder), ...]), consumed on the scraper thread.
+        Raises the error of the first stage that failed, once the others are done or cancelled
+        """
+        try:
+            self.loop.run_until_complete(self._run(lessons))
+        finally:
+            self._scraper_thread.shutdown()
+            self._uniter_thread.shutdown()
+            self.downloader.close()
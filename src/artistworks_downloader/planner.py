@@ -0,0 +1,209 @@
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+from collections import namedtuple, OrderedDict
+import contextlib
+import itertools
+
+import logbook
+
+from .constants import PLAN_PROBE_CONCURRENCY
+from .dedup import normalize_url
+from .exceptions import DiskBudgetException
+from .metrics import metrics
+
+logger = logbook.Logger(__name__)
+
+
+class PlannedDownload(namedtuple('PlannedDownload', field_names=['priority', 'link', 'folder', 'department', 'lesson',
+                                                                 'path', 'is_playlist', 'size'])):
+    """
+    A link queued for download, size is None when it couldn't be probed (estimated for HLS playlists)
+    """
+
+
+def _megabytes(size):
+    return '{:.1f} MB'.format(size / 2 ** 20)
+
+
+@asyncio.coroutine
+def probe_size(session, scheduler, url):
+    """
+    Size of url from the Content-Length of a HEAD request, or from the Content-Range of its first byte when HEAD
+    doesn't tell. None when neither does. Each request waits for a slot of scheduler, like the downloads do
+    """
+    with (yield from scheduler.slot(url)):
+        response = yield from session.head(url, allow_redirects=True)
+        with contextlib.closing(response):
+            if response.status == 200 and response.headers.get('Content-Length'):
+                return int(response.headers['Content-Length'])
+
+    with (yield from scheduler.slot(url)):
+        response = yield from session.get(url, headers={'Range': 'bytes=0-0'})
+        with contextlib.closing(response):
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if response.status == 206 and total.isdigit():
+                return int(total)
+    return None
+
+
+class Plan(object):
+    """
+    The downloads of a run with their sizes. Videos linked from several lessons are only counted once when the
+    downloader deduplicates them, their copies share the same data on disk
+    """
+
+    def __init__(self, downloads, dedup=True, streamed=False):
+        self.downloads = downloads
+        self.dedup = dedup
+        # whether playlists are streamed into a single file, rather than downloaded as parts
+        self.streamed = streamed
+
+    def _counted(self, downloads=None, sources=None):
+        sources = set() if sources is None else sources
+        for download in self.downloads if downloads is None else downloads:
+            source = normalize_url(download.link.link)
+            duplicate = self.dedup and source in sources
+            sources.add(source)
+            yield download, 0 if duplicate else download.size or 0
+
+    @property
+    def total(self):
+        return sum(size for _, size in self._counted())
+
+    @property
+    def unknown(self):
+        return sum(1 for download in self.downloads if download.size is None)
+
+    def by_lesson(self):
+        """
+        department --> lesson --> [files, bytes], in the order the downloads were listed
+        """
+        sizes = OrderedDict()
+        for download, size in self._counted():
+            lesson = sizes.setdefault(download.department, OrderedDict()).setdefault(download.lesson, [0, 0])
+            lesson[0] += 1
+            lesson[1] += size
+        return sizes
+
+    def report(self):
+        lines = ['Plan: {} files, {}{}'.format(len(self.downloads), _megabytes(self.total),
+                                              ' ({} of unknown size)'.format(self.unknown) if self.unknown else '')]
+        for department, lessons in self.by_lesson().items():
+            lines.append('  {}: {} files, {}'.format(department, sum(files for files, _ in lessons.values()),
+                                                     _megabytes(sum(size for _, size in lessons.values()))))
+            for lesson, (files, size) in lessons.items():
+                lines.append('    {}: {} files, {}'.format(lesson, files, _megabytes(size)))
+        return '\n'.join(lines)
+
+    def within_budget(self, budget, trim=False):
+        """
+        The plan if it fits in budget bytes. Otherwise raises DiskBudgetException, or with trim keeps the lessons that
+        fit, whole and highest priority first
+        """
+        total = self.total
+        if total <= budget:
+            return self
+        if not trim:
+            raise DiskBudgetException('the downloads need {}, only {} of the output disk may be used'.format(
+                _megabytes(total), _megabytes(max(budget, 0))))
+
+        lessons = OrderedDict()
+        for download in sorted(self.downloads, key=lambda download: -download.priority):
+            lessons.setdefault((download.department, download.lesson), []).append(download)
+
+        kept, sources, used, dropped = [], set(), 0, 0
+        for downloads in lessons.values():
+            # copies of videos already kept take no space of their own
+            lesson_sources = set(sources)
+            size = sum(size for _, size in self._counted(downloads, lesson_sources))
+            if used + size <= budget:
+                kept.extend(downloads)
+                sources = lesson_sources
+                used += size
+            else:
+                dropped += 1
+        logger.warning('the downloads need {}, leaving out {} lessons to fit in {}'.format(
+            _megabytes(total), dropped, _megabytes(max(budget, 0))))
+        return Plan(kept, dedup=self.dedup, streamed=self.streamed)
+
+    def ordered(self):
+        """
+        The downloads in the order they should start: by priority, then the largest files first so that none of them
+        is left downloading alone at the end, with playlists (many short segments) in between to fill the slots the
+        large files leave
+        """
+        ordered = []
+        by_priority = sorted(self.downloads, key=lambda download: -download.priority)
+        for _, downloads in itertools.groupby(by_priority, key=lambda download: download.priority):
+            downloads = sorted(downloads, key=lambda download: -(download.size or 0))
+            files = [download for download in downloads if not download.is_playlist]
+            playlists = [download for download in downloads if download.is_playlist]
+            for pair in itertools.zip_longest(files, playlists):
+                ordered.extend(download for download in pair if download is not None)
+        return ordered
+
+    def expect_progress(self):
+        """
+        Counts the planned sizes in the total progress bar up front, for an ETA of the whole run. Playlists
+        downloaded as parts count their parts as these start
+        """
+        metrics.set_gauge('planned_bytes', self.total)
+        metrics.set_gauge('planned_files', len(self.downloads))
+        for download, size in self._counted():
+            if self.streamed or not download.is_playlist:
+                metrics.expect_file(str(download.path), size)
+
+
+class DownloadPlanner(object):
+    """
+    Probes the size of every download of a run before any of them starts, concurrently and over the downloader's
+    session: files with a HEAD request, HLS playlists by resolving them (into the downloader's playlist cache, the
+    download reuses it) and probing their first segment. Probes go through the downloader's scheduler, within the
+    same per host rates as the downloads. Links already downloaded are left out.
+    """
+
+    def __init__(self, downloader, concurrency=PLAN_PROBE_CONCURRENCY):
+        self.downloader = downloader
+        self.sem = asyncio.Semaphore(concurrency)
+        self._downloads = []
+
+    def add(self, priority, link, folder, department=None, lesson=None):
+        path, is_playlist = self.downloader.link_path(link, folder)
+        if not self.downloader.is_downloaded(path):
+            self._downloads.append((priority, link, folder, department, lesson, path, is_playlist))
+
+    def __len__(self):
+        return len(self._downloads)
+
+    @asyncio.coroutine
+    def _probe(self, url, is_playlist):
+        with (yield from self.sem):
+            try:
+                downloader = self.downloader
+                if not is_playlist:
+                    return (yield from probe_size(downloader.session, downloader.scheduler, url))
+
+                segment_urls = yield from downloader.playlists.resolve(url)
+                if not segment_urls:
+                    return 0
+                # segments of a rendition are about the same length
+                segment_size = yield from probe_size(downloader.session, downloader.scheduler, segment_urls[0])
+                return segment_size * len(segment_urls) if segment_size is not None else None
+            except Exception as e:
+                logger.warning('could not probe the size of {}: {}'.format(url, e))
+                return None
+
+    @asyncio.coroutine
+    def _probe_all(self, urls):
+        return (yield from asyncio.gather(*[self._probe(url, is_playlist) for url, is_playlist in urls.items()]))
+
+    def plan(self):
+        urls = OrderedDict((download[1].link, download[6]) for download in self._downloads)
+        sizes = {}
+        if urls:
+            with metrics.timed('plan_probe_seconds'):
+                sizes = dict(zip(urls, self.downloader.loop.run_until_complete(self._probe_all(urls))))
+        metrics.increment('plan_probes_total', len(urls))
+        return Plan([PlannedDownload(*download, size=sizes[download[1].link]) for download in self._downloads],
+                    dedup=self.downloader.dedup, streamed=self.downloader.hls_format is not None)
@@ -0,0 +1,206 @@
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+import collections
+import random
+from urllib.parse import urlparse
+
+import logbook
+
+from .constants import MAX_CONCURRENT_DOWNLOADS, MIN_CONCURRENT_DOWNLOADS, MAX_CONCURRENT_DOWNLOADS_LIMIT, \
+    CONCURRENCY_ADJUST_INTERVAL, CONCURRENCY_ERROR_THRESHOLD, CONCURRENCY_DECREASE_FACTOR, \
+    CONCURRENCY_THROUGHPUT_TOLERANCE, HOST_REQUEST_RATE, HOST_REQUEST_BURST, RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX, \
+    COUNT_BUCKETS, THROUGHPUT_BUCKETS
+from .metrics import metrics
+
+logger = logbook.Logger(__name__)
+
+
+class AdaptiveLimiter(object):
+    """
+    A semaphore whose size is adjusted every interval seconds, additive increase / multiplicative decrease:
+    halved (by decrease_factor) when the share of failed requests reaches error_threshold, grown by one while every
+    slot is taken and throughput keeps up, and the last increase undone when throughput dropped after it.
+    """
+
+    def __init__(self, loop, initial=MAX_CONCURRENT_DOWNLOADS, minimum=MIN_CONCURRENT_DOWNLOADS,
+                 maximum=MAX_CONCURRENT_DOWNLOADS_LIMIT, interval=CONCURRENCY_ADJUST_INTERVAL,
+                 error_threshold=CONCURRENCY_ERROR_THRESHOLD, decrease_factor=CONCURRENCY_DECREASE_FACTOR,
+                 tolerance=CONCURRENCY_THROUGHPUT_TOLERANCE):
+        self.loop = loop
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.interval = interval
+        self.error_threshold = error_threshold
+        self.decrease_factor = decrease_factor
+        self.tolerance = tolerance
+
+        self.in_use = 0
+        self._waiters = collections.deque()
+
+        self._window_start = loop.time()
+        self._bytes = 0
+        self._completed = 0
+        self._errors = 0
+        self._busy = False
+        self._last_throughput = None
+        self._increased = False
+
+    @property
+    def capacity(self):
+        return int(self.limit)
+
+    @asyncio.coroutine
+    def acquire(self):
+        while self.in_use >= self.capacity:
+            self._busy = True
+            waiter = asyncio.Future(loop=self.loop)
+            self._waiters.append(waiter)
+            try:
+                yield from waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif not waiter.cancelled():
+                    # woken up but no longer interested, pass the slot on
+                    self._wake()
+                raise
+        self.in_use += 1
+        if self.in_use >= self.capacity:
+            self._busy = True
+
+    def release(self, failed=False):
+        self.in_use -= 1
+        self._completed += 1
+        if failed:
+            self._errors += 1
+        self._maybe_adjust()
+        self._wake()
+
+    def record_bytes(self, count):
+        self._bytes += count
+        if self._maybe_adjust():
+            self._wake()
+
+    def _wake(self):
+        free = self.capacity - self.in_use
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def _maybe_adjust(self):
+        now = self.loop.time()
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return False
+
+        throughput = self._bytes / elapsed
+        previous = self.limit
+        if self._errors and self._errors >= self.error_threshold * self._completed:
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+            self._increased = False
+        elif (self._increased and self._last_throughput and
+              throughput < self._last_throughput * (1 - self.tolerance)):
+            # more connections made it slower
+            self.limit = max(self.minimum, self.limit - 1)
+            self._increased = False
+        elif self._busy and (self._last_throughput is None or
+                             throughput >= self._last_throughput * (1 - self.tolerance)):
+            self.limit = min(self.maximum, self.limit + 1)
+            self._increased = self.limit > previous
+        else:
+            self._increased = False
+
+        if int(self.limit) != int(previous):
+            logger.debug('download concurrency {} -> {} ({:.0f} KB/s, {} errors out of {})'.format(
+                int(previous), int(self.limit), throughput / 1024, self._errors, self._completed))
+
+        metrics.observe('download_concurrency', self.capacity, buckets=COUNT_BUCKETS)
+        metrics.observe('download_throughput_bytes_per_second', throughput, buckets=THROUGHPUT_BUCKETS)
+        self._last_throughput = throughput
+        self._window_start = now
+        self._bytes = self._completed = self._errors = 0
+        self._busy = self.in_use >= self.capacity
+        return True
+
+
+class TokenBucket(object):
+    """
+    Allows rate requests per second on average, and bursts of up to burst requests
+    """
+
+    def __init__(self, loop, rate, burst):
+        self.loop = loop
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self._updated = loop.time()
+
+    @asyncio.coroutine
+    def take(self):
+        while True:
+            now = self.loop.time()
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            yield from asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _Slot(object):
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.limiter.release(failed=exc_type is not None and not issubclass(exc_type, asyncio.CancelledError))
+
+
+class DownloadScheduler(object):
+    """
+    Hands out download slots: requests wait for a token of their host's bucket (when host_rate is set),
+    then for a slot of the adaptive limiter. A request failing inside its slot counts as an error for the limiter.
+    Waiting before a retry happens outside of any slot, for backoff(attempt) seconds.
+    """
+
+    def __init__(self, loop, initial=MAX_CONCURRENT_DOWNLOADS, minimum=MIN_CONCURRENT_DOWNLOADS,
+                 maximum=MAX_CONCURRENT_DOWNLOADS_LIMIT, host_rate=HOST_REQUEST_RATE, host_burst=HOST_REQUEST_BURST,
+                 backoff_base=RETRY_BACKOFF_BASE, backoff_max=RETRY_BACKOFF_MAX):
+        self.loop = loop
+        self.limiter = AdaptiveLimiter(loop, initial=initial, minimum=minimum, maximum=maximum)
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._buckets = {}
+
+    def _bucket(self, url):
+        host = urlparse(url).hostname
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self.loop, self.host_rate, self.host_burst)
+        return self._buckets[host]
+
+    @asyncio.coroutine
+    def slot(self, url):
+        """
+        with (yield from scheduler.slot(url)):
+        """
+        if self.host_rate:
+            yield from self._bucket(url).take()
+        yield from self.limiter.acquire()
+        return _Slot(self.limiter)
+
+    def record_bytes(self, count):
+        self.limiter.record_bytes(count)
+
+    def backoff(self, attempt):
+        """
+        Exponential backoff with full jitter, attempt counts from 0
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
@@ -0,0 +1,154 @@
+from __future__ import unicode_literals, absolute_import
+
+import contextlib
+import queue
+import threading
+
+import logbook
+
+from .constants import MAX_SCRAPE_RETRIES
+from .metrics import metrics
+from .session_store import restore_or_login
+from .webdriver import ArtistWorkScraper
+
+logger = logbook.Logger(__name__)
+
+LESSON = 'lesson'
+MASTERCLASS = 'masterclass'
+
+
+class ScraperPool(object):
+    """
+    Runs several browser instances in parallel, sharing the cookies of a single login between them.
+    The logged in browser itself is kept out of the workers, for listing the departments of every job.
+    Lesson and masterclass ids are handed out from a work queue, results are written back from the calling thread
+    only, so every finished item is recorded in the manifest as soon as it arrives.
+    """
+
+    def __init__(self, workers, fetch_extras=False, use_firefox=False, profile_dir=None):
+        self.workers = max(1, workers)
+        self.fetch_extras = fetch_extras
+        self.use_firefox = use_firefox
+        # only the primary browser keeps its profile, browsers can't share one
+        self.profile_dir = profile_dir
+        self.cookies = None
+
+        self._primary = None
+        self._work = queue.Queue()
+        self._results = queue.Queue()
+        self._threads = []
+
+    def login(self, username, password, store=None):
+        self._primary = ArtistWorkScraper(fetch_extras=self.fetch_extras, use_firefox=self.use_firefox,
+                                          profile_dir=self.profile_dir)
+        restore_or_login(self._primary, store, username, password)
+        self.cookies = self._primary.get_session_cookies()
+        return self._primary
+
+    def _new_scraper(self):
+        scraper = ArtistWorkScraper(fetch_extras=self.fetch_extras, use_firefox=self.use_firefox)
+        scraper.load_session_cookies(self.cookies)
+        return scraper
+
+    @staticmethod
+    def _discard(scraper):
+        if scraper is not None:
+            with contextlib.suppress(Exception):
+                scraper.quit()
+
+    @staticmethod
+    def _scrape_item(scraper, kind, item_id, context):
+        with metrics.timed('scrape_{}_seconds'.format(kind)):
+            if kind == LESSON:
+                return scraper.get_lesson_by_id(item_id)
+            return scraper.get_masterclass_by_id(item_id, lesson_name=context)
+
+    def _worker(self, index):
+        scraper = None
+        while True:
+            item = self._work.get()
+            if item is None:
+                break
+
+            kind, item_id, context, attempt = item
+            try:
+                if scraper is None:
+                    logger.debug('starting browser for worker {}'.format(index))
+                    scraper = self._new_scraper()
+                result = self._scrape_item(scraper, kind, item_id, context)
+            except Exception as e:
+                logger.exception(e)
+                logger.error('worker {} crashed on {} {}, restarting its browser'.format(index, kind, item_id))
+                self._discard(scraper)
+                scraper = None
+                if attempt + 1 < MAX_SCRAPE_RETRIES:
+                    self._work.put((kind, item_id, context, attempt + 1))
+                    continue
+                logger.error('giving up on {} {} after {} attempts'.format(kind, item_id, attempt + 1))
+                result = None
+
+            self._results.put((kind, item_id, result))
+
+        if scraper is not None:
+            scraper.exit()
+
+    def _start(self):
+        for index in range(self.workers):
+            # every worker starts a browser of its own with the cookies of the logged in one, which is kept
+            thread = threading.Thread(target=self._worker, args=(index,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _stop(self):
+        for _ in self._threads:
+            self._work.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def scrape(self, lesson_ids, lessons_db, masterclasses_db, fetch_masterclasses=False):
+        queued = set()
+        pending = 0
+
+        def enqueue(kind, item_id, context=None):
+            nonlocal pending
+            if (kind, item_id) in queued:
+                return
+            queued.add((kind, item_id))
+            self._work.put((kind, item_id, context, 0))
+            pending += 1
+
+        def enqueue_masterclasses(lesson):
+            for masterclass_id in lesson.masterclass_ids:
+                if masterclass_id not in masterclasses_db:
+                    enqueue(MASTERCLASS, masterclass_id, lesson.name)
+
+        for lesson_id in lesson_ids:
+            if lesson_id not in lessons_db:
+                enqueue(LESSON, lesson_id)
+            elif fetch_masterclasses:
+                enqueue_masterclasses(lessons_db[lesson_id])
+
+        logger.info('scraping {} items with {} workers'.format(pending, self.workers))
+        self._start()
+        try:
+            while pending:
+                kind, item_id, result = self._results.get()
+                pending -= 1
+                if result is None:
+                    continue
+
+                if kind == LESSON:
+                    lessons_db[item_id] = result
+                    if fetch_masterclasses:
+                        enqueue_masterclasses(result)
+                else:
+                    masterclasses_db[item_id] = result
+        finally:
+            self._stop()
+
+    def exit(self):
+        self._stop()
+        if self._primary is not None:
+            self._primary.exit()
+            self._primary = None
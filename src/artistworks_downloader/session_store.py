@@ -0,0 +1,109 @@
+from __future__ import unicode_literals, absolute_import
+
+import contextlib
+import json
+import os
+import time
+from urllib.parse import urljoin, urlparse
+
+import logbook
+
+from .constants import ARTISTWORKS_LOGIN, SESSION_FILE_NAME, SESSION_PROFILE_DIRECTORY, LOGGED_IN_MARKER, \
+    SESSION_CHECK_TIMEOUT
+from .metrics import metrics
+
+logger = logbook.Logger(__name__)
+
+
+def cookies_for(url, cookies):
+    """
+    name --> value of the selenium cookies the browser would send to url
+    """
+    host = urlparse(url).hostname
+    sent = {}
+    for cookie in cookies:
+        domain = cookie.get('domain', '').lstrip('.')
+        if not domain or host == domain or host.endswith('.' + domain):
+            sent[cookie['name']] = cookie['value']
+    return sent
+
+
+class SessionStore(object):
+    """
+    The cookies of a logged in browser, kept in directory between runs (and processes) so they can skip the login
+    form, along with the browser profile directory a single browser may keep its own state in.
+    One account per directory, a session saved for another username is never restored.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, SESSION_FILE_NAME)
+        self.profile_dir = os.path.join(directory, SESSION_PROFILE_DIRECTORY)
+
+    def load(self, username=None):
+        """
+        The saved cookies (of username, if given) without the expired ones, None when there is no usable session
+        """
+        try:
+            with open(self.path) as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if username is not None and session.get('username') != username:
+            return None
+
+        now = time.time()
+        cookies = [cookie for cookie in session.get('cookies', []) if cookie.get('expiry', now + 1) > now]
+        return cookies or None
+
+    def save(self, username, cookies):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        # the cookies log in as the user, only they may read them
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'username': username, 'saved_at': time.time(), 'cookies': cookies}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        with contextlib.suppress(OSError):
+            os.remove(self.path)
+
+    @staticmethod
+    def is_valid(cookies, timeout=SESSION_CHECK_TIMEOUT):
+        """
+        Whether cookies are still logged in, from a single request for the home page (which shows the user block
+        only to logged in users)
+        """
+        import requests
+
+        url = urljoin(ARTISTWORKS_LOGIN, '/')
+        try:
+            response = requests.get(url, cookies=cookies_for(url, cookies), timeout=timeout)
+        except requests.RequestException as e:
+            logger.warning('could not check the saved session: {}'.format(e))
+            return False
+        return response.ok and LOGGED_IN_MARKER in response.text
+
+
+def restore_or_login(scraper, store, username, password):
+    """
+    Hands scraper the session saved by an earlier run if it is still valid, logs it in (and saves its new session)
+    otherwise. Returns whether the saved session was used
+    """
+    if store is not None:
+        cookies = store.load(username)
+        if cookies and store.is_valid(cookies):
+            logger.info('Restored the saved session of {}'.format(username))
+            scraper.restore_session(cookies)
+            metrics.increment('sessions_restored_total')
+            return True
+
+    logged_in = scraper.login_to_artistworks(username=username, password=password)
+    metrics.increment('browser_logins_total')
+    if store is not None:
+        if logged_in:
+            store.save(username, scraper.get_session_cookies())
+        else:
+            store.clear()
+    return False
@@ -0,0 +1,121 @@
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+
+import logbook
+
+from .constants import ARTISTWORKS_LESSON_BASE, ARTISTWORKS_DEPARTMENT_BASE
+from .exceptions import PageParseException
+from .webdriver import parse_masterclass_ids, parse_department_lessons
+
+logger = logbook.Logger(__name__)
+
+
+class SyncSummary(object):
+    def __init__(self, department_name, lessons):
+        self.department_name = department_name
+        # the department's lessons table, lesson id --> name
+        self.lessons = lessons
+        self.new = []
+        self.changed = []
+        self.removed = []
+        self.unchanged = []
+        self.failed = []
+
+    def __str__(self):
+        lines = ['Sync of {}: {} new, {} changed, {} removed, {} unchanged lessons'.format(
+            self.department_name, len(self.new), len(self.changed), len(self.removed), len(self.unchanged))]
+        for title, lesson_ids in (('new', self.new), ('changed', self.changed), ('removed', self.removed),
+                                  ('failed to check', self.failed)):
+            for lesson_id in lesson_ids:
+                lines.append('  {} {}. {}'.format(title, lesson_id, self.lessons.get(lesson_id, '')))
+        return '\r\n'.join(lines)
+
+
+class DepartmentSync(object):
+    """
+    Brings the manifest of an already scraped department up to date, using conditional requests so pages that
+    didn't change since the last run cost a 304. New lessons are only listed here, they are scraped like in any run.
+    Stored lessons whose masterclass list changed are scraped again from the page that was just fetched.
+    """
+
+    def __init__(self, http_scraper, manifest, department_name):
+        self.http = http_scraper
+        self.manifest = manifest
+        self.department_name = department_name
+        self.lessons_db = manifest.lessons(department_name)
+
+    @asyncio.coroutine
+    def _get_page_if_modified(self, url):
+        page = yield from self.http.get_page_if_modified(url, *self.manifest.page_validators(url))
+        if page is None:
+            return None
+        soup, content, etag, last_modified = page
+        # validators are stored by the caller, only once the page was handled
+        return soup, content, lambda: self.manifest.set_page_validators(url, etag, last_modified)
+
+    @asyncio.coroutine
+    def _department_lessons(self, department_number):
+        page = yield from self._get_page_if_modified(ARTISTWORKS_DEPARTMENT_BASE + str(department_number))
+        stored = self.manifest.department_lessons(self.department_name)
+        if page is None and stored:
+            logger.info('lessons table of {} did not change'.format(self.department_name))
+            return stored
+
+        if page is None:
+            # validators without a stored table, fetch it again
+            lessons = yield from self.http._get_all_lesson_ids_for_department(department_number)
+        else:
+            soup, _, store_validators = page
+            if soup.find('div', id='media-group-table') is None:
+                raise PageParseException('no lessons table found for department {}'.format(department_number))
+            lessons = parse_department_lessons(soup)
+            if not lessons:
+                raise PageParseException('empty lessons table for department {}'.format(department_number))
+            store_validators()
+        return lessons
+
+    @asyncio.coroutine
+    def _check_lesson(self, lesson_id, summary):
+        try:
+            page = yield from self._get_page_if_modified(ARTISTWORKS_LESSON_BASE + str(lesson_id))
+            if page is None:
+                summary.unchanged.append(lesson_id)
+                return
+
+            soup, content, store_validators = page
+            stored = self.lessons_db[lesson_id]
+            if list(map(str, stored.masterclass_ids)) == parse_masterclass_ids(soup):
+                summary.unchanged.append(lesson_id)
+            else:
+                logger.info('masterclasses of lesson {} changed, scraping it again'.format(lesson_id))
+                self.lessons_db[lesson_id] = yield from self.http._with_fallback(
+                    'lesson {}'.format(lesson_id), self.http.lesson_from_page(lesson_id, soup, content),
+                    self.http.fallback.get_lesson_by_id, lesson_id)
+                summary.changed.append(lesson_id)
+            store_validators()
+        except Exception as e:
+            logger.exception(e)
+            logger.error('failed to check lesson {}'.format(lesson_id))
+            summary.failed.append(lesson_id)
+
+    @asyncio.coroutine
+    def _sync(self, department_number):
+        lessons = yield from self.http._with_fallback(
+            'department {}'.format(department_number), self._department_lessons(department_number),
+            self.http.fallback.get_all_lesson_ids_for_department, department_number)
+
+        summary = SyncSummary(self.department_name, lessons)
+        stored = set(self.lessons_db)
+        summary.new = [lesson_id for lesson_id in lessons if lesson_id not in stored]
+        summary.removed = sorted(stored.difference(lessons))
+
+        existing = [lesson_id for lesson_id in lessons if lesson_id in stored]
+        if existing:
+            yield from asyncio.gather(*[self._check_lesson(lesson_id, summary) for lesson_id in existing])
+        return summary
+
+    def run(self, department_number):
+        summary = self.http.loop.run_until_complete(self._sync(department_number))
+        self.manifest.flush()
+        return summary
@@ -1,67 +1,202 @@
 from __future__ import unicode_literals, absolute_import, print_function
-from contextlib import suppress
+from concurrent.futures import ProcessPoolExecutor
 
+import contextlib
 import os
-import itertools
+import re
+import shutil
 import subprocess
+import time
 
 import logbook
 
-from artistworks_downloader.constants import LOG_PATH
+from artistworks_downloader.metrics import metrics
 
 __author__ = 'Omer'
 
 logger = logbook.Logger(__name__)
-logger.handlers.append(logbook.FileHandler(LOG_PATH, bubble=True, level=logbook.DEBUG))
-logger.handlers.append(logbook.StderrHandler())
 
+# path/blah_part0.ts --> ('blah', '0', 'ts')
+PART_RE = re.compile(r'^(?P<group>.+)_part(?P<index>\d+)\.(?P<ext>\w+)$')
 
-def unite_ts_videos(folder, delete_original=True):
-    for r, d, files in os.walk(folder):
-        it = itertools.groupby(sorted(files), lambda x: x.split('_part')[0])
-        for group, file_list in it:
 
-            file_list = list(file_list)  # don't exhaust iterator
-            logger.debug('Group {} contains {} parts'.format(group, len(file_list)))
-            if len(file_list) == 1:
-                logger.debug('{} does not require processing'.format(group))
-                continue
+class PartGroup(object):
+    def __init__(self, folder, name, ext):
+        self.folder = folder
+        self.name = name
+        self.ext = ext
+        self.parts = {}
 
-            file_paths = [os.path.join(r, f) for f in file_list]
-            file_list_path = os.path.join(r, group + '_file_list.txt')
+    @property
+    def output_path(self):
+        return os.path.join(self.folder, self.name + '.mp4')
 
-            # check no parts are missing! (from 0-max)
-            # path/blah_part0.ts --> 0
-            key_func = lambda x: int(x.split('_part')[1].split('.')[0])
+    @property
+    def part_paths(self):
+        return [os.path.join(self.folder, self.parts[index]) for index in sorted(self.parts)]
 
-            try:
-                highest_part_no = key_func(max(file_paths, key=key_func))
-            except ValueError as e:
-                # example my_video_part_2.mp4 would throw exception on conversion to int
-                logger.exception(e)
-                continue
+    @property
+    def complete(self):
+        # no parts are missing (from 0-max)
+        return len(self.parts) == max(self.parts) + 1
 
-            if len(file_paths) != (highest_part_no + 1):
-                logger.error('Found missing parts! not uniting!')
-                return
+    def up_to_date(self):
+        try:
+            output_mtime = os.path.getmtime(self.output_path)
+        except OSError:
+            return False
+        return output_mtime >= max(os.path.getmtime(path) for path in self.part_paths)
 
-            output_path = os.path.join(r, group + '.mp4')
-            with open(file_list_path, 'w') as l:
-                for f in sorted(file_paths, key=key_func):
-                    print("file {}".format(repr(f)), file=l)
-                    l.write('\r\n')
 
-            logger.debug('Calling ffmpeg on file in {} , output {}'.format(file_list_path, output_path))
+def find_part_groups(folder):
+    """
+    Finds every group of video parts under folder, in a single walk of the tree
+    """
+    groups = []
+    for r, d, files in os.walk(folder):
+        folder_groups = {}
+        for f in files:
+            match = PART_RE.match(f)
+            if not match:
+                continue
+            key = (match.group('group'), match.group('ext'))
+            if key not in folder_groups:
+                folder_groups[key] = PartGroup(r, *key)
+            folder_groups[key].parts[int(match.group('index'))] = f
+        groups.extend(folder_groups.values())
+    return groups
+
+
+def copy_into(source_path, destination):
+    """
+    Appends a whole file to an open destination, inside the kernel when it allows it
+    """
+    destination.flush()
+    start = destination.tell()
+    with open(source_path, 'rb') as source:
+        size = os.fstat(source.fileno()).st_size
+        for zero_copy in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, zero_copy):
+                continue
             try:
-                subprocess.check_call(
-                    ['ffmpeg', '-f', 'concat', '-i', file_list_path, '-bsf:a', 'aac_adtstoasc', '-c', 'copy',
-                     output_path])
-            except subprocess.CalledProcessError as e:
+                copied = 0
+                while copied < size:
+                    if zero_copy == 'copy_file_range':
+                        sent = os.copy_file_range(source.fileno(), destination.fileno(), size - copied)
+                    else:
+                        sent = os.sendfile(destination.fileno(), source.fileno(), None, size - copied)
+                    if not sent:
+                        raise OSError('short copy of {}'.format(source_path))
+                    copied += sent
+                destination.seek(start + size)
+                return
+            except OSError:
+                # not supported between these filesystems, start over with the next method
+                source.seek(0)
+                destination.seek(start)
+                destination.truncate()
+
+        shutil.copyfileobj(source, destination, 1024 * 1024)
+
+
+def _write_concat(input_path, part_paths):
+    with open(input_path, 'wb') as concatenated:
+        for f in part_paths:
+            copy_into(f, concatenated)
+
+
+def _write_file_list(input_path, part_paths):
+    with open(input_path, 'w') as l:
+        for f in part_paths:
+            print("file {}".format(repr(f)), file=l)
+            l.write('\r\n')
+
+
+def unite_group(folder, name, ext, part_paths, delete_original=True, fast_concat=True):
+    output_path = os.path.join(folder, name + '.mp4')
+
+    if fast_concat and ext == 'ts':
+        # mpeg-ts parts can simply be appended to each other, leaving ffmpeg a single remux
+        input_path = os.path.join(folder, name + '_concat.ts')
+        write_input = _write_concat
+        command = ['ffmpeg', '-y', '-i', input_path, '-bsf:a', 'aac_adtstoasc', '-c', 'copy', output_path]
+    else:
+        input_path = os.path.join(folder, name + '_file_list.txt')
+        write_input = _write_file_list
+        command = ['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', input_path, '-bsf:a', 'aac_adtstoasc',
+                   '-c', 'copy', output_path]
+
+    try:
+        # a concatenation failing halfway (a full disk, an unreadable part) isn't left beside the parts either
+        write_input(input_path, part_paths)
+        logger.debug('Calling ffmpeg on {} , output {}'.format(input_path, output_path))
+        start = time.monotonic()
+        try:
+            subprocess.check_call(command)
+        except subprocess.CalledProcessError as e:
+            logger.exception(e)
+            return None
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(input_path)
+    elapsed = time.monotonic() - start
+
+    if delete_original:
+        for f in part_paths:
+            os.remove(f)
+
+    return elapsed
+
+
+def _record_united(manifest, job, elapsed):
+    if elapsed is None:
+        metrics.increment('unite_failures_total')
+        return
+    metrics.observe('ffmpeg_seconds', elapsed)
+    metrics.increment('videos_united_total')
+
+    if manifest:
+        folder, name, _, part_paths = job[:4]
+        output_path = os.path.join(folder, name + '.mp4')
+        stat = os.stat(output_path)
+        manifest.parts_united(part_paths, output_path, size=stat.st_size, mtime=stat.st_mtime)
+
+
+def unite_ts_videos(folder, delete_original=True, workers=None, fast_concat=True, manifest=None):
+    """
+    Unites every group of video parts under folder into a single mp4. Groups with missing parts, or whose mp4 is
+    already newer than all of their parts, are skipped. Remuxing runs on up to workers processes (one per core
+    by default), united videos are recorded in the manifest from this process.
+    """
+    jobs = []
+    for group in find_part_groups(folder):
+        logger.debug('Group {} contains {} parts'.format(group.name, len(group.parts)))
+        if len(group.parts) == 1:
+            logger.debug('{} does not require processing'.format(group.name))
+            continue
+
+        if not group.complete:
+            logger.error('Found missing parts in {}! not uniting it!'.format(group.name))
+            continue
+
+        if group.up_to_date():
+            logger.debug('{} is already united'.format(group.name))
+            continue
+
+        jobs.append((group.folder, group.name, group.ext, group.part_paths, delete_original, fast_concat))
+
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        for job in jobs:
+            _record_united(manifest, job, unite_group(*job))
+        return len(jobs)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(unite_group, *job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                _record_united(manifest, job, future.result())
+            except Exception as e:
                 logger.exception(e)
-                delete_original = False
-
-            os.remove(file_list_path)
 
-            if delete_original:
-                for f in file_paths:
-                    os.remove(f)
\ No newline at end of file
+    return len(jobs)
@@ -1,94 +1,528 @@
 from __future__ import unicode_literals, absolute_import
 
+import collections
 import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import os
 import asyncio
 from pathlib import Path
 import re
 
-import aiohttp
 import logbook
-import tqdm
 
-from .constants import MAX_CONCURRENT_DOWNLOADS, LOG_PATH, MAX_RETRIES, RETRY_DURATION
+from .constants import MAX_RETRIES, HTTP_CONNECT_TIMEOUT, \
+    HTTP_READ_TIMEOUT, HTTP_CONNECTION_LIMIT_PER_HOST, DOWNLOAD_SEGMENTS, SEGMENTED_DOWNLOAD_THRESHOLD, \
+    WRITE_BUFFER_SIZE, WRITE_BUFFERS, DISK_WRITER_THREADS, HLS_WINDOW, HLS_SEGMENT_RETRIES, COUNT_BUCKETS, \
+    HASH_BLOCK_SIZE, PROGRESS_SAVE_INTERVAL, MP4, MAX_RESOLUTION
+from .hls import TsSink, FfmpegSink, PlaylistResolver
+from .dedup import DedupStats, normalize_url, link_file, BY_URL, BY_HASH
+from .integrity import ContentHash
+from .manifest import DONE, UNITED
+from .metrics import metrics
+from .http_session import create_session
+from .partial import PartialDownload, PART_SUFFIX
+from .scheduler import DownloadScheduler
+from .writer import AdaptiveChunkSize, BufferPool, FileWriter, open_for_positioned_writes, preallocate
 
 logger = logbook.Logger(__name__)
-logger.handlers.append(logbook.FileHandler(LOG_PATH, bubble=True, level=logbook.DEBUG))
-logger.handlers.append(logbook.StderrHandler())
 
 
 class AsyncDownloader(object):
-    def __init__(self, loop=asyncio.get_event_loop()):
+    def __init__(self, loop=asyncio.get_event_loop(), connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT, connection_limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+                 segments=DOWNLOAD_SEGMENTS, segment_threshold=SEGMENTED_DOWNLOAD_THRESHOLD,
+                 save_interval=PROGRESS_SAVE_INTERVAL, preallocate=False,
+                 hls_format=None, hls_window=HLS_WINDOW, rendition_policy=MAX_RESOLUTION, max_height=None,
+                 manifest=None, scheduler=None, max_retries=MAX_RETRIES, dedup=True, cookies=None):
         self.loop = loop
         self.busy = set()
         self.done = {}
         self.tasks = set()
 
-        self.sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+        # concurrency, per host rates and retry backoff
+        self.scheduler = scheduler or DownloadScheduler(loop)
+        self.max_retries = max_retries
+
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connection_limit_per_host = connection_limit_per_host
+        # of a logged in browser, for media only served to the user
+        self.cookies = cookies
+        self._session = None
+
+        # files of at least segment_threshold bytes are fetched as this many concurrent byte ranges
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        # the progress of a download is saved every save_interval bytes it (or one of its ranges) received
+        self.save_interval = save_interval
+
+        # disk writes happen off the loop, through a bounded set of reusable buffers
+        self.preallocate = preallocate
+        self.buffers = BufferPool(WRITE_BUFFERS, WRITE_BUFFER_SIZE)
+        self.disk = ThreadPoolExecutor(max_workers=DISK_WRITER_THREADS)
+
+        # with an hls_format, playlist links are streamed segment after segment into a single .ts or
+        # (through ffmpeg) .mp4 file, otherwise each segment is downloaded as a part, to be united later
+        self.hls_format = hls_format
+        self.hls_window = hls_window
+
+        # download state is kept in the manifest, finished downloads are known without checking the disk
+        self.manifest = manifest
+        self._statuses = None
+
+        # an asset linked from several lessons is downloaded once, see _deduplicated
+        self.dedup = dedup
+        self.dedup_stats = DedupStats()
+        self._sources = {}
+
+        self.playlists = PlaylistResolver(self._get_playlist, loop, policy=rendition_policy, max_height=max_height,
+                                          manifest=manifest)
+
+    @property
+    def session(self):
+        # created lazily, from within the loop, and shared by every download and retry
+        if self._session is None:
+            self._session = create_session(self.loop,
+                                           cookies=self.cookies,
+                                           limit_per_host=self.connection_limit_per_host,
+                                           connect_timeout=self.connect_timeout,
+                                           read_timeout=self.read_timeout)
+        return self._session
+
+    def _writer(self, fd):
+        return FileWriter(fd, self.buffers, self.disk, self.loop)
+
+    def _received(self, path, count):
+        self.scheduler.record_bytes(count)
+        metrics.file_progress(path, count)
 
     @asyncio.coroutine
-    def async_download_video(self, video_url, chunk_size=1024, folder=r'C:\Temp', filename='', retry_count=0):
-        if retry_count > 0:
-            logger.info('going to retry {} for the {} time'.format(video_url, retry_count + 1))
+    def _read_stream(self, vid, writer, offset, partial, hasher):
+        chunk_size = AdaptiveChunkSize()
+        try:
+            while True:
+                chunk = yield from vid.content.read(chunk_size.size)
+                if not chunk:
+                    break
+                chunk_size.update(len(chunk))
+                self._received(partial.path, len(chunk))
+                hasher.update(offset, chunk)
+                yield from writer.write(chunk, offset)
+                offset += len(chunk)
+                if offset - partial.written >= self.save_interval:
+                    # partial.written only counts bytes already on disk, like the ranges of _read_segment
+                    yield from writer.flush()
+                    partial.written = offset
+                    partial.save()
+        finally:
+            yield from writer.close()
+            partial.written = offset
 
-        with aiohttp.ClientSession(loop=self.loop) as session, (yield from self.sem):
+    @asyncio.coroutine
+    def _read_segment(self, vid, writer, segment, partial, hasher):
+        start, end, received = segment
+        size = end - start + 1
+        chunk_size = AdaptiveChunkSize()
+        try:
+            while received < size:
+                chunk = yield from vid.content.read(min(chunk_size.size, size - received))
+                if not chunk:
+                    break
+                chunk_size.update(len(chunk))
+                self._received(partial.path, len(chunk))
+                hasher.update(start + received, chunk)
+                yield from writer.write(chunk, start + received)
+                received += len(chunk)
+                if received - segment[2] >= self.save_interval:
+                    # segment[2] only counts bytes already on disk, so the sidecar is never ahead of the part file
+                    yield from writer.flush()
+                    segment[2] = received
+                    partial.save()
+        finally:
+            yield from writer.close()
+            segment[2] = received
+
+        if segment[2] != size:
+            raise IOError('got {} out of {} bytes for range {}-{}'.format(segment[2], size, start, end))
+
+    @asyncio.coroutine
+    def _fetch_segment(self, video_url, fd, partial, segment, hasher):
+        with (yield from self.scheduler.slot(video_url)):
+            headers = {'Range': 'bytes={}-{}'.format(segment[0] + segment[2], segment[1]),
+                       'If-Range': partial.validator}
+            vid = yield from self.session.get(video_url, headers=headers)
+            with contextlib.closing(vid):
+                if vid.status != 206:
+                    # the file changed since the download started, nothing written so far can be trusted
+                    partial.discard()
+                    raise IOError('got status {} for a range of {}'.format(vid.status, video_url))
+                yield from self._read_segment(vid, self._writer(fd), segment, partial, hasher)
+
+    @asyncio.coroutine
+    def _wait_for_segments(self, partial, fd, tasks):
+        try:
+            if tasks:
+                yield from asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                yield from asyncio.wait(tasks)
+            os.close(fd)
+            # ranges also save their progress as they go, this one counts what they flushed since
+            if os.path.exists(partial.part_path):
+                partial.save()
+
+    def _start_segments(self, video_url, partial, fd, segments, hasher):
+        return [asyncio.Task(self._fetch_segment(video_url, fd, partial, segment, hasher)) for segment in segments]
+
+    def _plan_segments(self, response, partial, offset):
+        if offset or partial.length is None or partial.validator is None:
+            return []
+        if (self.segments > 1 and partial.length >= self.segment_threshold and
+                response.headers.get('Accept-Ranges', '').lower() == 'bytes'):
+            # ranges start on hash block boundaries, so each of them can be hashed as it streams
+            return partial.plan_segments(self.segments, align=HASH_BLOCK_SIZE)
+        if self.preallocate:
+            # a single range still tracks its progress, the size of a preallocated file says nothing about it
+            return partial.plan_segments(1)
+        return []
+
+    @staticmethod
+    def _resumed_hash(partial):
+        # only blocks whose data is known to be on disk are kept from the sidecar
+        hasher = ContentHash(blocks=partial.hashes)
+        hasher.retain(partial.written_ranges)
+        return hasher
+
+    @asyncio.coroutine
+    def _complete(self, partial, hasher, video_url):
+        """
+        Checks the length of a finished download against the response headers, returns its hash
+        """
+        if partial.length is not None and partial.offset != partial.length:
+            raise IOError('got {} out of {} bytes for {}'.format(partial.offset, partial.length, video_url))
+
+        # blocks that weren't streamed whole (a resumed range) are read back on a writer thread
+        digest = yield from self.loop.run_in_executor(self.disk, hasher.finish, partial.part_path, partial.offset)
+        partial.complete()
+        return digest
+
+    @asyncio.coroutine
+    def _download_to_file(self, video_url, path):
+        partial = PartialDownload(path)
+        partial.load()
+
+        if partial.segments and partial.url == video_url:
+            logger.info('resuming {} in {} segments'.format(video_url, len(partial.pending_segments)))
+            metrics.file_started(path, os.path.basename(path), partial.length,
+                                 initial=sum(segment[2] for segment in partial.segments))
+            hasher = self._resumed_hash(partial)
+            fd = open_for_positioned_writes(partial.part_path)
+            yield from self._wait_for_segments(
+                partial, fd, self._start_segments(video_url, partial, fd, partial.pending_segments, hasher))
+            return (yield from self._complete(partial, hasher, video_url))
+
+        tasks, fd = [], None
+        with (yield from self.scheduler.slot(video_url)):
+            vid = yield from self.session.get(video_url, headers=partial.resume_headers(video_url))
+            with contextlib.closing(vid):
+                if vid.status not in (200, 206):
+                    raise IOError('got status {} for {}'.format(vid.status, video_url))
+
+                offset = partial.update_from_response(video_url, vid)
+                metrics.file_started(path, os.path.basename(path), partial.length, initial=offset)
+                partial.segments = self._plan_segments(vid, partial, offset)
+                hasher = self._resumed_hash(partial) if offset else ContentHash()
+                partial.hashes = hasher.blocks
+                partial.written = offset
+                partial.save()
+
+                if partial.segments:
+                    # this response serves the first range, the others get their own requests (and slots)
+                    first, *others = partial.segments
+                    if others:
+                        logger.info('downloading {} in {} segments'.format(video_url, len(partial.segments)))
+                    fd = open_for_positioned_writes(partial.part_path, truncate=True)
+                    preallocate(fd, partial.length)
+                    tasks = self._start_segments(video_url, partial, fd, others, hasher)
+                    try:
+                        yield from self._read_segment(vid, self._writer(fd), first, partial, hasher)
+                    except Exception:
+                        yield from self._wait_for_segments(partial, fd, tasks)
+                        raise
+                else:
+                    if offset:
+                        logger.info('resuming {} from byte {}'.format(video_url, offset))
+                    stream_fd = open_for_positioned_writes(partial.part_path)
+                    try:
+                        os.ftruncate(stream_fd, offset)
+                        yield from self._read_stream(vid, self._writer(stream_fd), offset, partial, hasher)
+                    except Exception:
+                        # keeps the hashes of the blocks received, a resumed stream won't read them back
+                        partial.save()
+                        raise
+                    finally:
+                        os.close(stream_fd)
+
+        if fd is not None:
+            yield from self._wait_for_segments(partial, fd, tasks)
+
+        return (yield from self._complete(partial, hasher, video_url))
+
+    @asyncio.coroutine
+    def _get_playlist(self, playlist_url):
+        with (yield from self.scheduler.slot(playlist_url)):
+            response = yield from self.session.get(playlist_url)
+            with contextlib.closing(response):
+                if response.status != 200:
+                    raise IOError('got status {} for {}'.format(response.status, playlist_url))
+                return (yield from response.text())
+
+    @asyncio.coroutine
+    def _fetch_hls_segment(self, segment_url):
+        # segments are retried on their own, one bad segment shouldn't restart the whole stream
+        for attempt in range(HLS_SEGMENT_RETRIES):
             try:
-                vid = yield from session.get(video_url)
-                if not filename:
-                    filename = video_url.split('/')[-1]
+                with (yield from self.scheduler.slot(segment_url)):
+                    vid = yield from self.session.get(segment_url)
+                    with contextlib.closing(vid):
+                        if vid.status != 200:
+                            raise IOError('got status {} for {}'.format(vid.status, segment_url))
+                        data = yield from vid.read()
+                        content_length = vid.headers.get('Content-Length')
+                        if content_length and len(data) != int(content_length):
+                            raise IOError('got {} out of {} bytes for {}'.format(len(data), content_length,
+                                                                                segment_url))
+                        self.scheduler.record_bytes(len(data))
+                        return data
             except Exception:
+                if attempt + 1 == HLS_SEGMENT_RETRIES:
+                    raise
+                logger.debug('failed fetching segment {}, retrying'.format(segment_url))
+                yield from asyncio.sleep(self.scheduler.backoff(attempt))
 
-                logger.error('Error trying to read url {}'.format(video_url))
-                if retry_count >= MAX_RETRIES:
+    def _hls_sink(self, path, part_path):
+        # the format follows the file name, a file queued again keeps the format it was downloaded in
+        if os.path.splitext(path)[1] == '.' + MP4:
+            return FfmpegSink(part_path, self.loop)
+        return TsSink(part_path, self._writer)
+
+    @asyncio.coroutine
+    def _download_hls(self, playlist_url, path):
+        segment_urls = yield from self.playlists.resolve(playlist_url)
+        logger.info('streaming {} segments of {} into {}'.format(len(segment_urls), playlist_url, path))
+
+        part_path = path + PART_SUFFIX
+        sink = self._hls_sink(path, part_path)
+        # the segments of a transport stream are the file itself, ffmpeg's output is only hashed by verify
+        hasher = ContentHash() if isinstance(sink, TsSink) else None
+        metrics.file_started(path, os.path.basename(path))
+
+        @asyncio.coroutine
+        def write_next():
+            data = yield from pending.popleft()
+            metrics.file_progress(path, len(data))
+            if hasher:
+                hasher.update(sink.offset, data)
+            yield from sink.write(data)
+
+        # at most hls_window segments are in flight or waiting for their turn in memory
+        pending = collections.deque()
+        try:
+            for segment_url in segment_urls:
+                if len(pending) >= self.hls_window:
+                    yield from write_next()
+                pending.append(asyncio.Task(self._fetch_hls_segment(segment_url)))
+
+            while pending:
+                yield from write_next()
+        except Exception:
+            for task in pending:
+                task.cancel()
+            with contextlib.suppress(Exception):
+                yield from sink.abort()
+            with contextlib.suppress(OSError):
+                os.remove(part_path)
+            raise
+
+        yield from sink.close()
+        digest = None
+        if hasher:
+            digest = yield from self.loop.run_in_executor(self.disk, hasher.finish, part_path, sink.offset)
+        os.replace(part_path, path)
+        return digest
+
+    @asyncio.coroutine
+    def _retrying(self, url, path, download, retry_count=0):
+        while True:
+            if retry_count > 0:
+                logger.info('going to retry {} for the {} time'.format(url, retry_count + 1))
+
+            if self.manifest and path:
+                self.manifest.download_started(path, url)
+            try:
+                result = yield from download()
+                break
+            except Exception as e:
+                logger.error('Error while downloading {}'.format(url))
+                if self.manifest and path:
+                    self.manifest.download_failed(path, e)
+                if retry_count >= self.max_retries:
                     logger.exception('Max retries reached, exiting!')
+                    metrics.increment('download_failures_total')
                     raise
+                metrics.increment('download_retries_total')
 
-                logger.error('Failure trying to download from {}, going to retry later..'.format(video_url))
-                logger.debug('sleeping for {}'.format(RETRY_DURATION))
-                yield from asyncio.sleep(RETRY_DURATION)
-                task = asyncio.Task(self.async_download_video(video_url=video_url,
-                                                              folder=str(folder),
-                                                              filename=filename,
-                                                              retry_count=retry_count+1))
-                task.add_done_callback(self.tasks.remove)
-                self.tasks.add(task)
-                self.sem.release()
-                return
-
-            with open(os.path.join(folder, filename), 'wb') as fd, contextlib.closing(vid):
-                while True:
-                    try:
-                        chunk = yield from vid.content.read(chunk_size)
-                    except Exception:
+                logger.error('Failure trying to download from {}, going to resume later..'.format(url))
+                # outside of any download slot, others keep downloading in the meantime
+                delay = self.scheduler.backoff(retry_count)
+                logger.debug('sleeping for {:.1f}'.format(delay))
+                yield from asyncio.sleep(delay)
+                retry_count += 1
+
+        if self.manifest and path:
+            # downloads return the hash of the file
+            stat = os.stat(path)
+            self.manifest.download_finished(path, size=stat.st_size, url=url, sha256=result, mtime=stat.st_mtime)
+        return result
+
+    @asyncio.coroutine
+    def _materialize(self, copy, path, url, reason):
+        source_path, sha256 = copy
+        method = yield from self.loop.run_in_executor(self.disk, link_file, source_path, path)
+        stat = os.stat(path)
+        logger.info('{} is the same as {}, made a {} of it'.format(path, source_path, method))
+
+        self.dedup_stats.record(reason, method, stat.st_size)
+        metrics.increment('dedup_{}_total'.format(method))
+        metrics.increment('dedup_bytes_total', stat.st_size)
+        if self.manifest:
+            self.manifest.download_finished(path, size=stat.st_size, url=url, sha256=sha256, mtime=stat.st_mtime)
+
+    @asyncio.coroutine
+    def _deduplicated(self, url, path, download):
+        """
+        Runs download() (which returns the hash of the file) for the first path of an asset. Later paths of
+        the same source url, in this run or an earlier one, are linked to its file instead of being downloaded,
+        and a download whose content is already stored under another path is replaced by a link to it.
+        """
+        if not self.dedup:
+            return (yield from download())
+
+        key = (normalize_url(url), os.path.splitext(path)[1])
+        first = self._sources.get(key)
+        if first is not None:
+            # still downloading, wait for it rather than fetching the same bytes twice
+            copy = yield from asyncio.shield(first)
+        else:
+            copy = self.manifest.find_by_source(url, path) if self.manifest else None
+
+        if copy is not None and copy[0] != path:
+            try:
+                yield from self._materialize(copy, path, url, BY_URL)
+                return copy[1]
+            except OSError as e:
+                logger.warning('could not link {} to {}, downloading it: {}'.format(path, copy[0], e))
 
-                        logger.error('Error in midst of reading from stream {}'.format(video_url))
-                        if retry_count >= MAX_RETRIES:
-                            logger.exception('Max retries reached, exiting!')
-                            raise
-
-                        logger.error('Failure trying to download from {}, going to retry later..'.format(video_url))
-                        logger.debug('sleeping for {}'.format(RETRY_DURATION))
-                        yield from asyncio.sleep(RETRY_DURATION)
-                        task = asyncio.Task(self.async_download_video(video_url=video_url,
-                                                                      folder=str(folder),
-                                                                      filename=filename))
-                        task.add_done_callback(self.tasks.remove)
-                        self.tasks.add(task)
-                        self.loop.create_task(self.remove_partial_file(os.path.join(folder, filename)))
-                        self.sem.release()
-                        return
-
-                    if not chunk:
-                        break
-                    fd.write(chunk)
+        future = asyncio.Future(loop=self.loop)
+        self._sources[key] = future
+        try:
+            sha256 = yield from download()
+        except BaseException:
+            # the paths waiting for it try on their own
+            future.set_result(None)
+            if self._sources.get(key) is future:
+                del self._sources[key]
+            raise
 
+        if sha256 and self.manifest:
+            duplicate = self.manifest.find_by_hash(sha256, path)
+            if duplicate is not None:
+                with contextlib.suppress(OSError):
+                    yield from self._materialize(duplicate, path, url, BY_HASH)
+        future.set_result((path, sha256))
+        return sha256
+
+    @asyncio.coroutine
+    def async_download_video(self, video_url, folder=r'C:\Temp', filename='', retry_count=0):
+        if not filename:
+            filename = video_url.split('/')[-1]
+        path = os.path.join(folder, filename)
+
+        try:
+            with metrics.timed('download_file_seconds'):
+                yield from self._deduplicated(video_url, path, lambda: self._retrying(
+                    video_url, path, lambda: self._download_to_file(video_url, path), retry_count))
+        finally:
+            metrics.file_finished(path)
+
+        metrics.increment('downloads_completed_total')
         logger.info('Finished downloading file {}'.format(filename))
         self.done[video_url] = True
+        return [path]
+
+    @asyncio.coroutine
+    def async_download_hls(self, playlist_url, folder, filename, retry_count=0):
+        path = os.path.join(folder, filename)
+
+        try:
+            with metrics.timed('hls_stream_seconds'):
+                yield from self._deduplicated(playlist_url, path, lambda: self._retrying(
+                    playlist_url, path, lambda: self._download_hls(playlist_url, path), retry_count))
+        finally:
+            metrics.file_finished(path)
+
+        metrics.increment('downloads_completed_total')
+        logger.info('Finished streaming file {}'.format(filename))
+        self.done[playlist_url] = True
+        return [path]
 
     @asyncio.coroutine
-    def remove_partial_file(self, file_path):
-        yield
-        os.remove(file_path)
+    def async_download_playlist_parts(self, playlist_url, folder, name, retry_count=0):
+        # resolved on the loop rather than by the scraper, each segment is then downloaded like any other video
+        segment_urls = yield from self._retrying(playlist_url, None, lambda: self.playlists.resolve(playlist_url),
+                                                 retry_count)
+
+        parts, paths = [], []
+        for i, segment_url in enumerate(segment_urls):
+            filename = '{}_part{}.{}'.format(name, i, segment_url.split('?')[0].split('.')[-1])
+            paths.append(os.path.join(folder, filename))
+            # parts united before are gone, the playlist is only downloaded again when its video is
+            if not self.is_downloaded(Path(folder).joinpath(filename), finished=(DONE,)):
+                parts.append(self.async_download_video(video_url=segment_url, folder=folder, filename=filename))
+
+        if parts:
+            yield from asyncio.gather(*parts)
+        self.done[playlist_url] = True
+        return paths
+
+    def is_downloaded(self, path, finished=(DONE, UNITED)):
+        if self.manifest is None:
+            return path.exists()
+
+        if self._statuses is None:
+            self._statuses = self.manifest.download_statuses()
+        status = self._statuses.get(os.path.abspath(str(path)))
+        if status in finished:
+            return True
+
+        # downloaded before the manifest kept track of it. files found corrupt are downloaded again
+        if status is None and path.exists():
+            self.manifest.download_finished(path, size=path.stat().st_size)
+            return True
+        return False
+
+    def link_path(self, link, output_folder_path):
+        """
+        (path link ends up in under output_folder_path, whether it is an HLS playlist)
+        """
+        ext = link.link.split('.')[-1]
+        is_playlist = ext == 'm3u8'
+        if is_playlist:
+            # a playlist downloaded as parts ends up as an mp4 once they are united
+            ext = self.hls_format or MP4
+        return Path(str(output_folder_path)).joinpath(get_valid_filename(link.name) + '.{}'.format(ext)), is_playlist
 
     def download_link(self, link, output_folder_path):
         if not isinstance(output_folder_path, Path):
@@ -97,24 +531,60 @@ class AsyncDownloader(object):
         if not output_folder_path.exists():
             os.makedirs(str(output_folder_path))
 
-        ext = link.link.split('.')[-1]
-        filename = get_valid_filename(link.name) + '.{}'.format(ext)
+        path, is_playlist = self.link_path(link, output_folder_path)
+        filename = path.name
 
-        if output_folder_path.joinpath(filename).exists():
+        if self.is_downloaded(path):
             logger.debug('file {} exists in disk, not downloading'.format(filename))
             return None
 
         logger.debug('going to download {} to folder {}'.format(filename, str(output_folder_path)))
-        task = asyncio.Task(self.async_download_video(video_url=link.link,
-                                                      folder=str(output_folder_path),
-                                                      filename=filename))
+        if is_playlist and self.hls_format:
+            task = asyncio.Task(self.async_download_hls(playlist_url=link.link,
+                                                        folder=str(output_folder_path),
+                                                        filename=filename))
+        elif is_playlist:
+            task = asyncio.Task(self.async_download_playlist_parts(playlist_url=link.link,
+                                                                   folder=str(output_folder_path),
+                                                                   name=get_valid_filename(link.name)))
+        else:
+            task = asyncio.Task(self.async_download_video(video_url=link.link,
+                                                          folder=str(output_folder_path),
+                                                          filename=filename))
         task.add_done_callback(self.tasks.remove)
         self.tasks.add(task)
+        metrics.observe('download_queue_depth', len(self.tasks), buckets=COUNT_BUCKETS)
+        return task
+
+    def requeue(self, path, url):
+        """
+        Downloads a file again, into the same path, from the url it was downloaded from
+        """
+        folder, filename = os.path.split(path)
+        if url.split('?')[0].endswith('.m3u8'):
+            task = asyncio.Task(self.async_download_hls(playlist_url=url, folder=folder, filename=filename))
+        else:
+            task = asyncio.Task(self.async_download_video(video_url=url, folder=folder, filename=filename))
+        task.add_done_callback(self.tasks.remove)
+        self.tasks.add(task)
+        return task
 
     def run(self):
-        if self.tasks:
-            self.loop.run_until_complete(asyncio.wait(self.tasks))
-        return
+        try:
+            if self.tasks:
+                self.loop.run_until_complete(asyncio.wait(self.tasks))
+        finally:
+            self.close()
+
+    def close(self):
+        if self._session is not None:
+            self.loop.run_until_complete(self._session.close())
+            self._session = None
+        self.disk.shutdown()
+        if self.manifest:
+            self.manifest.flush()
+        if self.dedup_stats:
+            logger.info(str(self.dedup_stats))
 
 
 def get_valid_filename(s):
@@ -1,18 +1,18 @@
 from __future__ import unicode_literals, absolute_import
 
-from collections import namedtuple, OrderedDict
+from collections import OrderedDict
 import contextlib
 from enum import Enum
+import os
 import re
 import time
-from urllib.error import URLError
+from urllib.parse import urlparse
 
 import logbook
 from retry import retry
 from bs4 import BeautifulSoup
-import m3u8 as m3u8
 from selenium.common.exceptions import TimeoutException, WebDriverException
-from selenium.webdriver import Chrome, Firefox
+from selenium.webdriver import Chrome, ChromeOptions, Firefox, FirefoxOptions
 from selenium.webdriver.common.by import By
 
 from selenium.webdriver.support.ui import WebDriverWait
@@ -20,24 +20,116 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
 from artistworks_downloader.exceptions import NoElementsException
+from .metrics import metrics
+from .models import Lesson, Masterclass, LessonLink
 from .constants import ARTISTWORKS_LOGIN, ARTISTWORKS_LESSON_BASE, ARTISTWORKS_DEPARTMENT_BASE, \
-    ARTISTWORKS_MASTERCLASS_BASE, LOG_PATH
+    ARTISTWORKS_MASTERCLASS_BASE, LINK_EVENT_TIMEOUT, LINK_POLL_TIMEOUT, LINK_POLL_INITIAL_DELAY, \
+    LINK_POLL_MAX_DELAY
 
 logger = logbook.Logger(__name__)
-logger.handlers.append(logbook.FileHandler(LOG_PATH, bubble=True))
-logger.handlers.append(logbook.StderrHandler())
 
 
-class Lesson(namedtuple('Lesson', field_names=['id', 'name', 'links', 'masterclass_ids'])):
-    pass
+# registers playlistItem/ready/play listeners on every player on the page, events are collected in a global list.
+# supports both the jwplayer 6 (onPlaylistItem) and the jwplayer 7+ (on('playlistItem')) apis.
+# run before every click, events from before it are dropped
+JWPLAYER_EVENT_HOOK = """
+if (window.__awHooked) { window.__awPlayerEvents = []; return true; }
+window.__awPlayerEvents = [];
+for (var id = 0; ; id++) {
+    var player = jwplayer(id);
+    if (!player || !player.getState) { break; }
+    (function (id, player) {
+        ['playlistItem', 'ready', 'play'].forEach(function (type) {
+            var handler = function (e) {
+                window.__awPlayerEvents.push({player: id, type: type, file: e && e.item ? e.item.file : null});
+            };
+            var legacy = 'on' + type.charAt(0).toUpperCase() + type.slice(1);
+            if (player.on) { player.on(type, handler); } else if (player[legacy]) { player[legacy](handler); }
+        });
+    })(id, player);
+}
+window.__awHooked = true;
+return true;
+"""
+
+# pops all pending player events, returns the current playlist file and index of the player which fired last, and
+# whether the playlist item changed. the player is stopped in the same round trip when it did, or when the file
+# differs from the previously found one (arguments[0])
+JWPLAYER_EVENT_POLL = """
+var events = window.__awPlayerEvents || [];
+if (!events.length) { return null; }
+window.__awPlayerEvents = [];
+var last = events[events.length - 1];
+var changed = events.some(function (e) { return e.type === 'playlistItem'; });
+var player = jwplayer(last.player);
+var item = player.getPlaylistItem();
+var file = item ? item['file'] : last.file;
+if (file && (changed || file !== arguments[0])) { player.stop(); }
+return {player: last.player, type: last.type, file: file, changed: changed,
+        index: player.getPlaylistIndex ? player.getPlaylistIndex() : 0};
+"""
+
+# state, current index and whole playlist of every player on the page, in a single round trip.
+# jwplayer(n) for a missing player returns an empty object with only registerPlugin
+JWPLAYER_SNAPSHOT = """
+var players = [];
+for (var id = 0; ; id++) {
+    var player = jwplayer(id);
+    if (!player || !player.getState) { break; }
+    var playlist = (player.getPlaylist && player.getPlaylist()) || [];
+    players.push({
+        id: id,
+        state: player.getState(),
+        index: player.getPlaylistIndex ? player.getPlaylistIndex() : 0,
+        playlist: playlist.map(function (item) {
+            var file = item.file || (item.sources && item.sources.length ? item.sources[0].file : null);
+            return {title: item.title || '', file: file};
+        })
+    });
+}
+return players;
+"""
+
+# returns the current file and playlist index of a player, and stops its playback when either changed since the
+# previously found ones (arguments[1] and [2])
+JWPLAYER_TAKE_FILE = """
+var player = jwplayer(arguments[0]);
+var item = player.getPlaylistItem();
+var file = item ? item['file'] : null;
+var index = player.getPlaylistIndex ? player.getPlaylistIndex() : 0;
+if (file && (file !== arguments[1] || index !== arguments[2])) { player.stop(); }
+return {file: file, index: index};
+"""
+
+
+def parse_page_title(soup):
+    title = soup.select_one('#tabs-wrapper > h2')
+    if title is None:
+        return None
+    # same whitespace normalization selenium applies to element.text
+    return ' '.join(title.get_text().split())
+
+
+def parse_masterclass_ids(soup):
+    return list(map(lambda x: re.findall('\d+', x['href'])[0],
+                    soup.find_all('a', href=re.compile('/masterclass/(\d+)'))))
+
 
+def parse_pdf_links(soup):
+    pdf_links = map(lambda x: x['href'], soup.find_all('a', href=re.compile('.+\.pdf')))
+    return [LessonLink(link.split('/')[-1], link) for link in pdf_links]
 
-class Masterclass(namedtuple('Masterclass', field_names=['id', 'name', 'links'])):
-    pass
 
+def parse_department_lessons(soup):
+    lessons = OrderedDict()
+    elem = soup.find('div', id='media-group-table')
+    links = elem.find_all('a', href=re.compile('/lesson/(\d+)'))
+    for link in links:
+        lesson_id = re.findall('\d+', link['href'])[0]
+        name = link.text
+        lessons[lesson_id] = name
 
-class LessonLink(namedtuple('LessonLink', field_names=['name', 'link'])):
-    pass
+    return lessons
 
 
 class JWPlayerStates(Enum):
@@ -47,13 +139,52 @@ class JWPlayerStates(Enum):
 
 
 class ArtistWorkScraper(object):
-    def __init__(self, fetch_extras=False, use_firefox=False):
-        if use_firefox:
-            self.driver = Firefox()
-        else:
-            self.driver = Chrome()
+    def __init__(self, fetch_extras=False, use_firefox=False, profile_dir=None):
+        self.use_firefox = use_firefox
+        # a browser profile kept between runs, only one browser at a time may use it
+        self.profile_dir = profile_dir
+        self._driver = None
+        # cookies of a restored session, installed once the browser starts
+        self._cookies = None
         self.fetch_extras = fetch_extras
         self.last_lesson = None
+        self.last_link = None
+        # (player, playlist index) of the last link found, two items of a playlist may share a file
+        self.last_item = None
+        # (element name, seconds from click to link, 'event' or 'poll') for every element handled
+        self.link_latencies = []
+
+    def _start_driver(self):
+        if self.use_firefox:
+            options = FirefoxOptions()
+            if self.profile_dir:
+                options.add_argument('-profile')
+                options.add_argument(self.profile_dir)
+            return Firefox(options=options)
+
+        options = ChromeOptions()
+        if self.profile_dir:
+            options.add_argument('--user-data-dir={}'.format(self.profile_dir))
+        return Chrome(options=options)
+
+    @property
+    def driver(self):
+        # started on first use, a restored session scraping over http may never need it
+        if self._driver is None:
+            if self.profile_dir:
+                os.makedirs(self.profile_dir, exist_ok=True)
+            self._driver = self._start_driver()
+            if self._cookies:
+                self.load_session_cookies(self._cookies)
+        return self._driver
+
+    def restore_session(self, cookies):
+        """
+        Takes over a session saved by an earlier login instead of logging in
+        """
+        self._cookies = cookies
+        if self._driver is not None:
+            self.load_session_cookies(cookies)
 
     def login_to_artistworks(self, username, password):
         logger.info('Connecting to artistworks with user {}'.format(username))
@@ -70,8 +201,29 @@ class ArtistWorkScraper(object):
         except TimeoutException as t:
             logger.exception(t)
             logger.critical('Failed to login!')
-
-    def get_masterclass_by_id(self, masterclass_id):
+            return False
+        return True
+
+    def get_session_cookies(self):
+        if self._driver is None:
+            return self._cookies
+        return self._driver.get_cookies()
+
+    def load_session_cookies(self, cookies):
+        """
+        Installs cookies taken from another (logged in) driver, so this one can skip the login form.
+        selenium only accepts cookies for the domain currently loaded, so we visit each artistworks host first.
+        """
+        for url in (ARTISTWORKS_LOGIN, ARTISTWORKS_LESSON_BASE):
+            self.driver.get(url)
+            host = urlparse(url).hostname
+            for cookie in cookies:
+                domain = cookie.get('domain', '').lstrip('.')
+                if host == domain or host.endswith('.' + domain):
+                    with contextlib.suppress(WebDriverException):
+                        self.driver.add_cookie(cookie)
+
+    def get_masterclass_by_id(self, masterclass_id, lesson_name=None):
         logger.info('grabbing info for masterclass {}'.format(masterclass_id))
         if not self.driver.current_url == (ARTISTWORKS_MASTERCLASS_BASE + str(masterclass_id)):
             self.driver.get(ARTISTWORKS_MASTERCLASS_BASE + str(masterclass_id))
@@ -81,9 +233,11 @@ class ArtistWorkScraper(object):
         elements = self._fetch_current_page_playlist_elements()
 
         # this is a case with some of the newer players
-        if self.last_lesson:
-            if masterclass_name == self.last_lesson.name:
-                masterclass_name = elements[0].text  # students question name is the masterclass name
+        if lesson_name is None and self.last_lesson:
+            lesson_name = self.last_lesson.name
+
+        if masterclass_name == lesson_name:
+            masterclass_name = elements[0].text  # students question name is the masterclass name
 
         lesson_links = self._handle_elements(elements, lesson_name=masterclass_name)
 
@@ -107,87 +261,142 @@ class ArtistWorkScraper(object):
 
         content = self.driver.page_source
         soup = BeautifulSoup(content)
-        masterclasses_ids = list(map(lambda x: re.findall('\d+', x['href'])[0],
-                                     soup.find_all('a', href=re.compile('/masterclass/(\d+)'))))
+        masterclasses_ids = parse_masterclass_ids(soup)
 
         if self.fetch_extras:
             logger.debug('Looking for pdf materials to download')
-            pdf_links = map(lambda x: x['href'], soup.find_all('a', href=re.compile('.+\.pdf')))
-            lesson_links.extend([LessonLink(link.split('/')[-1], link) for link in pdf_links])
+            lesson_links.extend(parse_pdf_links(soup))
 
         ret = Lesson(lesson_id, lesson_name, lesson_links, masterclasses_ids)
         self.last_lesson = ret
         return ret
 
+    def _get_jwplayer_snapshot(self):
+        players = self.driver.execute_script(JWPLAYER_SNAPSHOT) or []
+        for player in players:
+            logger.debug('player {} is {} with {} playlist items'.format(player['id'], player['state'],
+                                                                          len(player['playlist'])))
+        return players
+
     def _get_all_jwplayer_instances(self):
         logger.debug('Discovering all instances of JWPlayer on page')
-        ids = []
-        player_exists = True
-        player_id = 0
-        while player_exists:
-            jw = self.driver.execute_script("return jwplayer({player})".format(player=player_id))
-            # empty objects are a dict with only registerPlugin
-            if len(jw) > 1:
-                ids.append(player_id)
-                player_id += 1
-            else:
-                player_exists = False
+        ids = [player['id'] for player in self._get_jwplayer_snapshot()]
         logger.debug('Found {} instances'.format(len(ids)))
         return ids
 
     def _get_active_jwplayer_instance(self):
         logger.debug('checking all jwplayer state')
-        players = self._get_all_jwplayer_instances()
-        for player_id in players:
-            state = self.driver.execute_script("return jwplayer({player}).getState()".format(player=player_id))
-            logger.debug('state of player {} is {}'.format(player_id, state))
-            if not state == JWPlayerStates.IDLE.value:
-                return player_id
+        for player in self._get_jwplayer_snapshot():
+            if not player['state'] == JWPlayerStates.IDLE.value:
+                return player['id']
 
         return None
 
+    def _hook_jwplayer_events(self):
+        try:
+            self.driver.execute_script(JWPLAYER_EVENT_HOOK)
+        except WebDriverException as e:
+            logger.debug('could not hook jwplayer events, will poll instead: {}'.format(e))
+
+    def _poll_jwplayer_event(self):
+        event = self.driver.execute_script(JWPLAYER_EVENT_POLL, self.last_link)
+        # a playlist item change counts even when the new item plays the same file as the previous one
+        if event and event.get('file') and (event.get('changed') or event['file'] != self.last_link):
+            return event
+        return False
+
+    def _poll_active_player_with_backoff(self):
+        delay = LINK_POLL_INITIAL_DELAY
+        deadline = time.time() + LINK_POLL_TIMEOUT
+        player_id, link, index = None, None, None
+        last_index = self.last_item[1] if self.last_item else None
+        while time.time() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, LINK_POLL_MAX_DELAY)
+            try:
+                player_id = self._get_active_jwplayer_instance() or 0
+                current = self.driver.execute_script(JWPLAYER_TAKE_FILE, player_id, self.last_link, last_index)
+            except WebDriverException as e:
+                logger.debug('player not ready yet: {}'.format(e))
+                continue
+            link, index = current['file'], current['index']
+            if link and (link != self.last_link or (player_id, index) != self.last_item):
+                break
+        return player_id, link, index
+
     def _get_video_link_for_element(self, element):
         logger.info('grabbing links for element {}'.format(element.text))
+        self._hook_jwplayer_events()
+        start = time.time()
         element.click()
-        # small sleep is still needed for some js to initialize
-        i = 0
-        link = None
-        while i <= 3:
-            try:
-                time.sleep(5)
-                active_player_id = self._get_active_jwplayer_instance() or 0
-                link = self.driver.execute_script(
-                    "return jwplayer({player}).getPlaylistItem()['file']".format(player=active_player_id))
-                self.driver.execute_script("return jwplayer({player}).stop()".format(player=active_player_id))
-            except WebDriverException as e:
-                logger.exception(e)
-                logger.debug('waiting and retrying')
-                i += 1
-            break
+
+        try:
+            event = WebDriverWait(self.driver, LINK_EVENT_TIMEOUT, poll_frequency=0.1).until(
+                lambda driver: self._poll_jwplayer_event())
+            player_id, link, index, source = event['player'], event['file'], event.get('index'), 'event'
+        except (TimeoutException, WebDriverException):
+            logger.debug('no player event after {}s, falling back to polling'.format(LINK_EVENT_TIMEOUT))
+            player_id, link, index = self._poll_active_player_with_backoff()
+            source = 'poll'
+
         if not link:
             raise Exception('Could not find link!')
 
-        logger.info('found link {}'.format(link))
+        latency = time.time() - start
+        self.link_latencies.append((element.text, latency, source))
+        metrics.observe('scrape_element_seconds', latency)
+        metrics.increment('scrape_element_links_{}_total'.format(source))
+        self.last_link = link
+        self.last_item = (player_id, index)
+        logger.info('found link {} after {:.2f}s ({})'.format(link, latency, source))
         return link
 
+    def _resolve_links_from_playlists(self, elements):
+        """
+        Matches every playlist element to a file exposed by the players' playlists, without clicking anything.
+        Returns None when the page playlists don't expose a single unambiguous file per element.
+        """
+        try:
+            players = self._get_jwplayer_snapshot()
+        except WebDriverException as e:
+            logger.debug('could not read jwplayer playlists: {}'.format(e))
+            return None
+
+        items = [item for player in players for item in player['playlist'] if item.get('file')]
+        if len(elements) == 1 and len(items) == 1:
+            return [items[0]['file']]
+
+        links = []
+        for element in elements:
+            text = element.text.strip()
+            matches = {item['file'] for item in items if item['title'].strip() == text}
+            if not matches:
+                matches = {item['file'] for item in items if item['title'].strip() and item['title'].strip() in text}
+            if len(matches) != 1:
+                return None
+            links.append(matches.pop())
+
+        return links
+
     def _handle_elements(self, elements, lesson_name=None):
         lesson_links = []
-        for element in elements:
-            link = self._get_video_link_for_element(element)
+        links = self._resolve_links_from_playlists(elements)
+        if links:
+            logger.debug('resolved {} links from jwplayer playlists without clicking'.format(len(links)))
+        else:
+            links = [self._get_video_link_for_element(element) for element in elements]
 
+        for element, link in zip(elements, links):
             link_base_name = lesson_name if element.text.strip() == '' else element.text
-            if link.endswith('m3u8'):
-                logger.info('Got playlist instead of video, handling')
-                video_parts = self._handle_playlist(link)
-                if video_parts:
-                    for i, part in enumerate(video_parts):
-                        lesson_links.append(LessonLink(link_base_name + '_part{}'.format(i), part))
-
-            else:
-                lesson_links.append(LessonLink(link_base_name, link))
+            lesson_links.extend(self.links_for_video(link_base_name, link))
 
         return lesson_links
 
+    @staticmethod
+    def links_for_video(name, link):
+        # HLS playlists are kept as a single link, they are resolved by the downloader
+        return [LessonLink(name, link)]
+
     @retry(NoElementsException, tries=10, delay=5, jitter=3)
     def _fetch_current_page_playlist_elements(self):
         try:
@@ -203,23 +412,14 @@ class ArtistWorkScraper(object):
         valid_elements = [element for element in elements if element.text]
 
         if valid_elements:
-            valid_elements = list(set(valid_elements))
+            # drop duplicates but keep page order
+            valid_elements = list(OrderedDict.fromkeys(valid_elements))
             logger.debug('found {} valid elements in page'.format(len(valid_elements)))
             return valid_elements
         else:
             logger.debug('Could not find any valid links on page..')
             raise NoElementsException
 
-    @staticmethod
-    @retry(URLError, tries=10, delay=5, logger=logger)
-    def _handle_playlist(playlist_link):
-        playlist = m3u8.load(playlist_link)
-        highest_quality_video = max(playlist.playlists, key=lambda p: p.stream_info.resolution[0])
-        segments = m3u8.load(highest_quality_video.absolute_uri)
-        videos = [segment.absolute_uri for segment in segments.segments]
-        logger.info('resolved playlist {} into {} videos'.format(playlist_link, len(videos)))
-        return videos
-
     def get_department_name(self, department_id):
         if not self.driver.current_url == (ARTISTWORKS_DEPARTMENT_BASE + str(department_id)):
             self.driver.get(ARTISTWORKS_DEPARTMENT_BASE + str(department_id))
@@ -239,15 +439,20 @@ class ArtistWorkScraper(object):
 
         content = self.driver.page_source
         soup = BeautifulSoup(content)
-        lessons = OrderedDict()
-        elem = soup.find('div', id='media-group-table')
-        links = elem.find_all('a', href=re.compile('/lesson/(\d+)'))
-        for link in links:
-            lesson_id = re.findall('\d+', link['href'])[0]
-            name = link.text
-            lessons[lesson_id] = name
+        return parse_department_lessons(soup)
 
-        return lessons
+    def _forget_driver(self):
+        # a later use starts a new browser, with the session of this one when it can still tell
+        with contextlib.suppress(WebDriverException):
+            self._cookies = self._driver.get_cookies()
+        driver, self._driver = self._driver, None
+        return driver
 
     def exit(self):
-        self.driver.close()
+        if self._driver is not None:
+            self._forget_driver().close()
+
+    def quit(self):
+        # the whole browser, not only its window
+        if self._driver is not None:
+            self._forget_driver().quit()
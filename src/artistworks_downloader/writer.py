@@ -0,0 +1,160 @@
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+import functools
+import os
+import threading
+
+from .constants import MIN_READ_CHUNK_SIZE, MAX_READ_CHUNK_SIZE
+
+
+def open_for_positioned_writes(path, truncate=False):
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    if truncate:
+        flags |= os.O_TRUNC
+    return os.open(path, flags)
+
+
+def preallocate(fd, length):
+    try:
+        os.posix_fallocate(fd, 0, length)
+    except (AttributeError, OSError):
+        # windows, or a filesystem without fallocate support - a sparse file will do
+        os.ftruncate(fd, length)
+
+
+if hasattr(os, 'pwrite'):
+    def pwrite_all(fd, data, offset):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+else:
+    _seek_and_write_lock = threading.Lock()
+
+    def pwrite_all(fd, data, offset):
+        # no pwrite on windows, writer threads must not move the position under each other
+        with _seek_and_write_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+
+
+class AdaptiveChunkSize(object):
+    """
+    Size of the next stream read. StreamReader.read(n) returns whatever is buffered up to n bytes, so reads
+    coming back full mean data arrives faster than we ask for it - the size doubles, and halves when reads come
+    back mostly empty.
+    """
+
+    def __init__(self, minimum=MIN_READ_CHUNK_SIZE, maximum=MAX_READ_CHUNK_SIZE):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = minimum
+
+    def update(self, received):
+        if received >= self.size:
+            self.size = min(self.size * 2, self.maximum)
+        elif received < self.size // 4:
+            self.size = max(self.size // 2, self.minimum)
+
+
+class BufferPool(object):
+    """
+    A fixed number of fixed size buffers shared by every writer of a downloader. Writers wait for a free buffer
+    when all of them are being filled or written, which bounds memory and slows readers down to the disk's pace.
+    """
+
+    def __init__(self, count, size):
+        self.size = size
+        self._free = asyncio.Queue()
+        for _ in range(count):
+            self._free.put_nowait(bytearray(size))
+
+    @asyncio.coroutine
+    def acquire(self):
+        return (yield from self._free.get())
+
+    def release(self, buffer):
+        self._free.put_nowait(buffer)
+
+
+class FileWriter(object):
+    """
+    Coalesces stream chunks into pool buffers and writes full buffers with positioned writes on a thread pool,
+    so the event loop never blocks on the disk. Several writers can share a file descriptor as long as they write
+    to different ranges.
+    """
+
+    def __init__(self, fd, pool, executor, loop):
+        self.fd = fd
+        self.pool = pool
+        self.executor = executor
+        self.loop = loop
+
+        self._buffer = None
+        self._fill = 0
+        self._offset = 0
+        self._inflight = set()
+        self._error = None
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _write_done(self, buffer, future):
+        self._inflight.discard(future)
+        self.pool.release(buffer)
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+    def _submit(self):
+        if self._buffer is None:
+            return
+        buffer, fill, offset = self._buffer, self._fill, self._offset
+        self._buffer = None
+        if not fill:
+            self.pool.release(buffer)
+            return
+
+        future = self.loop.run_in_executor(self.executor, pwrite_all, self.fd, memoryview(buffer)[:fill], offset)
+        future.add_done_callback(functools.partial(self._write_done, buffer))
+        self._inflight.add(future)
+
+    @asyncio.coroutine
+    def write(self, data, offset):
+        self._check()
+        if self._buffer is not None and offset != self._offset + self._fill:
+            self._submit()
+
+        view = memoryview(data)
+        while view:
+            if self._buffer is None:
+                self._buffer = yield from self.pool.acquire()
+                self._fill = 0
+                self._offset = offset
+
+            size = min(len(view), self.pool.size - self._fill)
+            self._buffer[self._fill:self._fill + size] = view[:size]
+            self._fill += size
+            offset += size
+            view = view[size:]
+
+            if self._fill == self.pool.size:
+                self._submit()
+
+    @asyncio.coroutine
+    def flush(self):
+        """
+        Waits until everything written so far is on disk
+        """
+        self._submit()
+        if self._inflight:
+            yield from asyncio.wait(set(self._inflight))
+        self._check()
+
+    @asyncio.coroutine
+    def close(self):
+        yield from self.flush()
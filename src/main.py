@@ -2,68 +2,350 @@ from __future__ import unicode_literals, absolute_import
 
 import argparse
 import os
-import shelve
 from pathlib import Path
+import sys
+import time
 
 import logbook
 
-from artistworks_downloader.constants import DEFAULT_OUTPUT_DIRECTORY, LOG_PATH
-from artistworks_downloader.webdriver import ArtistWorkScraper
-from artistworks_downloader.video_downloader import AsyncDownloader, get_valid_filename
-from artistworks_downloader.unite import unite_ts_videos
-
-parser = argparse.ArgumentParser(description='Grabs videos from artistworks')
-parser.add_argument('--username', type=str, required=True,
-                    help='Username to connect to artistworks')
-parser.add_argument('--password', type=str, required=True,
-                    help='Password to connect to artistworks')
-parser.add_argument('--output_dir', type=str, nargs='?', default=DEFAULT_OUTPUT_DIRECTORY,
-                    help='specify output directory')
-parser.add_argument('--fetch_extras', default=False, action='store_true',
-                    help='whether to download extra lesson objects (such as slow motion etc..)')
-parser.add_argument('--fetch_masterclasses', default=False, action='store_true',
-                    help='whether to download student exchanges for lessons')
-parser.add_argument('--use_firefox', default=False, action='store_true',
-                    help='whether to use firefox instead of chrome webdriver')
-parser.add_argument('--use_virtual_display', default=False, action='store_true',
-                    help='whether to use a virtual display for running in headless mode (linux only)')
-parser.add_argument('--root_folder', type=str, required=True,
-                    help="Name of root folder to save files in (Artist's name for example)")
-
-links_group = parser.add_mutually_exclusive_group(required=True)
-links_group.add_argument('--department', type=int,
-                         help='Department number to be scraped')
-links_group.add_argument('--only_lessons', type=str, nargs='*',
-                         help='download only specified lessons')
+from artistworks_downloader.constants import DEFAULT_OUTPUT_DIRECTORY, HTTP_SCRAPE_CONCURRENCY, \
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_CONNECTION_LIMIT_PER_HOST, DOWNLOAD_SEGMENTS, \
+    SEGMENTED_DOWNLOAD_THRESHOLD, MANIFEST_NAME, MAX_CONCURRENT_DOWNLOADS, MIN_CONCURRENT_DOWNLOADS, \
+    MAX_CONCURRENT_DOWNLOADS_LIMIT, HOST_REQUEST_RATE, HOST_REQUEST_BURST, MAX_RETRIES, RETRY_BACKOFF_BASE, \
+    RETRY_BACKOFF_MAX, METRICS_DIRECTORY, BATCH_DOWNLOADS_IN_FLIGHT, HLS_FORMATS, RENDITION_POLICIES, MAX_RESOLUTION, \
+    SESSION_DIRECTORY, WORK_QUEUE_NAME, WORK_CLAIM_BATCH, WORK_LEASE_SECONDS, WORK_KINDS, \
+    WORK_POLL_INTERVAL, PLAN_PROBE_CONCURRENCY, PLAN_FREE_SPACE_RESERVE_MB
+from artistworks_downloader.exceptions import DiskBudgetException
+from artistworks_downloader.logs import setup_logging
+from artistworks_downloader.metrics import metrics
+
+# everything heavier (selenium, bs4, aiohttp, m3u8) is imported by the commands that use it, so the commands that
+# don't log in start fast
+
+COMMANDS = ('run', 'scrape', 'download', 'verify', 'unite', 'coordinate', 'work', 'status')
 
 logger = logbook.Logger(__name__)
-logger.handlers.append(logbook.FileHandler(LOG_PATH, bubble=True, level=logbook.DEBUG))
-logger.handlers.append(logbook.StderrHandler())
 
-args = parser.parse_args()
+args = None
 
-if not os.path.exists(args.output_dir):
-    os.makedirs(args.output_dir)
 
+def build_parser():
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument('--output_dir', type=str, nargs='?', default=DEFAULT_OUTPUT_DIRECTORY,
+                        help='specify output directory')
+    output.add_argument('--no_progress', default=False, action='store_true',
+                        help='do not show download progress bars')
+    output.add_argument('--metrics_dir', type=str, default=None,
+                        help='directory the json summary of each run is written to (defaults to output_dir/{})'.format(
+                            METRICS_DIRECTORY))
+    output.add_argument('--prometheus_textfile', type=str, default=None,
+                        help='also write the metrics of the run to this file, in the prometheus text format')
 
-def main():
-    if args.use_virtual_display:
-        import pyvirtualdisplay
+    credentials = argparse.ArgumentParser(add_help=False)
+    credentials.add_argument('--username', type=str,
+                             help='Username to connect to artistworks')
+    credentials.add_argument('--password', type=str,
+                             help='Password to connect to artistworks')
+    credentials.add_argument('--fetch_extras', default=False, action='store_true',
+                             help='whether to download extra lesson objects (such as slow motion etc..)')
+    credentials.add_argument('--use_firefox', default=False, action='store_true',
+                             help='whether to use firefox instead of chrome webdriver')
+    credentials.add_argument('--use_virtual_display', default=False, action='store_true',
+                             help='whether to use a virtual display for running in headless mode (linux only)')
+    credentials.add_argument('--browser_profile', default=False, action='store_true',
+                             help='keep the browser profile in the session directory between runs')
 
-        display = pyvirtualdisplay.Display(visible=0, size=(800, 600))
-        display.start()
+    login = argparse.ArgumentParser(add_help=False, parents=[credentials])
+    login.add_argument('--scrape_workers', type=int, default=1,
+                       help='number of browser instances used in parallel for scraping lessons and masterclasses')
+    login.add_argument('--http_scrape', default=False, action='store_true',
+                       help='use the browser only for login and fetch pages directly over http')
+    login.add_argument('--http_scrape_concurrency', type=int, default=HTTP_SCRAPE_CONCURRENCY,
+                       help='maximum number of pages fetched concurrently in http scrape mode')
+
+    session = argparse.ArgumentParser(add_help=False)
+    session.add_argument('--session_dir', type=str, default=None,
+                         help='directory the logged in session is saved to and restored from, instead of logging in '
+                              'again (defaults to output_dir/{})'.format(SESSION_DIRECTORY))
+    session.add_argument('--no_session', default=False, action='store_true',
+                         help='always log in, and neither save nor restore sessions')
+
+    scraping = argparse.ArgumentParser(add_help=False)
+    scraping.add_argument('--root_folder', type=str,
+                          help="Name of root folder to save files in (Artist's name for example)")
+    scraping.add_argument('--fetch_masterclasses', default=False, action='store_true',
+                          help='whether to download student exchanges for lessons')
+    scraping.add_argument('--sync', default=False, action='store_true',
+                          help='only scrape lessons of the department that are new or whose masterclasses changed '
+                               'since the last run, and print a summary of the changes')
+    links_group = scraping.add_mutually_exclusive_group()
+    links_group.add_argument('--department', type=int,
+                             help='Department number to be scraped')
+    links_group.add_argument('--only_lessons', type=str, nargs='*',
+                             help='download only specified lessons')
+    links_group.add_argument('--batch', type=str, nargs='+', metavar='JOB',
+                             help='download several departments and lesson sets with a single login and download '
+                                  'pool. A job is a department number or lessons:<id>,<id>..., optionally followed '
+                                  'by @<priority> - higher priorities download first')
+    scraping.add_argument('--batch_file', type=str, default=None,
+                          help='file of batch jobs, one per line (lines starting with # are ignored)')
+
+    downloading = argparse.ArgumentParser(add_help=False)
+    downloading.add_argument('--connect_timeout', type=float, default=HTTP_CONNECT_TIMEOUT,
+                             help='seconds to wait for a download connection to be established')
+    downloading.add_argument('--read_timeout', type=float, default=HTTP_READ_TIMEOUT,
+                             help='seconds to wait for data on a download connection')
+    downloading.add_argument('--connections_per_host', type=int, default=HTTP_CONNECTION_LIMIT_PER_HOST,
+                             help='maximum number of open download connections to a single host')
+    downloading.add_argument('--concurrent_downloads', type=int, default=MAX_CONCURRENT_DOWNLOADS,
+                             help='number of concurrent downloads to start with, adjusted to throughput and errors '
+                                  'as they go')
+    downloading.add_argument('--min_concurrent_downloads', type=int, default=MIN_CONCURRENT_DOWNLOADS,
+                             help='lowest number of concurrent downloads to fall back to on errors')
+    downloading.add_argument('--max_concurrent_downloads', type=int, default=MAX_CONCURRENT_DOWNLOADS_LIMIT,
+                             help='highest number of concurrent downloads to grow to')
+    downloading.add_argument('--host_rate', type=float, default=HOST_REQUEST_RATE,
+                             help='maximum download requests per second to a single host (0 for no limit)')
+    downloading.add_argument('--host_burst', type=int, default=HOST_REQUEST_BURST,
+                             help='number of download requests allowed at once to a single host before host_rate '
+                                  'applies')
+    downloading.add_argument('--max_retries', type=int, default=MAX_RETRIES,
+                             help='number of times a failed download is retried')
+    downloading.add_argument('--backoff_base', type=float, default=RETRY_BACKOFF_BASE,
+                             help='seconds a first retry waits at most, doubled for every following one')
+    downloading.add_argument('--backoff_max', type=float, default=RETRY_BACKOFF_MAX,
+                             help='seconds a retry waits at most')
+    downloading.add_argument('--segments', type=int, default=DOWNLOAD_SEGMENTS,
+                             help='number of concurrent byte ranges large files are split into (1 disables '
+                                  'splitting)')
+    downloading.add_argument('--segment_threshold_mb', type=int,
+                             default=SEGMENTED_DOWNLOAD_THRESHOLD // (1024 * 1024),
+                             help='minimal size in MB of a file to be downloaded in segments')
+    downloading.add_argument('--preallocate', default=False, action='store_true',
+                             help='reserve the full size of a download on disk before writing to it')
+    downloading.add_argument('--hls_stream', choices=HLS_FORMATS,
+                             help='stream HLS videos straight into a single .ts or .mp4 file instead of downloading '
+                                  'parts')
+    downloading.add_argument('--rendition', choices=RENDITION_POLICIES, default=MAX_RESOLUTION,
+                             help='which rendition of an HLS video to download, the one with the most pixels or the '
+                                  'highest bandwidth')
+    downloading.add_argument('--max_height', type=int, default=None,
+                             help='only consider HLS renditions up to this height, e.g. 720')
+    downloading.add_argument('--no_dedup', default=False, action='store_true',
+                             help='download every link, even when the same video was already downloaded for another '
+                                  'lesson')
+
+    planning = argparse.ArgumentParser(add_help=False)
+    planning.add_argument('--plan', default=False, action='store_true',
+                          help='probe the size of every download first, report them per lesson and department, '
+                               'check they fit on the output disk and start the largest ones first')
+    planning.add_argument('--plan_only', default=False, action='store_true',
+                          help='only probe and report the sizes of the downloads, without downloading them')
+    planning.add_argument('--free_space_reserve_mb', type=int, default=PLAN_FREE_SPACE_RESERVE_MB,
+                          help='space in MB planned downloads must leave free on the output disk')
+    planning.add_argument('--trim_to_budget', default=False, action='store_true',
+                          help="leave out the last lessons of a plan that doesn't fit on the output disk, instead "
+                               "of not downloading at all")
+    planning.add_argument('--plan_concurrency', type=int, default=PLAN_PROBE_CONCURRENCY,
+                          help='maximum number of size probes in flight when planning')
+
+    uniting = argparse.ArgumentParser(add_help=False)
+    uniting.add_argument('--unite_workers', type=int, default=None,
+                         help='number of ffmpeg processes uniting videos in parallel (defaults to the number of '
+                              'cores)')
+    uniting.add_argument('--unite_concat_demuxer', default=False, action='store_true',
+                         help="unite .ts parts with ffmpeg's concat demuxer instead of appending them before "
+                              "remuxing")
+
+    parser = argparse.ArgumentParser(description='Grabs videos from artistworks',
+                                     epilog='Without a command, the options are those of run.')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    run = commands.add_parser('run', parents=[output, login, session, scraping, downloading, planning, uniting],
+                              help='log in, scrape, download and unite')
+    run.add_argument('--pipeline', default=False, action='store_true',
+                     help='start downloading and uniting each lesson as soon as it is scraped')
+    run.add_argument('--batch_in_flight', type=int, default=BATCH_DOWNLOADS_IN_FLIGHT,
+                     help='number of downloads of a batch started at the same time, the others wait by priority')
+
+    scrape = commands.add_parser('scrape', parents=[output, login, session, scraping],
+                                 help='log in and scrape lessons into the manifest, without downloading them')
+    scrape.set_defaults(pipeline=False)
+
+    download = commands.add_parser('download', parents=[output, session, downloading, planning, uniting],
+                                   help='download the lessons already scraped into the manifest, without a browser')
+    download.add_argument('--department', type=int,
+                          help='only download the lessons of this department number')
+    download.add_argument('--only_lessons', type=str, nargs='*',
+                          help='only download these lessons')
+    download.add_argument('--root_folder', type=str,
+                          help='folder to download into, instead of the one each department was scraped for')
+    download.add_argument('--fetch_masterclasses', default=False, action='store_true',
+                          help='also download the scraped student exchanges of the lessons')
+    download.add_argument('--no_unite', default=False, action='store_true',
+                          help='leave HLS parts as they are')
+
+    verify = commands.add_parser('verify', parents=[output, session, downloading],
+                                 help='check the downloads of output_dir against their recorded size and hash, and '
+                                      'download the damaged ones again, without a browser')
+    verify.add_argument('--full', default=False, action='store_true',
+                        help='hash every file, even those whose size and mtime did not change')
+    verify.add_argument('--hash_workers', type=int, default=None,
+                        help='number of files hashed in parallel (defaults to the number of cores)')
+
+    unite = commands.add_parser('unite', parents=[output, uniting],
+                                help='unite downloaded HLS parts into mp4s')
+    unite.add_argument('--root_folder', type=str,
+                       help='only unite the parts under this folder of output_dir')
+
+    coordinate = commands.add_parser('coordinate', parents=[output, login, session, scraping],
+                                     help='list lessons and hand their scraping, downloads and unites to work '
+                                          'processes, on this node or others')
+    coordinate.add_argument('--queue', type=str, default=None,
+                            help='sqlite file of the work items (defaults to output_dir/{}), workers on nodes '
+                                 'sharing it may open it directly'.format(WORK_QUEUE_NAME))
+    coordinate.add_argument('--serve', type=str, default=None, metavar='HOST:PORT',
+                            help='also serve the work items over http, for workers that can only reach this node '
+                                 '(unauthenticated, for trusted networks only)')
+    coordinate.add_argument('--no_unite', default=False, action='store_true',
+                            help='leave HLS parts as they are')
+    coordinate.set_defaults(pipeline=False)
+
+    work = commands.add_parser('work', parents=[output, credentials, session, downloading, uniting],
+                               help="do the work items of a coordinator until it is finished, output_dir is the "
+                                    "coordinator's output tree as mounted on this node")
+    work.add_argument('--coordinator', type=str, required=True,
+                      help="url of a coordinator serving its work items, or the path of its queue file")
+    work.add_argument('--worker_id', type=str, default=None,
+                      help='name of this worker in the leases it holds (defaults to host-pid)')
+    work.add_argument('--kinds', type=str, nargs='+', choices=WORK_KINDS, default=list(WORK_KINDS),
+                      help='kinds of work items taken, lessons and masterclasses need --username and --password')
+    work.add_argument('--claim_batch', type=int, default=WORK_CLAIM_BATCH,
+                      help='number of work items claimed at a time, the downloads among them run concurrently')
+    work.add_argument('--lease', type=int, default=WORK_LEASE_SECONDS,
+                      help='seconds claimed items stay leased without a heartbeat, before other workers take them')
+    # lessons are scraped with one browser per worker, more of them are more workers
+    work.set_defaults(scrape_workers=1, http_scrape=False, sync=False)
+
+    commands.add_parser('status', parents=[output],
+                        help='summarize the departments, lessons and downloads of the manifest')
+    return parser
+
+
+parser = build_parser()
+
+
+def parse_args(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # the options of earlier versions, without a command, still run everything
+    if argv and argv[0] not in COMMANDS + ('-h', '--help'):
+        argv = ['run'] + argv
+    parsed = parser.parse_args(argv)
+    if parsed.command is None:
+        parser.error('a command is required')
+
+    if parsed.command in ('run', 'scrape', 'coordinate'):
+        missing = [name for name in ('username', 'password', 'root_folder') if getattr(parsed, name) is None]
+        if missing:
+            parser.error('the following arguments are required: {}'.format(
+                ', '.join('--' + name for name in missing)))
+        if (parsed.department is None and parsed.only_lessons is None and parsed.batch is None and
+                parsed.batch_file is None):
+            parser.error('one of the arguments --department --only_lessons --batch --batch_file is required')
+
+    if parsed.command in ('run', 'scrape', 'coordinate'):
+        if parsed.batch_file and (parsed.department is not None or parsed.only_lessons is not None):
+            parser.error('argument --batch_file: not allowed with argument --department or --only_lessons')
+        if parsed.batch or parsed.batch_file:
+            if parsed.pipeline:
+                parser.error('--pipeline does not apply to batch jobs, they share a single download pass')
+        elif parsed.sync and parsed.department is None:
+            parser.error('--sync requires --department')
+
+    if parsed.command in ('run', 'download'):
+        parsed.plan = parsed.plan or parsed.plan_only
+        if parsed.plan and getattr(parsed, 'pipeline', False):
+            parser.error('--plan does not apply to --pipeline, lessons are downloaded as they are scraped')
+    return parsed
+
+
+def open_manifest():
+    from artistworks_downloader.manifest import Manifest
+
+    return Manifest(os.path.join(args.output_dir, MANIFEST_NAME))
+
+
+def lesson_downloads(lesson, department_path, masterclasses_db):
+    from artistworks_downloader.video_downloader import get_valid_filename
+
+    lesson_output_folder_path = department_path.joinpath(get_valid_filename(lesson.name))
+    downloads = [(lesson_link, lesson_output_folder_path) for lesson_link in lesson.links]
+
+    if args.fetch_masterclasses:
+        for masterclass_id in lesson.masterclass_ids:
+            if masterclass_id not in masterclasses_db:
+                continue
+            masterclass = masterclasses_db[masterclass_id]
+            masterclass_output_folder_path = lesson_output_folder_path.joinpath(
+                get_valid_filename(masterclass.name))
+            if masterclass_output_folder_path.exists():
+                masterclass_output_folder_path.with_name(
+                    masterclass_output_folder_path.name + 'masterclass_{}'.format(masterclass_id))
+            downloads.extend((masterclass_link, masterclass_output_folder_path)
+                             for masterclass_link in masterclass.links)
+
+    return lesson_output_folder_path, downloads
+
+
+def scrape_lesson(scraper, lesson_id, lessons_db, masterclasses_db):
+    if lesson_id not in lessons_db:
+        with metrics.timed('scrape_lesson_seconds'):
+            lessons_db[lesson_id] = scraper.get_lesson_by_id(lesson_id)
 
-    scraper = ArtistWorkScraper(fetch_extras=args.fetch_extras, use_firefox=args.use_firefox)
+    if args.fetch_masterclasses:
+        for masterclass_id in lessons_db[lesson_id].masterclass_ids:
+            if masterclass_id not in masterclasses_db:
+                with metrics.timed('scrape_masterclass_seconds'):
+                    masterclasses_db[masterclass_id] = scraper.get_masterclass_by_id(masterclass_id)
+
+    return lessons_db[lesson_id]
 
-    scraper.login_to_artistworks(username=args.username, password=args.password)
 
-    if args.only_lessons:
-        lesson_ids = args.only_lessons
+def list_job(job, scraper, http_scraper, manifest):
+    """
+    Lists the lessons of a job into the manifest, without scraping them.
+    Returns the job's department name and folder, its lesson ids, the lessons and masterclasses of its department,
+    and the summary of its sync if any
+    """
+    if job.department is None:
+        lesson_ids = job.lessons
         department_name = 'Misc lessons'
     else:
-        department_name = scraper.get_department_name(args.department)
-        lessons = scraper.get_all_lesson_ids_for_department(args.department)
+        department_scraper = http_scraper or scraper
+        # a department synced before is known by its number, without loading its page
+        with metrics.phase('department'):
+            department_name = ((args.sync and manifest.department_name(job.department)) or
+                               department_scraper.get_department_name(job.department))
+
+    # download finds the department's folder again without being told
+    manifest.department_id(department_name, number=job.department, root_folder=args.root_folder)
+    manifest.migrate_shelves(args.output_dir, department_name)
+    lessons_db = manifest.lessons(department_name)
+    masterclasses_db = manifest.masterclasses(department_name)
+
+    summary = None
+    if job.department is not None:
+        with metrics.phase('department'):
+            if args.sync:
+                from artistworks_downloader.sync import DepartmentSync
+
+                summary = DepartmentSync(http_scraper, manifest, department_name).run(job.department)
+                # changed lessons were already scraped again, new ones are the only lessons missing from the manifest
+                lessons = summary.lessons
+            else:
+                lessons = department_scraper.get_all_lesson_ids_for_department(job.department)
         lesson_ids = lessons.keys()
+        manifest.set_department_lessons(department_name, lessons)
 
         # Create nice txt file with lessons info
         output_path = Path(args.output_dir).joinpath(args.root_folder).joinpath(department_name)
@@ -76,42 +358,530 @@ def main():
             f.write('\r\n')
         f.close()
 
-    lessons_db = shelve.open(os.path.join(args.output_dir, department_name + '_lessons.db'))
-    masterclasses_db = shelve.open(os.path.join(args.output_dir, department_name + '_masterclasses.db'))
+    department_path = Path(args.output_dir).joinpath(args.root_folder).joinpath(department_name)
+    return department_name, department_path, lesson_ids, lessons_db, masterclasses_db, summary
 
-    for lesson_id in lesson_ids:
-        if lesson_id not in lessons_db:
-            lessons_db[lesson_id] = scraper.get_lesson_by_id(lesson_id)
 
-        if args.fetch_masterclasses:
-            for masterclass_id in lessons_db[lesson_id].masterclass_ids:
-                if masterclass_id not in masterclasses_db:
-                    masterclasses_db[masterclass_id] = scraper.get_masterclass_by_id(masterclass_id)
+def scrape_job(job, scraper, http_scraper, pool, manifest):
+    """
+    Scrapes the lessons of a job into the manifest.
+    Returns the job's department folder, its lesson ids, and the lessons and masterclasses of its department
+    """
+    _, department_path, lesson_ids, lessons_db, masterclasses_db, summary = list_job(job, scraper, http_scraper,
+                                                                                     manifest)
+
+    if summary:
+        print(summary)
+
+    # with --sync alone, the http scraper only synced the listing and the changed lessons, new ones are scraped by
+    # the browsers
+    with metrics.phase('scrape'):
+        if args.http_scrape:
+            http_scraper.scrape(lesson_ids, lessons_db, masterclasses_db,
+                                fetch_masterclasses=args.fetch_masterclasses)
+        elif pool:
+            pool.scrape(lesson_ids, lessons_db, masterclasses_db, fetch_masterclasses=args.fetch_masterclasses)
+        elif not args.pipeline:
+            for lesson_id in lesson_ids:
+                scrape_lesson(scraper, lesson_id, lessons_db, masterclasses_db)
+
+    return department_path, lesson_ids, lessons_db, masterclasses_db
+
+
+def write_metrics():
+    metrics.close_progress()
+    path = metrics.write_json(args.metrics_dir or os.path.join(args.output_dir, METRICS_DIRECTORY))
+    logger.info('run metrics written to {}'.format(path))
+    if args.prometheus_textfile:
+        metrics.write_prometheus(args.prometheus_textfile)
+
+
+def session_store():
+    if args.no_session:
+        return None
+
+    from artistworks_downloader.session_store import SessionStore
+
+    return SessionStore(args.session_dir or os.path.join(args.output_dir, SESSION_DIRECTORY))
+
+
+def create_downloader(manifest):
+    import asyncio
+
+    from artistworks_downloader.scheduler import DownloadScheduler
+    from artistworks_downloader.video_downloader import AsyncDownloader
+
+    store = session_store()
+    loop = asyncio.get_event_loop()
+    scheduler = DownloadScheduler(loop,
+                                  initial=args.concurrent_downloads,
+                                  minimum=args.min_concurrent_downloads,
+                                  maximum=args.max_concurrent_downloads,
+                                  host_rate=args.host_rate or None,
+                                  host_burst=args.host_burst,
+                                  backoff_base=args.backoff_base,
+                                  backoff_max=args.backoff_max)
+    return AsyncDownloader(loop=loop,
+                           connect_timeout=args.connect_timeout,
+                           read_timeout=args.read_timeout,
+                           connection_limit_per_host=args.connections_per_host,
+                           segments=args.segments,
+                           segment_threshold=args.segment_threshold_mb * 1024 * 1024,
+                           preallocate=args.preallocate,
+                           hls_format=args.hls_stream,
+                           rendition_policy=args.rendition,
+                           max_height=args.max_height,
+                           manifest=manifest,
+                           scheduler=scheduler,
+                           max_retries=args.max_retries,
+                           dedup=not args.no_dedup,
+                           cookies=store.load() if store else None)
+
+
+def plan_downloads(downloader, downloads):
+    """
+    downloads are (priority, link, output_folder_path, department, lesson). With --plan their sizes are probed,
+    reported and checked against the free space of the output disk, and they come back as (priority, link,
+    output_folder_path) in the order they should start. Returns None when they shouldn't start at all (--plan_only)
+    """
+    if not args.plan:
+        return [download[:3] for download in downloads]
+
+    import shutil
+
+    from artistworks_downloader.planner import DownloadPlanner
+
+    planner = DownloadPlanner(downloader, concurrency=args.plan_concurrency)
+    for download in downloads:
+        planner.add(*download)
+    logger.info('probing the sizes of {} downloads'.format(len(planner)))
+    with metrics.phase('plan'):
+        plan = planner.plan()
+    print(plan.report())
+
+    budget = shutil.disk_usage(args.output_dir).free - args.free_space_reserve_mb * 2 ** 20
+    try:
+        plan = plan.within_budget(budget, trim=args.trim_to_budget)
+    except DiskBudgetException:
+        downloader.close()
+        raise
+    if args.plan_only:
+        downloader.close()
+        return None
+
+    plan.expect_progress()
+    return [(download.priority, download.link, download.folder) for download in plan.ordered()]
+
+
+def unite_root_folder(root_folder, manifest):
+    from artistworks_downloader.unite import unite_ts_videos
+
+    with metrics.phase('unite'):
+        unite_ts_videos(os.path.join(args.output_dir, root_folder), workers=args.unite_workers,
+                        fast_concat=not args.unite_concat_demuxer, manifest=manifest)
+
+
+def login():
+    """
+    Logs in with a single browser, or a pool of them, unless the saved session is still valid. Returns the scraper,
+    the pool if any, and the http scraper sharing the browser's session if pages are fetched or synced over http
+    """
+    from artistworks_downloader.webdriver import ArtistWorkScraper
+    from artistworks_downloader.scraper_pool import ScraperPool
+    from artistworks_downloader.session_store import restore_or_login
+
+    if args.use_virtual_display:
+        import pyvirtualdisplay
+
+        display = pyvirtualdisplay.Display(visible=0, size=(800, 600))
+        display.start()
+
+    store = session_store()
+    profile_dir = store.profile_dir if store and args.browser_profile else None
+
+    pool = None
+    with metrics.phase('login'):
+        if args.scrape_workers > 1 and not args.http_scrape:
+            pool = ScraperPool(args.scrape_workers, fetch_extras=args.fetch_extras, use_firefox=args.use_firefox,
+                               profile_dir=profile_dir)
+            scraper = pool.login(username=args.username, password=args.password, store=store)
+        else:
+            scraper = ArtistWorkScraper(fetch_extras=args.fetch_extras, use_firefox=args.use_firefox,
+                                        profile_dir=profile_dir)
+            restore_or_login(scraper, store, args.username, args.password)
+
+    http_scraper = None
+    if args.http_scrape or args.sync:
+        from artistworks_downloader.http_scraper import HttpScraper
+
+        http_scraper = HttpScraper(scraper, concurrency=args.http_scrape_concurrency, fetch_extras=args.fetch_extras)
+
+    return scraper, pool, http_scraper
+
+
+def run_job(job, scraper, http_scraper, pool, manifest):
+    department_path, lesson_ids, lessons_db, masterclasses_db = scrape_job(job, scraper, http_scraper, pool, manifest)
+    if http_scraper:
+        http_scraper.close()
 
     # start downlaoding
 
-    downloader = AsyncDownloader()
+    downloader = create_downloader(manifest)
+
+    if args.pipeline:
+        from artistworks_downloader.pipeline import Pipeline
+
+        def scraped_lessons():
+            # runs on the pipeline's scraper thread, the only one touching the browser.
+            # pool and http scrapers already filled the manifest, only the single browser scrapes along the way
+            for lesson_id in lesson_ids:
+                if args.http_scrape or pool:
+                    if lesson_id not in lessons_db:
+                        continue
+                    lesson = lessons_db[lesson_id]
+                else:
+                    lesson = scrape_lesson(scraper, lesson_id, lessons_db, masterclasses_db)
+                yield lesson_downloads(lesson, department_path, masterclasses_db)
+
+        with metrics.phase('pipeline'):
+            Pipeline(downloader, unite=not args.hls_stream, unite_workers=args.unite_workers,
+                     fast_concat=not args.unite_concat_demuxer).run(scraped_lessons())
+    else:
+        downloads = plan_downloads(downloader, [
+            (0, link, output_folder_path, department_path.name, lesson.name) for lesson in lessons_db.values()
+            for link, output_folder_path in lesson_downloads(lesson, department_path, masterclasses_db)[1]])
+        if downloads is None:
+            return
+
+        with metrics.phase('download'):
+            for _, link, output_folder_path in downloads:
+                downloader.download_link(link, output_folder_path)
+
+            downloader.run()
+
+        if not args.hls_stream:
+            unite_root_folder(args.root_folder, manifest)
+
+
+def batch_jobs():
+    from artistworks_downloader.batch import parse_job, read_jobs
+
+    jobs = []
+    try:
+        for spec in args.batch or []:
+            jobs.append(parse_job(spec))
+        if args.batch_file:
+            jobs.extend(read_jobs(args.batch_file))
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    if not jobs:
+        parser.error('the batch has no jobs')
+    return jobs
+
+
+def command_jobs():
+    from artistworks_downloader.batch import Job
+
+    if args.batch or args.batch_file:
+        return batch_jobs()
+    return [Job(args.department, args.only_lessons, 0)]
+
+
+def run_batch(jobs, scraper, http_scraper, pool, manifest):
+    """
+    Scrapes every job with the same logged in scraper, then downloads them all with one downloader,
+    the downloads of higher priority jobs first
+    """
+    from artistworks_downloader.batch import by_priority, PriorityDownloads
+
+    downloads = []
+    for job in by_priority(jobs):
+        logger.info('scraping {} (priority {})'.format(job, job.priority))
+        department_path, lesson_ids, lessons_db, masterclasses_db = scrape_job(job, scraper, http_scraper, pool,
+                                                                               manifest)
+        for lesson_id in lesson_ids:
+            if lesson_id in lessons_db:
+                lesson = lessons_db[lesson_id]
+                downloads.extend((job.priority, link, output_folder_path, department_path.name, lesson.name)
+                                 for link, output_folder_path in
+                                 lesson_downloads(lesson, department_path, masterclasses_db)[1])
+    if http_scraper:
+        http_scraper.close()
+
+    downloader = create_downloader(manifest)
+    downloads = plan_downloads(downloader, downloads)
+    if downloads is None:
+        return
+
+    queue = PriorityDownloads(downloader, in_flight=args.batch_in_flight)
+    for priority, link, output_folder_path in downloads:
+        queue.put(priority, link, output_folder_path)
+    logger.info('downloading {} links of {} jobs'.format(len(queue), len(jobs)))
+    with metrics.phase('download'):
+        queue.run()
+
+    if not args.hls_stream:
+        unite_root_folder(args.root_folder, manifest)
+
+
+def exit_browsers(scraper, pool):
+    if pool:
+        pool.exit()
+    else:
+        scraper.exit()
+
+
+def run_command():
+    # bad jobs fail before logging in
+    jobs = command_jobs()
+
+    if not args.no_progress:
+        metrics.enable_progress()
+
+    scraper, pool, http_scraper = login()
+    manifest = open_manifest()
+
+    try:
+        if args.batch or args.batch_file:
+            run_batch(jobs, scraper, http_scraper, pool, manifest)
+        else:
+            run_job(jobs[0], scraper, http_scraper, pool, manifest)
+    finally:
+        # scraped lessons are kept even when the downloads don't fit on the disk
+        manifest.close()
+        exit_browsers(scraper, pool)
+    write_metrics()
+
+
+def scrape_command():
+    from artistworks_downloader.batch import by_priority
+
+    jobs = command_jobs()
+    scraper, pool, http_scraper = login()
+    manifest = open_manifest()
+
+    for job in by_priority(jobs):
+        logger.info('scraping {}'.format(job))
+        scrape_job(job, scraper, http_scraper, pool, manifest)
+    if http_scraper:
+        http_scraper.close()
+
+    manifest.close()
+    write_metrics()
+    exit_browsers(scraper, pool)
+
+
+def download_scraped(manifest):
+    downloader = create_downloader(manifest)
+    root_folders = set()
+    downloads = []
+    for department in manifest.departments():
+        if args.department is not None and department['number'] != args.department:
+            continue
+        root_folder = args.root_folder or department['root_folder']
+        if root_folder is None:
+            logger.warning('the folder of {} is unknown, scrape it again or pass --root_folder'.format(
+                department['name']))
+            continue
+
+        root_folders.add(root_folder)
+        department_path = Path(args.output_dir).joinpath(root_folder).joinpath(department['name'])
+        masterclasses_db = manifest.masterclasses(department['name'])
+        for lesson_id, lesson in manifest.lessons(department['name']).items():
+            if args.only_lessons and lesson_id not in args.only_lessons:
+                continue
+            downloads.extend((0, link, output_folder_path, department['name'], lesson.name) for
+                             link, output_folder_path in lesson_downloads(lesson, department_path, masterclasses_db)[1])
+
+    downloads = plan_downloads(downloader, downloads)
+    if downloads is None:
+        return
+
+    with metrics.phase('download'):
+        for _, link, output_folder_path in downloads:
+            downloader.download_link(link, output_folder_path)
+
+        downloader.run()
+
+    if not args.hls_stream and not args.no_unite:
+        for root_folder in sorted(root_folders):
+            unite_root_folder(root_folder, manifest)
+
+
+def download_command():
+    """
+    Downloads what was scraped before, from the lessons stored in the manifest
+    """
+    if not args.no_progress:
+        metrics.enable_progress()
+
+    manifest = open_manifest()
+    try:
+        download_scraped(manifest)
+    finally:
+        manifest.close()
+    write_metrics()
+
+
+def verify_command():
+    """
+    Checks the downloads recorded in the manifest and downloads the damaged ones again
+    """
+    from artistworks_downloader.integrity import verify_downloads
+
+    manifest = open_manifest()
+    with metrics.phase('verify'):
+        summary = verify_downloads(manifest, workers=args.hash_workers, full=args.full)
+    print(summary)
+
+    downloader = create_downloader(manifest)
+    with metrics.phase('download'):
+        for download in summary.damaged:
+            if download['url']:
+                downloader.requeue(download['path'], download['url'])
+            else:
+                # united from parts, the lesson's playlist is downloaded again by its next run
+                logger.warning('{} will be downloaded again with its lesson'.format(download['path']))
+        downloader.run()
+
+    manifest.close()
+    write_metrics()
+
+
+def unite_command():
+    manifest = open_manifest()
+    unite_root_folder(args.root_folder or '', manifest)
+    manifest.close()
+    write_metrics()
+
+
+def coordinate_command():
+    """
+    Lists the lessons of the jobs and publishes the work left on them, for work processes to claim, then applies
+    what they send back to the manifest until nothing is left
+    """
+    from artistworks_downloader.batch import by_priority
+    from artistworks_downloader.coordinator import WorkQueue, QueueServer, Coordinator
+
+    jobs = command_jobs()
+    scraper, pool, http_scraper = login()
+    manifest = open_manifest()
+    queue = WorkQueue(args.queue or os.path.join(args.output_dir, WORK_QUEUE_NAME))
+    coordinator = Coordinator(queue, manifest, args.output_dir, lesson_downloads,
+                              fetch_masterclasses=args.fetch_masterclasses, unite=not args.no_unite)
+
+    # items are claimed in the order they were published
+    for job in by_priority(jobs):
+        logger.info('listing {}'.format(job))
+        department_name, department_path, lesson_ids = list_job(job, scraper, http_scraper, manifest)[:3]
+        coordinator.add_lessons(department_name, department_path, lesson_ids)
+    if http_scraper:
+        http_scraper.close()
+    # workers scrape with browsers of their own, restoring the session saved by this one
+    exit_browsers(scraper, pool)
+
+    server = None
+    if args.serve:
+        host, _, port = args.serve.rpartition(':')
+        server = QueueServer(queue, host=host or '0.0.0.0', port=int(port)).start()
+
+    with metrics.phase('coordinate'):
+        failures = coordinator.run()
+
+    if server:
+        # idle workers poll for the end of the run before they stop
+        time.sleep(2 * WORK_POLL_INTERVAL)
+        server.stop()
+    queue.close()
+    manifest.close()
+    write_metrics()
+    return 1 if failures else None
+
+
+def work_command():
+    """
+    Claims and does the work items of a coordinator until it is finished
+    """
+    import socket
+    import tempfile
+
+    from artistworks_downloader.coordinator import connect, Worker, LESSON, MASTERCLASS
+    from artistworks_downloader.manifest import Manifest
+
+    worker_id = args.worker_id or '{}-{}'.format(socket.gethostname(), os.getpid())
+    kinds = args.kinds
+    scraper = pool = None
+    if LESSON in kinds or MASTERCLASS in kinds:
+        if args.username is None or args.password is None:
+            logger.info('no --username and --password, {} only downloads and unites'.format(worker_id))
+            kinds = [kind for kind in kinds if kind not in (LESSON, MASTERCLASS)]
+        else:
+            scraper, pool, _ = login()
+
+    # the coordinator keeps the manifest of the run, this one only tells which downloads of this node finished
+    manifest = Manifest(os.path.join(tempfile.gettempdir(), 'artistworks_worker_{}.sqlite'.format(
+        worker_id.replace(os.sep, '_'))))
+    worker = Worker(connect(args.coordinator), worker_id, args.output_dir,
+                    create_downloader=lambda: create_downloader(manifest), scraper=scraper, kinds=kinds,
+                    batch=args.claim_batch, lease=args.lease, unite_workers=args.unite_workers,
+                    fast_concat=not args.unite_concat_demuxer)
+    logger.info('{} working on {} items of {}'.format(worker_id, ', '.join(kinds), args.coordinator))
+    with metrics.phase('work'):
+        worker.run()
+
+    manifest.close()
+    write_metrics()
+    if scraper:
+        exit_browsers(scraper, pool)
+
+
+def status_command():
+    path = os.path.join(args.output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        print('Nothing was scraped into {} yet'.format(args.output_dir))
+        return 1
+
+    manifest = open_manifest()
+    print('Manifest {}'.format(path))
+    for department in manifest.departments():
+        print('{} (department {}) in {}: {} lessons, {} masterclasses'.format(
+            department['name'], department['number'] if department['number'] is not None else '-',
+            department['root_folder'] or '?', len(manifest.lessons(department['name'])),
+            len(manifest.masterclasses(department['name']))))
+
+    print('Downloads:')
+    for status, (count, size) in sorted(manifest.download_summary().items()):
+        print('  {:<10} {:>6} files {:>10.1f} MB'.format(status, count, size / 2 ** 20))
+    manifest.close()
+
+    queue_path = os.path.join(args.output_dir, WORK_QUEUE_NAME)
+    if os.path.exists(queue_path):
+        from artistworks_downloader.coordinator import WorkQueue
+
+        queue = WorkQueue(queue_path)
+        print('Work items{}:'.format(' (finished)' if queue.finished() else ''))
+        for (kind, state), count in sorted(queue.counts().items()):
+            print('  {:<12} {:<8} {:>6}'.format(kind, state, count))
+        queue.close()
 
-    for lesson in lessons_db.values():
-        lesson_output_folder_path = Path(args.output_dir).joinpath(args.root_folder).joinpath(department_name).joinpath(
-            get_valid_filename(lesson.name))
 
-        for lesson_link in lesson.links:
-            downloader.download_link(lesson_link, lesson_output_folder_path)
+def main(argv=None):
+    global args
+    args = parse_args(argv)
+    setup_logging()
 
-        if args.fetch_masterclasses:
-            for masterclass_id in lesson.masterclass_ids:
-                masterclass = masterclasses_db[masterclass_id]
-                masterclass_output_folder_path = lesson_output_folder_path.joinpath(
-                    get_valid_filename(masterclass.name))
-                if masterclass_output_folder_path.exists():
-                    masterclass_output_folder_path.with_name(
-                        masterclass_output_folder_path.name + 'masterclass_{}'.format(masterclass_id))
-                for masterclass_link in masterclass.links:
-                    downloader.download_link(masterclass_link, masterclass_output_folder_path)
+    if args.command != 'status' and not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
 
-    downloader.run()
+    commands = {'run': run_command, 'scrape': scrape_command, 'download': download_command,
+                'verify': verify_command, 'unite': unite_command, 'coordinate': coordinate_command,
+                'work': work_command, 'status': status_command}
+    try:
+        return commands[args.command]()
+    except DiskBudgetException as e:
+        logger.error(str(e))
+        return 1
 
-    unite_ts_videos(os.path.join(args.output_dir, args.root_folder))
 
-    scraper.exit()
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+"""
+Benchmarks of the downloader, playlist resolution, uniting and a whole main() run, against a local FakeArtistWorks.
+Every benchmark reports its time and throughput (the best of --repeat runs), and the run fails when one of them
+regressed by more than --tolerance against the stored baseline.
+
+    PYTHONPATH=src python test/benchmarks.py [--only download_mp4 ...] [--update_baseline]
+"""
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import asyncio
+import contextlib
+from collections import OrderedDict
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from artistworks_downloader.metrics import metrics
+from artistworks_downloader.scheduler import DownloadScheduler
+from artistworks_downloader.unite import unite_ts_videos
+from artistworks_downloader.video_downloader import AsyncDownloader
+from artistworks_downloader.webdriver import LessonLink
+
+from fake_artistworks import FakeArtistWorks, make_ts_sample, MP4, HLS, MIXED
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# a regression is also at least this many seconds slower, so fast benchmarks don't fail on noise
+MIN_REGRESSION_SECONDS = 0.05
+BACKOFF_BASE = 0.1
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def temporary_folder():
+    folder = tempfile.mkdtemp(prefix='artistworks_bench_')
+    try:
+        yield folder
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(folder) for f in files)
+
+
+def scheduler(loop):
+    # no host rate limit, and short backoffs when errors are injected
+    return DownloadScheduler(loop, host_rate=None, backoff_base=BACKOFF_BASE)
+
+
+def download(links, folder, **kwargs):
+    """
+    Downloads every link into folder with a fresh downloader, returns the seconds it took
+    """
+    loop = asyncio.get_event_loop()
+    downloader = AsyncDownloader(loop=loop, scheduler=scheduler(loop), **kwargs)
+    start = time.monotonic()
+    for link in links:
+        downloader.download_link(link, folder)
+    downloader.run()
+    return time.monotonic() - start
+
+
+def bench_download(server, media, **kwargs):
+    server.media = media
+    links = [LessonLink(title, url) for lesson in server.lesson_ids(1)
+             for title, url in server.video_links('lesson_{}'.format(lesson), server.videos_per_lesson)]
+    with temporary_folder() as folder:
+        seconds = download(links, folder, **kwargs)
+        size = folder_size(folder)
+    return OrderedDict([('seconds', seconds), ('bytes_per_second', size / seconds), ('files', len(links))])
+
+
+def bench_download_mp4(server, ts_sample):
+    return bench_download(server, MP4)
+
+
+def bench_download_hls_parts(server, ts_sample):
+    return bench_download(server, HLS)
+
+
+def bench_download_hls_stream(server, ts_sample):
+    return bench_download(server, HLS, hls_format='ts')
+
+
+def bench_resolve_playlists(server, ts_sample):
+    server.media = HLS
+    urls = [url for lesson in server.lesson_ids(1) for _, url in server.video_links('lesson_{}'.format(lesson), 8)]
+    loop = asyncio.get_event_loop()
+    downloader = AsyncDownloader(loop=loop, scheduler=scheduler(loop))
+    try:
+        start = time.monotonic()
+        loop.run_until_complete(asyncio.gather(*[downloader.playlists.resolve(url) for url in urls]))
+        cold = time.monotonic() - start
+
+        start = time.monotonic()
+        loop.run_until_complete(asyncio.gather(*[downloader.playlists.resolve(url) for url in urls]))
+        cached = time.monotonic() - start
+    finally:
+        downloader.close()
+    return OrderedDict([('seconds', cold), ('cached_seconds', cached), ('playlists', len(urls))])
+
+
+def bench_unite(server, ts_sample, groups=8, parts=10):
+    if ts_sample is None:
+        raise SkipBenchmark('ffmpeg is missing')
+    with temporary_folder() as folder:
+        for group in range(groups):
+            for part in range(parts):
+                with open(os.path.join(folder, 'video{}_part{}.ts'.format(group, part)), 'wb') as f:
+                    f.write(ts_sample)
+        size = folder_size(folder)
+
+        start = time.monotonic()
+        unite_ts_videos(folder)
+        seconds = time.monotonic() - start
+    return OrderedDict([('seconds', seconds), ('bytes_per_second', size / seconds), ('groups', groups)])
+
+
+class FakeBrowser(object):
+    """
+    Logs in by taking the fake site's session cookie, main() then scrapes over http with it
+    """
+
+    server = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def login_to_artistworks(self, username, password):
+        return True
+
+    def restore_session(self, cookies):
+        pass
+
+    def get_session_cookies(self):
+        return self.server.cookies
+
+    def _no_fallback(self, *args):
+        raise RuntimeError('the fake site should never need the browser')
+
+    get_department_name = get_all_lesson_ids_for_department = _no_fallback
+    get_lesson_by_id = get_masterclass_by_id = _no_fallback
+
+    def exit(self):
+        pass
+
+
+def point_at(base_url):
+    """
+    Sends every artistworks url of the already imported modules to base_url
+    """
+    bases = {'ARTISTWORKS_LOGIN': '/awentry', 'ARTISTWORKS_LESSON_BASE': '/lesson/',
+             'ARTISTWORKS_DEPARTMENT_BASE': '/media-department/', 'ARTISTWORKS_MASTERCLASS_BASE': '/masterclass/'}
+    for module in [m for name, m in sys.modules.items() if name.startswith('artistworks_downloader')]:
+        for name, path in bases.items():
+            if hasattr(module, name):
+                setattr(module, name, base_url + path)
+
+
+def bench_main(server, ts_sample):
+    server.media = MIXED
+    with temporary_folder() as folder:
+        argv = ['run', '--username', 'bench', '--password', 'bench', '--output_dir', folder,
+                '--root_folder', 'bench', '--department', '1', '--http_scrape', '--pipeline', '--fetch_masterclasses',
+                '--no_progress', '--host_rate', '0', '--backoff_base', str(BACKOFF_BASE)]
+        if ts_sample is None:
+            # nothing to unite without ffmpeg
+            argv += ['--hls_stream', 'ts']
+
+        import main
+        # main imports these as it needs them, they are patched first
+        from artistworks_downloader import webdriver, http_scraper, sync, session_store  # noqa: F401
+        webdriver.ArtistWorkScraper = FakeBrowser
+        FakeBrowser.server = server
+        point_at(server.base_url)
+
+        start = time.monotonic()
+        main.main(argv)
+        seconds = time.monotonic() - start
+        size = folder_size(os.path.join(folder, 'bench'))
+
+    results = OrderedDict([('seconds', seconds), ('bytes_per_second', size / seconds)])
+    for phase, phase_seconds in metrics.summary()['phases'].items():
+        results['{}_seconds'.format(phase)] = phase_seconds
+    return results
+
+
+BENCHMARKS = OrderedDict([
+    ('download_mp4', bench_download_mp4),
+    ('download_hls_parts', bench_download_hls_parts),
+    ('download_hls_stream', bench_download_hls_stream),
+    ('resolve_playlists', bench_resolve_playlists),
+    ('unite', bench_unite),
+    ('main', bench_main),
+])
+
+
+def best_of(results):
+    """
+    The fastest run of a benchmark
+    """
+    return min(results, key=lambda result: result['seconds'])
+
+
+def regressions(name, result, baseline, tolerance):
+    found = []
+    for key, value in result.items():
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+        if key.endswith('per_second'):
+            if value < expected * (1 - tolerance):
+                found.append('{} {}: {:.0f} < {:.0f}'.format(name, key, value, expected))
+        elif key.endswith('seconds'):
+            if value > expected * (1 + tolerance) and value - expected > MIN_REGRESSION_SECONDS:
+                found.append('{} {}: {:.3f}s > {:.3f}s'.format(name, key, value, expected))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks against a local stand-in ArtistWorks')
+    parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS), help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every benchmark, the best one counts')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    parser.add_argument('--baseline', type=str, default=BASELINE_PATH)
+    parser.add_argument('--update_baseline', default=False, action='store_true',
+                        help='store these results as the new baseline instead of comparing them')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second of every response')
+    parser.add_argument('--error_rate', type=float, default=0, help='share of media requests failing with a 503')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    ts_sample = make_ts_sample()
+
+    results = OrderedDict()
+    failures = []
+    with FakeArtistWorks(lessons=4, videos_per_lesson=4, ts_sample=ts_sample, latency=args.latency,
+                         bandwidth=args.bandwidth, error_rate=args.error_rate) as server:
+        for name in args.only or BENCHMARKS:
+            runs = []
+            try:
+                # a whole run is long enough to be measured once
+                for _ in range(1 if name == 'main' else args.repeat):
+                    metrics.reset()
+                    runs.append(BENCHMARKS[name](server, ts_sample))
+            except SkipBenchmark as e:
+                print('{:<22} skipped, {}'.format(name, e))
+                continue
+
+            results[name] = best_of(runs)
+            print('{:<22} {}'.format(name, ', '.join('{} {:.3f}'.format(key, value)
+                                                     for key, value in results[name].items())))
+            if not args.update_baseline and name in baseline:
+                failures.extend(regressions(name, results[name], baseline[name], args.tolerance))
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print('baseline written to {}'.format(args.baseline))
+        return 0
+
+    missing = [name for name in results if name not in baseline]
+    if missing:
+        print('no baseline for {}, run with --update_baseline to store one'.format(', '.join(missing)))
+
+    for failure in failures:
+        print('REGRESSION ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,375 @@
+"""
+A local stand-in for ArtistWorks, for tests and benchmarks: login, department, lesson and masterclass pages with
+jwplayer setups, synthetic mp4 files (with range requests) and HLS master/media playlists with their .ts segments.
+Latency, bandwidth and injected errors are configurable. The server runs on its own thread and event loop, so
+blocking code (and main()) can use it like the real site.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+import hashlib
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from aiohttp import web
+
+MP4 = 'mp4'
+HLS = 'hls'
+MIXED = 'mixed'
+
+SESSION_COOKIE = 'SSESSfake'
+TS_PACKET_SIZE = 188
+STREAM_CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)')
+
+# (width, height, bandwidth) of the renditions listed in every master playlist
+RENDITIONS = ((640, 360, 800000), (1280, 720, 2500000))
+
+LOGIN_PAGE = """<html><body>
+<form method="post" action="/awentry">
+<input id="edit-name" name="name"><input id="edit-pass" name="pass" type="password">
+<input id="edit-submit" type="submit" value="Log in">
+</form></body></html>"""
+
+HOME_PAGE = """<html><body>
+<div id="blk-artistworks_user-4"><div><div></div><div><div><span>fake user</span></div></div></div></div>
+</body></html>"""
+
+PAGE = """<html><body>
+<div id="tabs-wrapper"><h2>{title}</h2></div>
+{body}
+</body></html>"""
+
+
+def make_ts_sample(seconds=2):
+    """
+    A real mpeg-ts clip made by ffmpeg, so served segments can be united. None when ffmpeg is missing
+    """
+    if shutil.which('ffmpeg') is None:
+        return None
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'sample.ts')
+    try:
+        subprocess.check_call(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i',
+                               'testsrc=duration={}:size=320x240:rate=25'.format(seconds), '-f', 'lavfi', '-i',
+                               'sine=duration={}'.format(seconds), '-c:v', 'libx264', '-c:a', 'aac', '-f', 'mpegts',
+                               path])
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+class SyntheticFile(object):
+    """
+    size bytes of deterministic content, made of a block derived from the file's name
+    """
+
+    def __init__(self, name, size, sample=None):
+        self.name = name
+        self.size = size
+        if sample is not None:
+            self.block = sample
+        else:
+            seed = hashlib.sha256(name.encode('utf-8')).digest()
+            self.block = (seed * (TS_PACKET_SIZE // len(seed) + 1))[:TS_PACKET_SIZE]
+            # every packet starts with the mpeg-ts sync byte
+            self.block = (b'\x47' + self.block[1:]) * 64
+
+    @property
+    def etag(self):
+        return '"{}-{}"'.format(hashlib.md5(self.name.encode('utf-8')).hexdigest()[:16], self.size)
+
+    def read(self, start, end):
+        """
+        bytes start to end (exclusive)
+        """
+        block_size = len(self.block)
+        first = start // block_size
+        data = self.block * ((end - 1) // block_size - first + 1)
+        offset = start - first * block_size
+        return data[offset:offset + end - start]
+
+
+class FakeArtistWorks(object):
+    """
+    departments are numbered from 1, lessons of department d from d * 100 + 1 and masterclasses of lesson l
+    from l * 10 + 1. media is MP4, HLS or MIXED (alternating) for the videos of every lesson and masterclass.
+    latency is added to every request (seconds), bandwidth limits every response (bytes per second), and
+    error_rate / truncate_rate is the share of media requests answered with a 503 / cut off halfway.
+    """
+
+    def __init__(self, departments=1, lessons=4, videos_per_lesson=2, masterclasses_per_lesson=1, media=MIXED,
+                 video_size=4 * 1024 * 1024, hls_segments=8, segment_size=256 * 1024, ts_sample=None,
+                 latency=0, bandwidth=None, error_rate=0, truncate_rate=0, require_login=True, seed=0):
+        self.departments = departments
+        self.lessons = lessons
+        self.videos_per_lesson = videos_per_lesson
+        self.masterclasses_per_lesson = masterclasses_per_lesson
+        self.media = media
+        self.video_size = video_size
+        self.hls_segments = hls_segments
+        self.segment_size = len(ts_sample) if ts_sample else segment_size
+        self.ts_sample = ts_sample
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.require_login = require_login
+        self.random = random.Random(seed)
+
+        self.base_url = None
+        self.requests = 0
+        self.bytes_sent = 0
+        self.errors_injected = 0
+
+        self._loop = None
+        self._thread = None
+
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.router.add_get('/', self.home)
+        self.app.router.add_get('/awentry', self.login_page)
+        self.app.router.add_post('/awentry', self.login)
+        self.app.router.add_get(r'/media-department/{department:\d+}', self.department)
+        self.app.router.add_get(r'/lesson/{lesson:\d+}', self.lesson)
+        self.app.router.add_get(r'/masterclass/{masterclass:\d+}', self.masterclass)
+        self.app.router.add_get('/videos/{name}.mp4', self.video)
+        self.app.router.add_get('/hls/{name}/master.m3u8', self.master_playlist)
+        self.app.router.add_get(r'/hls/{name}/{height:\d+}p.m3u8', self.media_playlist)
+        self.app.router.add_get(r'/hls/{name}/{height:\d+}p/{index:\d+}.ts', self.segment)
+
+    # urls the downloader is pointed at
+
+    def department_url(self, department):
+        return '{}/media-department/{}'.format(self.base_url, department)
+
+    def lesson_url(self, lesson):
+        return '{}/lesson/{}'.format(self.base_url, lesson)
+
+    def masterclass_url(self, masterclass):
+        return '{}/masterclass/{}'.format(self.base_url, masterclass)
+
+    def lesson_ids(self, department):
+        return [department * 100 + i for i in range(1, self.lessons + 1)]
+
+    def masterclass_ids(self, lesson):
+        return [lesson * 10 + i for i in range(1, self.masterclasses_per_lesson + 1)]
+
+    def video_links(self, name, count):
+        """
+        (title, url) of count videos, urls are mp4 files or master playlists depending on media
+        """
+        links = []
+        for i in range(count):
+            video_name = '{}_{}'.format(name, i)
+            if self.media == HLS or (self.media == MIXED and i % 2):
+                url = '{}/hls/{}/master.m3u8'.format(self.base_url, video_name)
+            else:
+                url = '{}/videos/{}.mp4'.format(self.base_url, video_name)
+            links.append(('{} part {}'.format(name, i + 1), url))
+        return links
+
+    @property
+    def cookies(self):
+        """
+        The session cookie, in the format selenium's driver.get_cookies() returns
+        """
+        return [{'name': SESSION_COOKIE, 'value': 'fake', 'domain': 'localhost', 'path': '/'}]
+
+    # page rendering
+
+    @staticmethod
+    def _player(links):
+        items = ', '.join('{{title: "{}", file: "{}"}}'.format(title, url) for title, url in links)
+        playlist = ''.join('<div class="playlist-item">{}</div>'.format(title) for title, _ in links)
+        return ('<div id="player0"></div>{}\n<script type="text/javascript">\n'
+                'jwplayer("player0").setup({{playlist: [{}], width: "100%"}});\n</script>'.format(playlist, items))
+
+    def department_page(self, department):
+        rows = ''.join('<tr><td><a href="/lesson/{0}">Lesson {0}</a></td></tr>'.format(lesson)
+                       for lesson in self.lesson_ids(department))
+        body = ('<div id="media-group-table"><table class="sticky-enabled sticky-table">{}</table></div>'
+                .format(rows))
+        return PAGE.format(title='Department {}'.format(department), body=body)
+
+    def lesson_page(self, lesson):
+        masterclasses = ''.join('<a href="/masterclass/{0}">Exchange {0}</a>'.format(masterclass)
+                                for masterclass in self.masterclass_ids(lesson))
+        body = '{}\n<div class="masterclasses">{}</div>'.format(
+            self._player(self.video_links('lesson_{}'.format(lesson), self.videos_per_lesson)), masterclasses)
+        return PAGE.format(title='Lesson {}'.format(lesson), body=body)
+
+    def masterclass_page(self, masterclass):
+        # a student's video and the artist's response
+        body = self._player(self.video_links('masterclass_{}'.format(masterclass), 2))
+        return PAGE.format(title='Masterclass {}'.format(masterclass), body=body)
+
+    def media_file(self, name):
+        return SyntheticFile(name, self.video_size)
+
+    def segment_file(self, name):
+        return SyntheticFile(name, self.segment_size, sample=self.ts_sample)
+
+    # handlers
+
+    @web.middleware
+    @asyncio.coroutine
+    def _middleware(self, request, handler):
+        self.requests += 1
+        if self.latency:
+            yield from asyncio.sleep(self.latency)
+
+        path = request.path
+        is_media = path.startswith('/videos/') or path.startswith('/hls/')
+        if is_media and self.error_rate and self.random.random() < self.error_rate:
+            self.errors_injected += 1
+            return web.Response(status=503, text='injected error')
+
+        is_page = not is_media and path != '/awentry'
+        if is_page and self.require_login and request.cookies.get(SESSION_COOKIE) is None:
+            raise web.HTTPFound('/awentry')
+        return (yield from handler(request))
+
+    @staticmethod
+    def _html(content):
+        return web.Response(text=content, content_type='text/html')
+
+    @asyncio.coroutine
+    def home(self, request):
+        return self._html(HOME_PAGE)
+
+    @asyncio.coroutine
+    def login_page(self, request):
+        return self._html(LOGIN_PAGE)
+
+    @asyncio.coroutine
+    def login(self, request):
+        response = web.HTTPFound('/')
+        response.set_cookie(SESSION_COOKIE, 'fake')
+        return response
+
+    @asyncio.coroutine
+    def department(self, request):
+        return self._html(self.department_page(int(request.match_info['department'])))
+
+    @asyncio.coroutine
+    def lesson(self, request):
+        return self._html(self.lesson_page(int(request.match_info['lesson'])))
+
+    @asyncio.coroutine
+    def masterclass(self, request):
+        return self._html(self.masterclass_page(int(request.match_info['masterclass'])))
+
+    @asyncio.coroutine
+    def _send(self, request, synthetic, start=0, end=None, status=200, headers=None):
+        end = synthetic.size if end is None else end
+        response = web.StreamResponse(status=status, headers=headers or {})
+        response.content_type = 'video/MP2T' if synthetic.name.endswith('.ts') else 'video/mp4'
+        response.content_length = end - start
+        yield from response.prepare(request)
+        if request.method == 'HEAD':
+            # headers only, like a real server
+            yield from response.write_eof()
+            return response
+
+        if self.truncate_rate and self.random.random() < self.truncate_rate:
+            # the connection drops halfway through the body
+            self.errors_injected += 1
+            end = start + (end - start) // 2
+            truncated = True
+        else:
+            truncated = False
+
+        position = start
+        while position < end:
+            chunk = synthetic.read(position, min(end, position + STREAM_CHUNK_SIZE))
+            yield from response.write(chunk)
+            self.bytes_sent += len(chunk)
+            position += len(chunk)
+            if self.bandwidth:
+                yield from asyncio.sleep(len(chunk) / self.bandwidth)
+
+        if truncated:
+            request.transport.close()
+            return response
+        yield from response.write_eof()
+        return response
+
+    @asyncio.coroutine
+    def video(self, request):
+        synthetic = self.media_file(request.match_info['name'] + '.mp4')
+        headers = {'Accept-Ranges': 'bytes', 'ETag': synthetic.etag}
+
+        match = RANGE_RE.match(request.headers.get('Range', ''))
+        if_range = request.headers.get('If-Range')
+        if match and (if_range is None or if_range == synthetic.etag):
+            start = int(match.group(1) or 0)
+            end = int(match.group(2)) + 1 if match.group(2) else synthetic.size
+            if start >= synthetic.size:
+                return web.Response(status=416, headers={'Content-Range': 'bytes */{}'.format(synthetic.size)})
+            end = min(end, synthetic.size)
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, synthetic.size)
+            return (yield from self._send(request, synthetic, start, end, status=206, headers=headers))
+        return (yield from self._send(request, synthetic, headers=headers))
+
+    @asyncio.coroutine
+    def master_playlist(self, request):
+        lines = ['#EXTM3U']
+        for width, height, bandwidth in RENDITIONS:
+            lines.append('#EXT-X-STREAM-INF:BANDWIDTH={},RESOLUTION={}x{}'.format(bandwidth, width, height))
+            lines.append('{}p.m3u8'.format(height))
+        return web.Response(text='\n'.join(lines) + '\n', content_type='application/vnd.apple.mpegurl')
+
+    @asyncio.coroutine
+    def media_playlist(self, request):
+        height = request.match_info['height']
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:0']
+        for index in range(self.hls_segments):
+            lines += ['#EXTINF:2.0,', '{}p/{}.ts'.format(height, index)]
+        lines.append('#EXT-X-ENDLIST')
+        return web.Response(text='\n'.join(lines) + '\n', content_type='application/vnd.apple.mpegurl')
+
+    @asyncio.coroutine
+    def segment(self, request):
+        name = '{name}_{height}p_{index}.ts'.format(**request.match_info)
+        return (yield from self._send(request, self.segment_file(name)))
+
+    # lifetime
+
+    def _serve(self, ready):
+        asyncio.set_event_loop(self._loop)
+        handler = self.app.make_handler(loop=self._loop)
+        server = self._loop.run_until_complete(self._loop.create_server(handler, '127.0.0.1', 0))
+        # localhost rather than the address, cookie jars don't keep cookies of ip addresses
+        self.base_url = 'http://localhost:{}'.format(server.sockets[0].getsockname()[1])
+        ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            server.close()
+            self._loop.run_until_complete(server.wait_closed())
+            self._loop.run_until_complete(handler.shutdown(1))
+            self._loop.close()
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(ready,), daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
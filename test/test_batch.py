@@ -0,0 +1,117 @@
+import asyncio
+from collections import OrderedDict
+import os
+
+import pytest
+
+from artistworks_downloader import scraper_pool, webdriver
+from artistworks_downloader.batch import Job, parse_job, read_jobs, by_priority, PriorityDownloads
+from artistworks_downloader.models import Lesson, LessonLink
+
+from fake_artistworks import FakeArtistWorks, MP4
+
+
+def test_parse_jobs(tmpdir):
+    assert parse_job('12') == Job(12, None, 0)
+    assert parse_job('lessons:101, 102@5') == Job(None, ['101', '102'], 5)
+    with pytest.raises(ValueError):
+        parse_job('guitar@high')
+
+    path = tmpdir.join('jobs.txt')
+    path.write('# weekly\n12@1\n\n15@10\n12@1\n')
+    assert [job.department for job in by_priority(read_jobs(str(path)))] == [15, 12, 12]
+
+
+class FakeDownloader(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.started = []
+        self.running = 0
+        self.most_running = 0
+
+    def download_link(self, link, output_folder_path):
+        self.started.append(link)
+        return asyncio.Task(self.download())
+
+    @asyncio.coroutine
+    def download(self):
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        yield from asyncio.sleep(0.01)
+        self.running -= 1
+
+    def close(self):
+        pass
+
+
+def test_priority_downloads_bounded():
+    downloader = FakeDownloader(asyncio.get_event_loop())
+    queue = PriorityDownloads(downloader, in_flight=2)
+    for priority, link in [(0, 'low1'), (5, 'high1'), (0, 'low2'), (5, 'high2'), (1, 'mid')]:
+        queue.put(priority, link, None)
+    queue.run()
+
+    assert downloader.started == ['high1', 'high2', 'mid', 'low1', 'low2']
+    assert downloader.most_running == 2
+
+
+class FakeBrowser(object):
+    """
+    Scrapes the fake site's lessons without a browser, and fails like a closed one once it exited
+    """
+
+    server = None
+
+    def __init__(self, *args, **kwargs):
+        self.closed = False
+
+    def _check(self):
+        if self.closed:
+            raise RuntimeError('the browser was closed')
+
+    def login_to_artistworks(self, username, password):
+        return True
+
+    def get_session_cookies(self):
+        return []
+
+    def load_session_cookies(self, cookies):
+        pass
+
+    def get_department_name(self, department_id):
+        self._check()
+        return 'Department {}'.format(department_id)
+
+    def get_all_lesson_ids_for_department(self, department_id):
+        self._check()
+        return OrderedDict((str(lesson_id), 'Lesson {}'.format(lesson_id))
+                           for lesson_id in self.server.lesson_ids(department_id))
+
+    def get_lesson_by_id(self, lesson_id):
+        self._check()
+        links = [LessonLink(title, url) for title, url in self.server.video_links('lesson_{}'.format(lesson_id), 2)]
+        return Lesson(lesson_id, 'Lesson {}'.format(lesson_id), links, [])
+
+    def exit(self):
+        self.closed = True
+
+    quit = exit
+
+
+def test_batch_with_scraper_pool(tmpdir, monkeypatch):
+    import main
+
+    monkeypatch.setattr(webdriver, 'ArtistWorkScraper', FakeBrowser)
+    monkeypatch.setattr(scraper_pool, 'ArtistWorkScraper', FakeBrowser)
+    output_dir = str(tmpdir)
+    with FakeArtistWorks(departments=2, lessons=2, media=MP4, video_size=16 * 1024, require_login=False) as server:
+        FakeBrowser.server = server
+        main.main(['run', '--username', 'u', '--password', 'p', '--output_dir', output_dir, '--root_folder', 'artist',
+                   '--batch', '1', '2', '--scrape_workers', '2', '--no_session', '--no_progress'])
+
+    # the second job was listed by the logged in browser, still open after the pool scraped the first one
+    for department_id in (1, 2):
+        for lesson_id in server.lesson_ids(department_id):
+            folder = os.path.join(output_dir, 'artist', 'Department {}'.format(department_id),
+                                  'Lesson_{}'.format(lesson_id))
+            assert len(os.listdir(folder)) == 2
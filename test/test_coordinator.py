@@ -0,0 +1,127 @@
+import asyncio
+import os
+import threading
+
+from artistworks_downloader.coordinator import WorkQueue, QueueServer, RemoteQueue, Coordinator, Worker, LESSON, \
+    DOWNLOAD, UNITE, APPLIED, FAILED
+from artistworks_downloader.manifest import Manifest
+from artistworks_downloader.models import Lesson, Masterclass, LessonLink
+from artistworks_downloader.video_downloader import AsyncDownloader, get_valid_filename
+
+from fake_artistworks import FakeArtistWorks, MP4
+
+
+def test_leases(tmpdir):
+    queue = WorkQueue(str(tmpdir.join('work.sqlite')), max_attempts=2)
+    assert queue.publish(DOWNLOAD, 'a', {'n': 1})
+    assert not queue.publish(DOWNLOAD, 'a', {'n': 2})
+    queue.publish(LESSON, 'b', {'n': 3})
+
+    assert queue.claim('w1', kinds=[LESSON], limit=5) == [(2, LESSON, 'b', None, {'n': 3}, 1)]
+    # a lease that already ran out, as if w1 died holding it
+    item, = queue.claim('w1', kinds=[DOWNLOAD], lease=-1)
+    again, = queue.claim('w2', kinds=[DOWNLOAD])
+    assert (again.id, again.attempts) == (item.id, 2)
+    assert queue.heartbeat('w1', [item.id, 2]) == [2]
+    queue.fail('w2', again.id, 'boom')
+    # no attempts left
+    assert queue.claim('w2') == []
+    assert queue.failures() == [(DOWNLOAD, 'a', 'boom')]
+
+    # w1 was slow, not dead: its result still counts
+    assert queue.complete('w1', 2, ['done'])
+    assert not queue.complete('w2', 2, ['done again'])
+    (done, result), = queue.results()
+    assert (done.key, result) == ('b', ['done'])
+    queue.applied(done.id)
+    assert queue.counts() == {(DOWNLOAD, FAILED): 1, (LESSON, APPLIED): 1}
+    assert queue.idle() and not queue.finished()
+    queue.close()
+
+
+class FakeScraper(object):
+    def __init__(self, server):
+        self.server = server
+
+    def _links(self, name, count):
+        return [LessonLink(title, url) for title, url in self.server.video_links(name, count)]
+
+    def get_lesson_by_id(self, lesson_id):
+        return Lesson(lesson_id, 'Lesson {}'.format(lesson_id), self._links('lesson_{}'.format(lesson_id), 2),
+                      [str(masterclass_id) for masterclass_id in self.server.masterclass_ids(int(lesson_id))])
+
+    def get_masterclass_by_id(self, masterclass_id, lesson_name=None):
+        return Masterclass(masterclass_id, 'Masterclass {}'.format(masterclass_id),
+                           self._links('masterclass_{}'.format(masterclass_id), 2))
+
+
+def lesson_downloads(lesson, department_path, masterclasses_db):
+    folder = department_path.joinpath(get_valid_filename(lesson.name))
+    downloads = [(link, folder) for link in lesson.links]
+    for masterclass_id in lesson.masterclass_ids:
+        if masterclass_id in masterclasses_db:
+            downloads.extend((link, folder.joinpath(masterclasses_db[masterclass_id].name))
+                             for link in masterclasses_db[masterclass_id].links)
+    return folder, downloads
+
+
+def test_coordinated_run(tmpdir):
+    output_dir = str(tmpdir.join('output'))
+    queue = WorkQueue(str(tmpdir.join('work.sqlite')))
+    failures = []
+
+    def coordinate():
+        manifest = Manifest(str(tmpdir.join('manifest.sqlite')))
+        coordinator = Coordinator(queue, manifest, output_dir, lesson_downloads, fetch_masterclasses=True,
+                                  poll_interval=0.05)
+        coordinator.add_lessons('Department 1', os.path.join(output_dir, 'artist', 'Department 1'),
+                                ['101', '102'])
+        failures.extend(coordinator.run())
+        manifest.close()
+
+    with FakeArtistWorks(lessons=2, media=MP4, video_size=64 * 1024, require_login=False) as server:
+        queue.start()
+        thread = threading.Thread(target=coordinate)
+        thread.start()
+        served = QueueServer(queue).start()
+
+        local = Manifest(str(tmpdir.join('worker.sqlite')))
+        worker = Worker(RemoteQueue(served.url), 'w1', output_dir, scraper=FakeScraper(server), poll_interval=0.05,
+                        create_downloader=lambda: AsyncDownloader(loop=asyncio.get_event_loop(), manifest=local))
+        worker.run()
+        thread.join()
+        served.stop()
+
+    assert failures == []
+    assert queue.counts()[(DOWNLOAD, APPLIED)] == 2 * (2 + 2)
+    assert queue.counts()[(UNITE, APPLIED)] == 2
+
+    manifest = Manifest(str(tmpdir.join('manifest.sqlite')))
+    assert sorted(manifest.lessons('Department 1')) == ['101', '102']
+    finished = manifest.finished_downloads()
+    assert len(finished) == 8 and all(download['sha256'] for download in finished)
+    assert os.path.exists(os.path.join(output_dir, 'artist', 'Department 1', 'Lesson_101', 'Masterclass 1011',
+                                       get_valid_filename('masterclass_1011 part 2') + '.mp4'))
+    manifest.close()
+    queue.close()
+
+
+def test_download_results_are_the_item_files(tmpdir):
+    output_dir = str(tmpdir.join('output'))
+    queue = WorkQueue(str(tmpdir.join('work.sqlite')))
+    with FakeArtistWorks(media=MP4, video_size=16 * 1024, require_login=False) as server:
+        # names one of which starts with the other
+        for name in ('Lesson 1', 'Lesson 1.5'):
+            (_, url), = server.video_links(name.replace(' ', '_'), 1)
+            queue.publish(DOWNLOAD, name, {'name': name, 'url': url, 'folder': 'lessons'})
+        queue.finish()
+
+        local = Manifest(str(tmpdir.join('worker.sqlite')))
+        Worker(queue, 'w1', output_dir, kinds=[DOWNLOAD], poll_interval=0.05,
+               create_downloader=lambda: AsyncDownloader(loop=asyncio.get_event_loop(), manifest=local)).run()
+
+    results = {item.key: [download['path'] for download in result] for item, result in queue.results()}
+    assert results == {'Lesson 1': [os.path.join('lessons', get_valid_filename('Lesson 1') + '.mp4')],
+                       'Lesson 1.5': [os.path.join('lessons', get_valid_filename('Lesson 1.5') + '.mp4')]}
+    local.close()
+    queue.close()
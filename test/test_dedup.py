@@ -0,0 +1,46 @@
+import asyncio
+import os
+
+from artistworks_downloader.dedup import normalize_url, link_file
+from artistworks_downloader.video_downloader import AsyncDownloader
+
+
+def test_normalize_url():
+    assert normalize_url('HTTP://Cdn.Example.com:80/a/b.mp4?b=2&a=1&token=x#t') == \
+        normalize_url('http://cdn.example.com/a/b.mp4?a=1&b=2&token=y')
+    assert normalize_url('http://cdn.example.com/a/b.mp4?a=1') != normalize_url('http://cdn.example.com/a/b.mp4?a=2')
+
+
+def test_link_file(tmpdir):
+    source, target = str(tmpdir.join('a.mp4')), str(tmpdir.join('b.mp4'))
+    with open(source, 'wb') as f:
+        f.write(b'video')
+    link_file(source, target)
+    with open(target, 'rb') as f:
+        assert f.read() == b'video'
+
+
+def test_same_url_downloaded_once(tmpdir):
+    loop = asyncio.get_event_loop()
+    downloader = AsyncDownloader(loop=loop)
+    downloads = []
+
+    def download(path):
+        @asyncio.coroutine
+        def fetch():
+            downloads.append(path)
+            yield from asyncio.sleep(0.01)
+            with open(path, 'wb') as f:
+                f.write(b'video')
+            return 'digest'
+        return fetch
+
+    paths = [str(tmpdir.join('lesson{}.mp4'.format(i))) for i in range(3)]
+    url = 'http://cdn.example.com/video.mp4?token={}'
+    loop.run_until_complete(asyncio.gather(*[
+        downloader._deduplicated(url.format(i), path, download(path)) for i, path in enumerate(paths)]))
+    downloader.close()
+
+    assert downloads == paths[:1]
+    assert all(os.path.exists(path) for path in paths)
+    assert downloader.dedup_stats.files['url'] == 2
@@ -0,0 +1,45 @@
+from http.cookiejar import CookieJar
+from urllib.request import build_opener, HTTPCookieProcessor, Request
+
+from bs4 import BeautifulSoup
+
+from artistworks_downloader.http_scraper import parse_jwplayer_setup
+from artistworks_downloader.webdriver import parse_department_lessons, parse_masterclass_ids, parse_page_title
+
+from fake_artistworks import FakeArtistWorks, SyntheticFile, MIXED
+
+
+def test_pages_parse_like_the_real_site():
+    server = FakeArtistWorks(lessons=3, videos_per_lesson=2, media=MIXED)
+    server.base_url = 'http://localhost:1'
+
+    department = BeautifulSoup(server.department_page(1), 'html.parser')
+    assert parse_page_title(department) == 'Department 1'
+    assert list(parse_department_lessons(department)) == ['101', '102', '103']
+
+    content = server.lesson_page(101)
+    lesson = BeautifulSoup(content, 'html.parser')
+    assert parse_masterclass_ids(lesson) == ['1011']
+    assert parse_jwplayer_setup(content) == [('lesson_101 part 1', 'http://localhost:1/videos/lesson_101_0.mp4'),
+                                             ('lesson_101 part 2', 'http://localhost:1/hls/lesson_101_1/master.m3u8')]
+
+
+def test_synthetic_file_ranges():
+    synthetic = SyntheticFile('a.mp4', 100000)
+    whole = synthetic.read(0, synthetic.size)
+    assert len(whole) == synthetic.size
+    assert synthetic.read(12345, 23456) == whole[12345:23456]
+
+
+def test_server_login_and_ranges():
+    with FakeArtistWorks(video_size=1000) as server:
+        opener = build_opener(HTTPCookieProcessor(CookieJar()))
+        assert 'edit-name' in opener.open(server.lesson_url(101)).read().decode()
+
+        opener.open(Request(server.base_url + '/awentry', data=b'name=a&pass=b'))
+        assert 'jwplayer' in opener.open(server.lesson_url(101)).read().decode()
+
+        response = opener.open(Request(server.base_url + '/videos/lesson_101_0.mp4', headers={'Range': 'bytes=10-'}))
+        assert response.status == 206
+        assert response.headers['Content-Range'] == 'bytes 10-999/1000'
+        assert response.read() == SyntheticFile('lesson_101_0.mp4', 1000).read(10, 1000)
@@ -0,0 +1,48 @@
+import asyncio
+
+from artistworks_downloader.hls import select_rendition, parse_playlist, PlaylistResolver, MAX_BANDWIDTH
+
+MASTER = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360
+360.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=5000000,RESOLUTION=1280x720
+720.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=4000000,RESOLUTION=1920x1080
+1080.m3u8
+"""
+
+MEDIA = """#EXTM3U
+#EXT-X-TARGETDURATION:10
+#EXTINF:10,
+seg0.ts
+#EXTINF:10,
+seg1.ts
+#EXT-X-ENDLIST
+"""
+
+
+def test_select_rendition():
+    master = parse_playlist(MASTER, 'http://a/video/master.m3u8')
+    assert select_rendition(master).uri == '1080.m3u8'
+    assert select_rendition(master, MAX_BANDWIDTH).uri == '720.m3u8'
+    assert select_rendition(master, max_height=720).uri == '720.m3u8'
+    # nothing fits the cap, the smallest one is the closest
+    assert select_rendition(master, max_height=240).uri == '360.m3u8'
+
+
+def test_resolver_caches_playlists():
+    fetched = []
+
+    @asyncio.coroutine
+    def fetch(url):
+        fetched.append(url)
+        yield from asyncio.sleep(0)
+        return MASTER if url.endswith('master.m3u8') else MEDIA
+
+    loop = asyncio.get_event_loop()
+    resolver = PlaylistResolver(fetch, loop, max_height=720)
+    first, second = loop.run_until_complete(asyncio.gather(resolver.resolve('http://a/video/master.m3u8'),
+                                                           resolver.resolve('http://a/video/master.m3u8')))
+    assert first == second == ['http://a/video/seg0.ts', 'http://a/video/seg1.ts']
+    assert loop.run_until_complete(resolver.resolve('http://a/video/master.m3u8')) == first
+    assert fetched == ['http://a/video/master.m3u8', 'http://a/video/720.m3u8']
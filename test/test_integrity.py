@@ -0,0 +1,44 @@
+import os
+
+from artistworks_downloader.integrity import ContentHash, hash_file, verify_downloads, UNCHANGED, VERIFIED, CORRUPT
+from artistworks_downloader.manifest import Manifest
+
+BLOCK = 1024
+
+
+def test_ranges_hash_like_the_whole_file(tmpdir):
+    data = os.urandom(BLOCK * 5 + 100)
+    path = tmpdir.join('video.mp4')
+    path.write_binary(data)
+
+    hasher = ContentHash(BLOCK)
+    # two ranges streaming interleaved, the second one joined halfway through a block
+    for offset in range(0, BLOCK * 3, 256):
+        hasher.update(offset, data[offset:offset + 256])
+        second = BLOCK * 3 + 512 + offset
+        hasher.update(second, data[second:second + 256])
+
+    assert hasher.finish(str(path), len(data)) == hash_file(str(path), BLOCK)
+
+
+def test_verify_skips_unchanged_and_finds_corrupt(tmpdir):
+    manifest = Manifest(str(tmpdir.join('manifest.sqlite')))
+    paths = []
+    for name in ('good.mp4', 'touched.mp4', 'truncated.mp4'):
+        path = tmpdir.join(name)
+        path.write_binary(b'x' * 3000)
+        stat = os.stat(str(path))
+        manifest.download_finished(str(path), size=stat.st_size, url='http://a/' + name, sha256=hash_file(str(path)),
+                                   mtime=stat.st_mtime)
+        paths.append(str(path))
+
+    os.utime(paths[1], (0, 0))
+    with open(paths[2], 'r+b') as f:
+        f.truncate(1000)
+
+    summary = verify_downloads(manifest, workers=2)
+    assert [d['path'] for d in summary.results[UNCHANGED]] == paths[:1]
+    assert [d['path'] for d in summary.results[VERIFIED]] == paths[1:2]
+    assert [d['path'] for d in summary.results[CORRUPT]] == paths[2:]
+    assert manifest.download_status(paths[2]) == 'corrupt'
+    assert paths[2] not in manifest.completed_downloads()
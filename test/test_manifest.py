@@ -0,0 +1,89 @@
+import os
+import shelve
+
+from artistworks_downloader.manifest import Manifest, DONE, UNITED
+from artistworks_downloader.models import Lesson, Masterclass, LessonLink
+
+
+def test_lessons_view(tmpdir):
+    manifest = Manifest(os.path.join(str(tmpdir), 'manifest.sqlite'))
+    lessons = manifest.lessons('Guitar')
+    lesson = Lesson(id='1', name='Blues', links=[LessonLink('intro', 'http://a/1.mp4'),
+                                                 LessonLink('solo', 'http://a/2.mp4')],
+                    masterclass_ids=['7', '8'])
+    lessons['1'] = lesson
+    assert '1' in lessons
+    assert '2' not in lessons
+    assert lessons['1'] == lesson
+    assert lessons.values() == [lesson]
+    # departments don't share lessons
+    assert '1' not in manifest.lessons('Piano')
+    manifest.close()
+
+    reopened = Manifest(os.path.join(str(tmpdir), 'manifest.sqlite'))
+    assert list(reopened.lessons('Guitar')) == ['1']
+    reopened.close()
+
+
+def test_download_state(tmpdir):
+    manifest = Manifest(os.path.join(str(tmpdir), 'manifest.sqlite'))
+    path = os.path.join(str(tmpdir), 'video_part0.ts')
+    manifest.download_started(path, 'http://a/0.ts')
+    manifest.download_failed(path, IOError('reset'))
+    manifest.download_started(path, 'http://a/0.ts')
+    manifest.download_finished(path, size=10)
+    manifest.parts_united([path], os.path.join(str(tmpdir), 'video.mp4'), size=10)
+
+    assert manifest.download_status(path) == UNITED
+    assert manifest.completed_downloads() == {path, os.path.join(str(tmpdir), 'video.mp4')}
+    assert manifest._read('SELECT attempts FROM downloads WHERE path = ?', (path,)) == [(2,)]
+
+
+def test_departments_summary(tmpdir):
+    manifest = Manifest(os.path.join(str(tmpdir), 'manifest.sqlite'))
+    manifest.department_id('Guitar', number=12)
+    # a later scrape records the folder, without forgetting the number
+    manifest.department_id('Guitar', root_folder='Artist')
+    manifest.download_finished(os.path.join(str(tmpdir), 'a.mp4'), size=10)
+    manifest.download_finished(os.path.join(str(tmpdir), 'b.mp4'), size=5)
+    manifest.download_failed(os.path.join(str(tmpdir), 'c.mp4'), IOError('reset'))
+
+    assert manifest.departments() == [{'name': 'Guitar', 'number': 12, 'root_folder': 'Artist'}]
+    assert manifest.download_summary()[DONE] == (2, 15)
+    manifest.close()
+
+
+def test_migrate_shelves(tmpdir):
+    folder = str(tmpdir)
+    with shelve.open(os.path.join(folder, 'Guitar_masterclasses.db')) as shelf:
+        shelf['7'] = Masterclass(id='7', name='answer', links=[LessonLink('answer', 'http://a/7.mp4')])
+
+    manifest = Manifest(os.path.join(folder, 'manifest.sqlite'))
+    manifest.migrate_shelves(folder, 'Guitar')
+    manifest.migrate_shelves(folder, 'Guitar')
+    assert dict(manifest.masterclasses('Guitar').items()) == {
+        '7': Masterclass(id='7', name='answer', links=[LessonLink('answer', 'http://a/7.mp4')])}
+    assert len(manifest.lessons('Guitar')) == 0
+
+
+def test_lookups_keep_writes_batched(tmpdir):
+    manifest = Manifest(os.path.join(str(tmpdir), 'manifest.sqlite'), batch_size=1000, commit_interval=60)
+    lessons = manifest.lessons('Guitar')
+    manifest.flush()
+    for lesson_id in ('3', '1', '2'):
+        assert lesson_id not in lessons
+        lessons[lesson_id] = Lesson(id=lesson_id, name='Lesson ' + lesson_id,
+                                    links=[LessonLink('intro', 'http://a/{}.mp4'.format(lesson_id))],
+                                    masterclass_ids=())
+        assert lessons[lesson_id].masterclass_ids == []
+    del lessons['1']
+    assert '1' not in lessons
+    # nothing was committed by the lookups
+    assert manifest._pending
+
+    lessons['1'] = Lesson(id='1', name='Lesson 1 again', links=[], masterclass_ids=[])
+    lessons['3'] = Lesson(id='3', name='Lesson 3 again', links=[], masterclass_ids=[])
+    # in the order they were first scraped
+    assert [lesson.name for lesson in lessons.values()] == ['Lesson 3 again', 'Lesson 2', 'Lesson 1 again']
+    assert not manifest._pending
+    manifest.close()
@@ -0,0 +1,42 @@
+import json
+
+from artistworks_downloader.metrics import Metrics, Histogram
+
+
+def test_histogram_summary_and_prometheus():
+    metrics = Metrics()
+    for value in (0.2, 0.4, 3):
+        metrics.observe('download_file_seconds', value, buckets=[0.5, 1, 5])
+    metrics.increment('download_retries_total')
+    with metrics.phase('download'):
+        pass
+
+    summary = metrics.summary()['histograms']['download_file_seconds']
+    assert summary['count'] == 3
+    assert summary['max'] == 3
+    assert summary['p50'] == 0.4
+
+    text = metrics.prometheus()
+    assert 'artistworks_download_retries_total 1' in text
+    assert 'artistworks_download_file_seconds_bucket{le="0.5"} 2' in text
+    assert 'artistworks_download_file_seconds_bucket{le="+Inf"} 3' in text
+    assert 'artistworks_phase_seconds{phase="download"}' in text
+
+
+def test_write_json(tmpdir):
+    metrics = Metrics()
+    metrics.increment('downloads_completed_total', 2)
+    with open(metrics.write_json(str(tmpdir.join('metrics')))) as f:
+        run = json.load(f)
+    assert run['counters'] == {'downloads_completed_total': 2}
+
+
+def test_histogram_memory_is_bounded():
+    histogram = Histogram(buckets=[10, 100], sample_size=100)
+    for value in range(1000):
+        histogram.observe(value)
+    assert len(histogram.sample) == 100
+    assert (histogram.count, histogram.sum, histogram.min, histogram.max) == (1000, 499500, 0, 999)
+    assert histogram.counts == [11, 90]
+    # from a uniform sample, roughly in the middle
+    assert 200 < histogram.quantile(0.5) < 800
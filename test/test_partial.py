@@ -0,0 +1,123 @@
+import asyncio
+import os
+import shutil
+
+from artistworks_downloader.partial import PartialDownload, parse_content_range
+from artistworks_downloader.video_downloader import AsyncDownloader
+
+from fake_artistworks import FakeArtistWorks, MP4
+
+
+class FakeResponse(object):
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+
+
+def test_parse_content_range():
+    assert parse_content_range('bytes 100-199/1000') == (100, 199, 1000)
+    assert parse_content_range('bytes 100-199/*') == (100, 199, None)
+    assert parse_content_range(None) is None
+
+
+def test_resume_after_interruption(tmpdir):
+    path = os.path.join(str(tmpdir), 'video.mp4')
+    partial = PartialDownload(path)
+    partial.update_from_response('http://a/video.mp4', FakeResponse(200, {'ETag': '"v1"', 'Content-Length': '10'}))
+    with open(partial.part_path, 'wb') as f:
+        # the last bytes were still being written when the download was killed
+        f.write(b'12345\0\0\0')
+    partial.written = 5
+    partial.save()
+
+    resumed = PartialDownload(path)
+    assert resumed.load()
+    assert resumed.resume_headers('http://a/video.mp4') == {'Range': 'bytes=5-', 'If-Range': '"v1"'}
+    # a different url always starts over
+    assert resumed.resume_headers('http://b/video.mp4') == {}
+
+    offset = resumed.update_from_response('http://a/video.mp4',
+                                          FakeResponse(206, {'ETag': '"v1"', 'Content-Range': 'bytes 5-9/10'}))
+    assert offset == 5
+    assert resumed.length == 10
+
+    with open(resumed.part_path, 'r+b') as f:
+        f.truncate(offset)
+        f.seek(offset)
+        f.write(b'67890')
+    resumed.complete()
+    assert os.listdir(str(tmpdir)) == ['video.mp4']
+    with open(path, 'rb') as f:
+        assert f.read() == b'1234567890'
+
+
+def test_weak_etag_is_not_used_for_if_range(tmpdir):
+    partial = PartialDownload(os.path.join(str(tmpdir), 'video.mp4'))
+    partial.etag = 'W/"v1"'
+    partial.last_modified = 'Wed, 21 Oct 2015 07:28:00 GMT'
+    assert partial.validator == partial.last_modified
+
+
+def kill_download(loop, downloader, url, path, seconds):
+    """
+    Runs a download for seconds, then puts back the part file and sidecar as a killed process would leave them:
+    the loop never gets to run the cleanups
+    """
+    partial = PartialDownload(path)
+    folder, filename = os.path.split(path)
+    task = loop.create_task(downloader.async_download_video(url, folder, filename))
+    loop.run_until_complete(asyncio.wait([task], timeout=seconds))
+    shutil.copy(partial.sidecar_path, partial.sidecar_path + '.killed')
+    shutil.copy(partial.part_path, partial.part_path + '.killed')
+    task.cancel()
+    loop.run_until_complete(asyncio.wait([task]))
+    downloader.close()
+    os.replace(partial.sidecar_path + '.killed', partial.sidecar_path)
+    os.replace(partial.part_path + '.killed', partial.part_path)
+    assert partial.load()
+    return partial
+
+
+def test_resume_killed_segmented_download(tmpdir):
+    loop = asyncio.get_event_loop()
+    size = 8 * 1024 * 1024
+    with FakeArtistWorks(media=MP4, video_size=size, bandwidth=8 * 1024 * 1024, require_login=False) as server:
+        (_, url), = server.video_links('lesson_101', 1)
+        path = str(tmpdir.join('video.mp4'))
+        downloader = AsyncDownloader(loop=loop, segment_threshold=1024 * 1024, save_interval=256 * 1024)
+        partial = kill_download(loop, downloader, url, path, 0.3)
+
+        assert len(partial.segments) == 2
+        saved = sum(written for _, _, written in partial.segments)
+        assert all(written for _, _, written in partial.segments)
+
+        sent = server.bytes_sent
+        downloader = AsyncDownloader(loop=loop, segment_threshold=1024 * 1024)
+        loop.run_until_complete(downloader.async_download_video(url, str(tmpdir), 'video.mp4'))
+        downloader.close()
+        assert server.bytes_sent - sent == size - saved
+
+    with open(path, 'rb') as f:
+        assert f.read() == server.media_file('lesson_101_0.mp4').read(0, size)
+    assert not os.path.exists(partial.sidecar_path)
+
+
+def test_resume_killed_stream_download(tmpdir):
+    loop = asyncio.get_event_loop()
+    size = 4 * 1024 * 1024
+    with FakeArtistWorks(media=MP4, video_size=size, bandwidth=8 * 1024 * 1024, require_login=False) as server:
+        (_, url), = server.video_links('lesson_101', 1)
+        path = str(tmpdir.join('video.mp4'))
+        downloader = AsyncDownloader(loop=loop, segments=1, save_interval=256 * 1024)
+        partial = kill_download(loop, downloader, url, path, 0.3)
+        # resumed from the bytes known to be written, not from the size of the part file
+        assert 0 < partial.written == partial.resume_offset <= partial.offset
+
+        sent = server.bytes_sent
+        downloader = AsyncDownloader(loop=loop, segments=1)
+        loop.run_until_complete(downloader.async_download_video(url, str(tmpdir), 'video.mp4'))
+        downloader.close()
+        assert server.bytes_sent - sent == size - partial.written
+
+    with open(path, 'rb') as f:
+        assert f.read() == server.media_file('lesson_101_0.mp4').read(0, size)
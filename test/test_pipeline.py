@@ -0,0 +1,51 @@
+import asyncio
+import os
+
+import pytest
+
+from artistworks_downloader.models import LessonLink
+from artistworks_downloader.pipeline import Pipeline
+from artistworks_downloader.video_downloader import AsyncDownloader, get_valid_filename
+
+from fake_artistworks import FakeArtistWorks, MP4
+
+
+def lesson(server, folder, lesson_id):
+    links = [LessonLink(title, url) for title, url in server.video_links('lesson_{}'.format(lesson_id), 2)]
+    return folder, [(link, folder) for link in links]
+
+
+def test_failed_scrape_keeps_scraped_lessons(tmpdir):
+    with FakeArtistWorks(media=MP4, video_size=256 * 1024, bandwidth=4 * 1024 * 1024,
+                         require_login=False) as server:
+        def lessons():
+            yield lesson(server, str(tmpdir.join('101')), 101)
+            yield lesson(server, str(tmpdir.join('102')), 102)
+            raise RuntimeError('the browser crashed')
+
+        downloader = AsyncDownloader(loop=asyncio.get_event_loop())
+        with pytest.raises(RuntimeError):
+            Pipeline(downloader, unite=False).run(lessons())
+
+    # downloads of the lessons scraped before the failure still finished
+    for lesson_id in (101, 102):
+        for i in (1, 2):
+            name = get_valid_filename('lesson_{} part {}'.format(lesson_id, i)) + '.mp4'
+            assert os.path.getsize(str(tmpdir.join(str(lesson_id), name))) == 256 * 1024
+
+
+class BrokenDownloader(AsyncDownloader):
+    def download_link(self, link, output_folder_path):
+        if '103' in str(output_folder_path):
+            raise OSError('no space left on device')
+        return super(BrokenDownloader, self).download_link(link, output_folder_path)
+
+
+def test_failed_download_stage_stops_the_scraper(tmpdir):
+    with FakeArtistWorks(media=MP4, video_size=64 * 1024, require_login=False) as server:
+        # many more lessons than the queue holds, the scraper is blocked when downloading breaks
+        lessons = (lesson(server, str(tmpdir.join(str(lesson_id))), lesson_id) for lesson_id in range(101, 160))
+        downloader = BrokenDownloader(loop=asyncio.get_event_loop())
+        with pytest.raises(OSError):
+            Pipeline(downloader, unite=False, queue_size=1).run(lessons)
+    assert not downloader.tasks
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from artistworks_downloader.exceptions import DiskBudgetException
+from artistworks_downloader.models import LessonLink
+from artistworks_downloader.planner import Plan, PlannedDownload, DownloadPlanner
+from artistworks_downloader.video_downloader import AsyncDownloader
+
+from fake_artistworks import FakeArtistWorks, MIXED
+
+
+def planned(lesson, name, size, is_playlist=False, priority=0, url=None):
+    link = LessonLink(name, url or 'http://cdn.example.com/{}.{}'.format(name, 'm3u8' if is_playlist else 'mp4'))
+    return PlannedDownload(priority, link, '/out', 'Department', lesson, '/out/' + name, is_playlist, size)
+
+
+def test_plan():
+    plan = Plan([planned('a', 'small', 10), planned('a', 'hls', 50, is_playlist=True), planned('b', 'large', 100),
+                 planned('b', 'unknown', None), planned('c', 'urgent', 1, priority=1),
+                 planned('c', 'copy', 100, url='http://cdn.example.com/large.mp4?token=2')])
+    assert (plan.total, plan.unknown) == (161, 1)
+    assert plan.by_lesson()['Department'] == {'a': [2, 60], 'b': [2, 100], 'c': [2, 1]}
+    assert 'Plan: 6 files' in plan.report()
+
+    # priority first, then the largest files with playlists in between
+    assert [download.link.name for download in plan.ordered()] == ['urgent', 'large', 'hls', 'copy', 'small',
+                                                                   'unknown']
+
+    assert plan.within_budget(161) is plan
+    with pytest.raises(DiskBudgetException):
+        plan.within_budget(160)
+    # whole lessons, the higher priority one first
+    trimmed = plan.within_budget(110, trim=True)
+    assert sorted(download.lesson for download in trimmed.downloads) == ['b', 'b', 'c', 'c']
+
+
+def test_probe_sizes(tmpdir):
+    loop = asyncio.get_event_loop()
+    with FakeArtistWorks(media=MIXED, video_size=300000, hls_segments=3, segment_size=1000,
+                         require_login=False) as server:
+        downloader = AsyncDownloader(loop=loop)
+        slots = []
+        take_slot = downloader.scheduler.slot
+        downloader.scheduler.slot = lambda url: slots.append(url) or take_slot(url)
+        planner = DownloadPlanner(downloader)
+        for title, url in server.video_links('lesson_101', 2):
+            planner.add(0, LessonLink(title, url), str(tmpdir), 'Department 1', 'Lesson 101')
+        plan = planner.plan()
+        downloader.close()
+
+    assert [download.size for download in plan.downloads] == [300000, 3000]
+    # the file, the master and media playlists and the first segment, within the host rates of the downloads
+    assert len(slots) == 4
+    assert [download.is_playlist for download in plan.downloads] == [False, True]
@@ -0,0 +1,64 @@
+import asyncio
+
+from artistworks_downloader.scheduler import AdaptiveLimiter, DownloadScheduler
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+
+def take(limiter):
+    for _ in limiter.acquire():
+        raise AssertionError('no free slot')
+
+
+def test_limiter_backs_off_on_errors():
+    clock = Clock()
+    limiter = AdaptiveLimiter(clock, initial=8, minimum=2, maximum=16, interval=1)
+    for _ in range(3):
+        take(limiter)
+        clock.now += 1
+        limiter.release(failed=True)
+    assert limiter.capacity == 2
+
+
+def test_limiter_grows_while_saturated():
+    clock = Clock()
+    limiter = AdaptiveLimiter(clock, initial=1, minimum=1, maximum=8, interval=1)
+    for _ in range(2):
+        # every slot is taken
+        while limiter.in_use < limiter.capacity:
+            take(limiter)
+        clock.now += 1
+        limiter.record_bytes(1024 * 1024)
+    assert limiter.capacity == 3
+
+    # throughput dropped after the last increase, it is undone
+    clock.now += 1
+    limiter.record_bytes(1024)
+    assert limiter.capacity == 2
+
+
+def test_slots_never_exceed_the_limit():
+    loop = asyncio.get_event_loop()
+    scheduler = DownloadScheduler(loop, initial=2, minimum=2, maximum=2, host_rate=None)
+    active = []
+
+    @asyncio.coroutine
+    def download():
+        with (yield from scheduler.slot('http://a/video.mp4')):
+            active.append(scheduler.limiter.in_use)
+            yield from asyncio.sleep(0.01)
+
+    loop.run_until_complete(asyncio.gather(*[download() for _ in range(6)]))
+    assert max(active) == 2
+    assert scheduler.limiter.in_use == 0
+
+
+def test_backoff_is_bounded():
+    scheduler = DownloadScheduler(asyncio.get_event_loop(), backoff_base=2, backoff_max=10)
+    assert all(0 <= scheduler.backoff(attempt) <= min(10, 2 * 2 ** attempt) for attempt in range(8))
@@ -0,0 +1,58 @@
+import os
+import time
+
+from artistworks_downloader import session_store
+from artistworks_downloader.session_store import SessionStore, restore_or_login, cookies_for
+
+from fake_artistworks import FakeArtistWorks
+
+
+class FakeScraper(object):
+    def __init__(self, cookies):
+        self.cookies = cookies
+        self.logins = 0
+        self.restored = None
+
+    def login_to_artistworks(self, username, password):
+        self.logins += 1
+        return True
+
+    def restore_session(self, cookies):
+        self.restored = cookies
+
+    def get_session_cookies(self):
+        return self.cookies
+
+
+def test_saved_session(tmpdir):
+    store = SessionStore(str(tmpdir.join('session')))
+    assert store.load('user') is None
+
+    expired = {'name': 'old', 'value': '1', 'domain': '.artistworks.com', 'expiry': time.time() - 1}
+    store.save('user', [{'name': 'SSESS1', 'value': 'abc', 'domain': '.artistworks.com'}, expired])
+    assert [cookie['name'] for cookie in store.load('user')] == ['SSESS1']
+    assert store.load('someone else') is None
+    assert os.stat(store.path).st_mode & 0o077 == 0
+
+    assert cookies_for('https://secure.artistworks.com/awentry', store.load()) == {'SSESS1': 'abc'}
+    assert cookies_for('https://cdn.example.com/video.mp4', store.load()) == {}
+
+
+def test_restore_or_login(tmpdir, monkeypatch):
+    store = SessionStore(str(tmpdir))
+    with FakeArtistWorks() as server:
+        monkeypatch.setattr(session_store, 'ARTISTWORKS_LOGIN', server.base_url + '/awentry')
+
+        first = FakeScraper(server.cookies)
+        assert not restore_or_login(first, store, 'user', 'secret')
+        assert first.logins == 1
+
+        second = FakeScraper(None)
+        assert restore_or_login(second, store, 'user', 'secret')
+        assert second.logins == 0 and second.restored == server.cookies
+
+        # the server forgot the session, logging in again
+        store.save('user', [dict(server.cookies[0], name='SSESSgone')])
+        third = FakeScraper(server.cookies)
+        assert not restore_or_login(third, store, 'user', 'secret')
+        assert third.logins == 1
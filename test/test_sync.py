@@ -0,0 +1,60 @@
+import asyncio
+import os
+
+from bs4 import BeautifulSoup
+
+from artistworks_downloader.constants import ARTISTWORKS_LESSON_BASE, ARTISTWORKS_DEPARTMENT_BASE
+from artistworks_downloader.manifest import Manifest
+from artistworks_downloader.sync import DepartmentSync
+from artistworks_downloader.webdriver import Lesson
+
+DEPARTMENT_PAGE = '<div id="media-group-table"><a href="/lesson/1">One</a><a href="/lesson/3">Three</a></div>'
+
+
+class FakeBrowser(object):
+    get_lesson_by_id = get_all_lesson_ids_for_department = None
+
+
+class FakeHttpScraper(object):
+    def __init__(self, pages):
+        self.loop = asyncio.get_event_loop()
+        self.pages = pages
+        self.fallback = FakeBrowser()
+
+    @asyncio.coroutine
+    def get_page_if_modified(self, url, etag=None, last_modified=None):
+        yield from asyncio.sleep(0)
+        content = self.pages.get(url)
+        if content is None or etag == 'same':
+            return None
+        return BeautifulSoup(content, 'html.parser'), content, 'same', None
+
+    @asyncio.coroutine
+    def _with_fallback(self, description, page_coroutine, fallback, *args):
+        return (yield from page_coroutine)
+
+    @asyncio.coroutine
+    def lesson_from_page(self, lesson_id, soup, content):
+        yield from asyncio.sleep(0)
+        return Lesson(lesson_id, 'One', [], ['9'])
+
+
+def test_sync_summary(tmpdir):
+    manifest = Manifest(os.path.join(str(tmpdir), 'manifest.sqlite'))
+    lessons = manifest.lessons('Guitar')
+    lessons['1'] = Lesson('1', 'One', [], ['8'])
+    lessons['2'] = Lesson('2', 'Two', [], [])
+
+    scraper = FakeHttpScraper({ARTISTWORKS_DEPARTMENT_BASE + '5': DEPARTMENT_PAGE,
+                               ARTISTWORKS_LESSON_BASE + '1': '<a href="/masterclass/9">answer</a>'})
+    summary = DepartmentSync(scraper, manifest, 'Guitar').run(5)
+    assert summary.new == ['3']
+    assert summary.changed == ['1']
+    assert summary.removed == ['2']
+    assert lessons['1'].masterclass_ids == ['9']
+    manifest.set_department_lessons('Guitar', summary.lessons)
+
+    # nothing changed since, every page is answered with a 304
+    summary = DepartmentSync(scraper, manifest, 'Guitar').run(5)
+    assert summary.unchanged == ['1']
+    assert summary.changed == []
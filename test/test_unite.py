@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from artistworks_downloader.unite import find_part_groups, copy_into, unite_group
+
+
+def touch(path, content=b''):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def test_find_part_groups(tmpdir):
+    folder = str(tmpdir)
+    os.makedirs(os.path.join(folder, 'masterclass'))
+    for i in range(3):
+        touch(os.path.join(folder, 'lesson_part{}.ts'.format(i)))
+    touch(os.path.join(folder, 'broken_part0.ts'))
+    touch(os.path.join(folder, 'broken_part2.ts'))
+    touch(os.path.join(folder, 'masterclass', 'answer_part0.ts'))
+    touch(os.path.join(folder, 'masterclass', 'answer_part1.ts'))
+    # not parts: an in progress download and a name that only looks like one
+    touch(os.path.join(folder, 'other_part3.ts.part'))
+    touch(os.path.join(folder, 'my_video_part_2.mp4'))
+
+    groups = {group.name: group for group in find_part_groups(folder)}
+    assert sorted(groups) == ['answer', 'broken', 'lesson']
+    assert groups['lesson'].complete
+    assert not groups['broken'].complete
+    assert groups['lesson'].part_paths == [os.path.join(folder, 'lesson_part{}.ts'.format(i)) for i in range(3)]
+
+
+def test_copy_into_concatenates(tmpdir):
+    folder = str(tmpdir)
+    paths = []
+    for i in range(3):
+        paths.append(os.path.join(folder, '{}.ts'.format(i)))
+        touch(paths[-1], bytes([i]) * 1000)
+
+    with open(os.path.join(folder, 'out.ts'), 'wb') as out:
+        for path in paths:
+            copy_into(path, out)
+
+    with open(os.path.join(folder, 'out.ts'), 'rb') as out:
+        assert out.read() == b'\x00' * 1000 + b'\x01' * 1000 + b'\x02' * 1000
+
+
+def test_failed_concatenation_is_removed(tmpdir):
+    folder = str(tmpdir)
+    touch(os.path.join(folder, 'lesson_part0.ts'), b'\x47' * 1000)
+    part_paths = [os.path.join(folder, 'lesson_part{}.ts'.format(i)) for i in range(2)]
+
+    with pytest.raises(OSError):
+        unite_group(folder, 'lesson', 'ts', part_paths)
+    assert os.listdir(folder) == ['lesson_part0.ts']
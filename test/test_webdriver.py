@@ -1,5 +1,77 @@
+import time
+
 import pytest
 
 @pytest.fixture
 def blah():
     pass
+
+
+class FakeDriver(object):
+    def __init__(self):
+        self.closed = False
+
+    def get_cookies(self):
+        return [{'name': 'SESS', 'value': 'x'}]
+
+    def close(self):
+        self.closed = True
+
+
+def test_exited_browser_restarts(monkeypatch):
+    from artistworks_downloader.webdriver import ArtistWorkScraper
+
+    monkeypatch.setattr(ArtistWorkScraper, '_start_driver', lambda self: FakeDriver())
+    monkeypatch.setattr(ArtistWorkScraper, 'load_session_cookies', lambda self, cookies: None)
+    scraper = ArtistWorkScraper()
+    first = scraper.driver
+    scraper.exit()
+    assert first.closed
+    second = scraper.driver
+    assert second is not first and not second.closed
+    assert scraper.get_session_cookies() == [{'name': 'SESS', 'value': 'x'}]
+
+
+class PlayerDriver(object):
+    """
+    A page whose player moved to the next playlist item, which plays the same file as the previous one
+    """
+
+    def __init__(self, events):
+        self.events = events
+
+    def execute_script(self, script, *args):
+        from artistworks_downloader import webdriver
+
+        if script == webdriver.JWPLAYER_EVENT_POLL:
+            return {'player': 0, 'type': 'playlistItem', 'file': 'same.mp4', 'changed': True, 'index': 1} \
+                if self.events else None
+        if script == webdriver.JWPLAYER_SNAPSHOT:
+            return [{'id': 0, 'state': 'PLAYING', 'index': 1, 'playlist': []}]
+        if script == webdriver.JWPLAYER_TAKE_FILE:
+            return {'file': 'same.mp4', 'index': 1}
+        return True
+
+
+class Element(object):
+    text = 'part 2'
+
+    def click(self):
+        pass
+
+
+@pytest.mark.parametrize('events', [True, False])
+def test_same_file_in_next_playlist_item(monkeypatch, events):
+    from artistworks_downloader import webdriver
+
+    monkeypatch.setattr(webdriver, 'LINK_EVENT_TIMEOUT', 0.2)
+    scraper = webdriver.ArtistWorkScraper()
+    scraper._driver = PlayerDriver(events)
+    scraper.last_link, scraper.last_item = 'same.mp4', (0, 0)
+
+    start = time.time()
+    assert scraper._get_video_link_for_element(Element()) == 'same.mp4'
+    # taken as soon as the player moved, not after the whole polling timeout
+    assert time.time() - start < 2
+    assert scraper.last_item == (0, 1)
+    assert scraper.link_latencies[0][2] == ('event' if events else 'poll')